@@ -0,0 +1,106 @@
+# accounts/carrito_invitado.py
+"""
+Carrito de visitantes que todavía no iniciaron sesión.
+
+Vive del lado del cliente en una cookie firmada (no se puede alterar sin
+la SECRET_KEY) y acotada: {id_producto: cantidad}, como máximo
+CARRITO_INVITADO_MAX_LINEAS líneas (unos pocos cientos de bytes).
+Navegar y armar el carrito sin loguearse no escribe nada en Mongo;
+al iniciar sesión se fusiona con el carrito abierto del usuario
+(mongo_service.fusionar_carrito_invitado) y la cookie se borra.
+"""
+import json
+import re
+
+from django.conf import settings
+
+COOKIE = "carrito_invitado"
+SALT = "accounts.carrito_invitado"
+
+PATRON_OBJECT_ID = re.compile(r"^[0-9a-f]{24}$")
+
+
+def leer(request) -> dict[str, int]:
+    """
+    Devuelve {id_producto (str): cantidad} de la cookie.
+    Si no existe, la firma no es válida o expiró, devuelve {}.
+    """
+    crudo = request.get_signed_cookie(
+        COOKIE, default=None, salt=SALT, max_age=settings.CARRITO_INVITADO_MAX_AGE
+    )
+    if not crudo:
+        return {}
+
+    try:
+        datos = json.loads(crudo)
+    except ValueError:
+        return {}
+    if not isinstance(datos, dict):
+        return {}
+
+    items = {}
+    for id_producto, cantidad in datos.items():
+        if not PATRON_OBJECT_ID.match(str(id_producto)):
+            continue
+        # bool es subclase de int: true no es una cantidad
+        if isinstance(cantidad, int) and not isinstance(cantidad, bool) and cantidad > 0:
+            items[id_producto] = cantidad
+        if len(items) >= settings.CARRITO_INVITADO_MAX_LINEAS:
+            break
+    return items
+
+
+def guardar(response, items: dict[str, int]) -> None:
+    """
+    Escribe el carrito en la cookie de la respuesta (o la borra si quedó vacío).
+    """
+    if not items:
+        borrar(response)
+        return
+
+    response.set_signed_cookie(
+        COOKIE,
+        json.dumps(items, separators=(",", ":")),
+        salt=SALT,
+        max_age=settings.CARRITO_INVITADO_MAX_AGE,
+        httponly=True,
+        samesite="Lax",
+        secure=settings.SESSION_COOKIE_SECURE,
+    )
+
+
+def borrar(response) -> None:
+    response.delete_cookie(COOKIE, samesite="Lax")
+
+
+def fijar_cantidad(items: dict[str, int], id_producto: str, cantidad: int) -> dict[str, int]:
+    """
+    Devuelve una copia de 'items' con la cantidad del producto cambiada
+    (0 lo elimina). Lanza ValueError si se supera el máximo de líneas.
+    """
+    items = dict(items)
+    if cantidad <= 0:
+        items.pop(id_producto, None)
+        return items
+
+    if id_producto not in items and len(items) >= settings.CARRITO_INVITADO_MAX_LINEAS:
+        raise ValueError(
+            f"Puedes tener hasta {settings.CARRITO_INVITADO_MAX_LINEAS} productos distintos "
+            "en el carrito sin iniciar sesión."
+        )
+    items[id_producto] = cantidad
+    return items
+
+
+def resumen(items: dict[str, int]) -> dict:
+    """
+    Resumen para el contador del encabezado (misma forma que
+    mongo_service.resumen_carrito). El total no se conoce sin leer precios.
+    """
+    return {
+        "idCarrito": None,
+        "lineas": len(items),
+        "unidades": sum(items.values()),
+        "total": None,
+        "version": 0,
+    }
@@ -0,0 +1,185 @@
+# accounts/catalogo_snapshot.py
+"""
+Snapshot binario del catálogo activo.
+
+El archivo es una secuencia de documentos BSON:
+  [cabecera {version, generado, cantidad}] [producto] [producto] ...
+Cada worker lo abre con mmap (solo lectura): un worker recién arrancado
+sirve el catálogo sin pedirle a Mongo la colección completa, y los bytes
+del archivo quedan en la caché de páginas del sistema, compartida por los
+procesos del host.
+Lo que sí es de cada worker son los registros Producto que se decodifican
+del archivo: se construyen una vez por versión cargada (registros con
+__slots__, ver 'python manage.py benchmark_memoria_catalogo').
+"""
+import mmap
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import bson
+from django.conf import settings
+
+from . import mongo_service
+from .registros import Producto
+
+_lock = threading.Lock()
+_mapa = None        # mmap del archivo actual
+_version = None     # versión de catálogo del snapshot cargado
+_inicio = 0         # offset donde empiezan los productos (después de la cabecera)
+_productos = None   # registros Producto decodificados de _mapa (una vez por versión)
+_hilo = None
+
+
+def _ruta() -> str | None:
+    ruta = getattr(settings, "CATALOGO_SNAPSHOT_PATH", None)
+    return str(ruta) if ruta else None
+
+
+def escribir_snapshot(ruta: str | None = None) -> int:
+    """
+    Vuelca el catálogo activo (parte descriptiva) al archivo de snapshot.
+    La escritura es atómica (archivo temporal + os.replace), así que los
+    workers que ya lo tienen mapeado siguen leyendo la versión anterior.
+    Devuelve la versión de catálogo escrita.
+    """
+    ruta = ruta or _ruta()
+    if not ruta:
+        raise ValueError("CATALOGO_SNAPSHOT_PATH no está configurado")
+
+    version = mongo_service.obtener_version_catalogo()
+    productos = mongo_service.consultar_catalogo_descriptivo_activo()
+
+    cabecera = {
+        "version": version,
+        "generado": datetime.now(timezone.utc),
+        "cantidad": len(productos),
+    }
+
+    directorio = os.path.dirname(os.path.abspath(ruta))
+    fd, temporal = tempfile.mkstemp(dir=directorio, prefix=".catalogo-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(bson.encode(cabecera))
+            for doc in productos:
+                f.write(bson.encode(doc))
+        os.replace(temporal, ruta)
+    except Exception:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+    return version
+
+
+def cargar_snapshot(ruta: str | None = None) -> int | None:
+    """
+    Mapea en memoria el archivo de snapshot y lee su cabecera.
+    Devuelve la versión cargada o None si no hay archivo.
+    """
+    global _mapa, _version, _inicio, _productos
+
+    ruta = ruta or _ruta()
+    if not ruta or not os.path.exists(ruta):
+        return None
+
+    with open(ruta, "rb") as f:
+        nuevo_mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    largo_cabecera = int.from_bytes(nuevo_mapa[:4], "little")
+    cabecera = bson.decode(nuevo_mapa[:largo_cabecera])
+
+    with _lock:
+        anterior = _mapa
+        _mapa = nuevo_mapa
+        _version = cabecera.get("version")
+        _inicio = largo_cabecera
+        _productos = None
+
+    if anterior is not None:
+        anterior.close()
+    return _version
+
+
+def version_cargada() -> int | None:
+    return _version
+
+
+def decodificar_productos(datos) -> list[Producto]:
+    """Registros Producto a partir de los documentos BSON de 'datos' (sin la cabecera)."""
+    return [Producto.desde_bson(doc) for doc in bson.decode_iter(datos)]
+
+
+def productos_activos(version: int) -> list[Producto] | None:
+    """
+    Productos activos del snapshot si corresponde a 'version'.
+    Devuelve None si no hay snapshot cargado o está desactualizado,
+    para que el llamador vaya a Mongo.
+    Los registros se construyen una sola vez por versión cargada y se
+    comparten entre requests: los llamadores no deben modificarlos.
+    """
+    global _productos
+
+    with _lock:
+        if _mapa is None or _version != version:
+            return None
+        if _productos is None:
+            _productos = decodificar_productos(memoryview(_mapa)[_inicio:])
+        return _productos
+
+
+def refrescar() -> None:
+    """
+    Si la versión del catálogo cambió:
+    - si otro worker ya escribió un snapshot nuevo, solo se recarga;
+    - si no, se escribe y se recarga.
+    """
+    version = mongo_service.obtener_version_catalogo()
+    if version == _version:
+        return
+
+    try:
+        en_disco = cargar_snapshot()
+    except Exception as e:
+        # Archivo vacío o cabecera corrupta: se regenera abajo
+        print("⚠️ Snapshot del catálogo inválido, se regenerará:", e)
+        en_disco = None
+    if en_disco != version:
+        escribir_snapshot()
+        cargar_snapshot()
+
+
+def _bucle_refresco(intervalo: int) -> None:
+    while True:
+        try:
+            refrescar()
+        except Exception as e:
+            print("⚠️ No se pudo refrescar el snapshot del catálogo:", e)
+        time.sleep(intervalo)
+
+
+def iniciar() -> None:
+    """
+    Se llama al arrancar cada worker (nexosoft/wsgi.py):
+    carga el snapshot existente y deja un hilo que lo mantiene al día.
+    """
+    global _hilo
+
+    if not _ruta() or _hilo is not None:
+        return
+
+    try:
+        cargar_snapshot()
+    except Exception as e:
+        print("⚠️ Snapshot del catálogo inválido, se regenerará:", e)
+
+    intervalo = getattr(settings, "CATALOGO_SNAPSHOT_INTERVALO", 60)
+    _hilo = threading.Thread(
+        target=_bucle_refresco,
+        args=(intervalo,),
+        name="catalogo-snapshot",
+        daemon=True,
+    )
+    _hilo.start()
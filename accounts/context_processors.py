@@ -0,0 +1,27 @@
+# accounts/context_processors.py
+from django.utils.functional import SimpleLazyObject
+
+from . import carrito_invitado, mongo_service
+
+
+def resumen_carrito_actual(request) -> dict:
+    """
+    Resumen del carrito para el encabezado sin consultar Mongo:
+    el de la sesión (usuarios logueados) o el de la cookie de invitado.
+    """
+    resumen = request.session.get("carrito_resumen")
+    if resumen:
+        return resumen
+    if not request.session.get("usuario_id"):
+        return carrito_invitado.resumen(carrito_invitado.leer(request))
+    return mongo_service.resumen_carrito(None)
+
+
+def carrito_resumen(request):
+    """
+    Expone 'carrito_resumen' (sesión o cookie de invitado) a todos
+    los templates, para el contador del encabezado.
+    Es perezoso: si el template no lo usa no se toca la sesión
+    (la landing cacheable lo recibe por /encabezado/).
+    """
+    return {"carrito_resumen": SimpleLazyObject(lambda: resumen_carrito_actual(request))}
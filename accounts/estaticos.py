@@ -0,0 +1,95 @@
+# accounts/estaticos.py
+import mimetypes
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+# Nombre con hash generado por ManifestComprimidoStorage: styles.3f2a9c1b7d4e.css
+PATRON_HASH = re.compile(r"\.[0-9a-f]{12}\.[^./]+$")
+
+CACHE_INMUTABLE = "public, max-age=31536000, immutable"
+CACHE_SIN_HASH = "public, max-age=0, must-revalidate"
+
+# Orden de preferencia de las versiones pre-comprimidas
+CODIFICACIONES = (("br", ".br"), ("gzip", ".gz"))
+
+
+def _calidades_codificacion(cabecera: str) -> dict:
+    """
+    Accept-Encoding → {codificación: q}. 'br;q=0' queda con q=0 (rechazada);
+    sin q el valor es 1. Los q mal formados cuentan como 0.
+    """
+    calidades = {}
+    for parte in cabecera.split(","):
+        nombre, _, parametros = parte.partition(";")
+        nombre = nombre.strip().lower()
+        if not nombre:
+            continue
+        q = 1.0
+        for parametro in parametros.split(";"):
+            clave, _, valor = parametro.partition("=")
+            if clave.strip().lower() == "q":
+                try:
+                    q = float(valor)
+                except ValueError:
+                    q = 0.0
+        calidades[nombre] = q
+    return calidades
+
+
+def _acepta(calidades: dict, codificacion: str) -> bool:
+    return calidades.get(codificacion, calidades.get("*", 0)) > 0
+
+
+def servir_estatico(request, path: str):
+    """
+    Sirve archivos de STATIC_ROOT (producción, DEBUG=False).
+    - Si el cliente acepta br/gzip y existe el hermano .br/.gz, lo envía
+      directamente sin comprimir en caliente.
+    - Los nombres con hash llevan Cache-Control immutable por un año:
+      el navegador no vuelve a pedirlos mientras el HTML apunte a ellos.
+    Delante de un nginx basta con 'gzip_static on;' / 'brotli_static on;'
+    y el mismo Cache-Control para location /static/.
+    """
+    raiz = Path(settings.STATIC_ROOT).resolve()
+    ruta = (raiz / path).resolve()
+
+    # Evitar path traversal (../../settings.py)
+    if raiz not in ruta.parents or not ruta.is_file():
+        raise Http404("Archivo estático no encontrado")
+
+    es_inmutable = bool(PATRON_HASH.search(ruta.name))
+    cache_control = CACHE_INMUTABLE if es_inmutable else CACHE_SIN_HASH
+    modificado = ruta.stat().st_mtime
+
+    # Revalidación (sobre todo de los sin hash, que se revalidan siempre)
+    if not was_modified_since(request.headers.get("If-Modified-Since"), modificado):
+        respuesta = HttpResponseNotModified()
+        respuesta["Last-Modified"] = http_date(modificado)
+        respuesta["Cache-Control"] = cache_control
+        respuesta["Vary"] = "Accept-Encoding"
+        return respuesta
+
+    content_type, _ = mimetypes.guess_type(ruta.name)
+    aceptadas = _calidades_codificacion(request.headers.get("Accept-Encoding", ""))
+
+    archivo = ruta
+    codificacion = None
+    for nombre, sufijo in CODIFICACIONES:
+        candidato = ruta.with_name(ruta.name + sufijo)
+        if _acepta(aceptadas, nombre) and candidato.is_file():
+            archivo = candidato
+            codificacion = nombre
+            break
+
+    respuesta = FileResponse(open(archivo, "rb"), content_type=content_type or "application/octet-stream")
+    respuesta["Last-Modified"] = http_date(modificado)
+    respuesta["Cache-Control"] = cache_control
+    respuesta["Vary"] = "Accept-Encoding"
+    if codificacion:
+        respuesta["Content-Encoding"] = codificacion
+    return respuesta
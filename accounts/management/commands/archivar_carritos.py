@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from accounts import mongo_service
+
+
+class Command(BaseCommand):
+    help = "Mueve los carritos 'convertido' de Carritos a CarritosArchivados, por lotes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lote",
+            type=int,
+            default=500,
+            help="Carritos por lote (por defecto 500).",
+        )
+        parser.add_argument(
+            "--sin-archivo",
+            action="store_true",
+            help="Borrarlos sin copiarlos (el pedido ya guarda el detalle).",
+        )
+
+    def handle(self, *args, **options):
+        if options["lote"] <= 0:
+            raise CommandError("--lote debe ser mayor a 0")
+
+        try:
+            total = mongo_service.archivar_carritos_convertidos(
+                tamano_lote=options["lote"],
+                archivar=not options["sin_archivo"],
+            )
+        except PyMongoError as e:
+            raise CommandError(f"No se pudieron archivar los carritos: {e}")
+
+        accion = "eliminados" if options["sin_archivo"] else "archivados"
+        self.stdout.write(self.style.SUCCESS(f"{total} carrito(s) convertidos {accion}."))
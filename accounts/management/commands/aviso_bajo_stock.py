@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.mail import send_mail
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from accounts import mongo_service
+
+
+class Command(BaseCommand):
+    help = "Envía (o muestra) el resumen de productos con stock bajo para reponer."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--recalcular",
+            action="store_true",
+            help="Recalcular antes la marca bajoStock de todo el catálogo.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            if options["recalcular"]:
+                cambiados = mongo_service.recalcular_bajo_stock()
+                self.stdout.write(f"bajoStock recalculado en {cambiados} producto(s).")
+            productos = mongo_service.listar_productos_bajo_stock()
+        except PyMongoError as e:
+            raise CommandError(f"No se pudo leer el stock bajo: {e}")
+
+        if not productos:
+            self.stdout.write(self.style.SUCCESS("No hay productos con stock bajo."))
+            return
+
+        lineas = "\n".join(
+            f"  - {p.get('nombreProducto', '')} ({p.get('skuProducto') or 'sin SKU'}): "
+            f"stock {p['inventario'].get('stockActual', 0)}, "
+            f"mínimo {p['inventario'].get('stockMinimo', 0)}, "
+            f"faltan {p['faltante']}"
+            for p in productos
+        )
+        self.stdout.write(lineas)
+
+        if settings.AVISO_BAJO_STOCK_CORREOS:
+            send_mail(
+                subject=f"{len(productos)} producto(s) con stock bajo",
+                message=f"Productos para reponer:\n{lineas}\n",
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                recipient_list=settings.AVISO_BAJO_STOCK_CORREOS,
+            )
+            self.stdout.write(f"Resumen enviado a {', '.join(settings.AVISO_BAJO_STOCK_CORREOS)}.")
+
+        self.stdout.write(self.style.SUCCESS(f"{len(productos)} producto(s) con stock bajo."))
@@ -0,0 +1,127 @@
+import gc
+import mmap
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import bson
+from bson import ObjectId
+from django.core.management.base import BaseCommand
+
+from accounts.catalogo_snapshot import decodificar_productos
+from accounts.registros import Producto
+
+
+def _documentos_sinteticos(cantidad: int) -> list[dict]:
+    """
+    Documentos con la misma forma que Productos en Mongo
+    (lo que devuelve pymongo al leer la colección).
+    """
+    ahora = datetime.now(timezone.utc)
+    return [
+        {
+            "_id": ObjectId(),
+            "nombreProducto": f"Producto de ferretería {i}",
+            "descripcionCortaProducto": "Herramienta de uso doméstico y profesional.",
+            "marcaProducto": "Marca",
+            "unidadMedidaProducto": "unidad",
+            "idCategoria": ObjectId(),
+            "estadoProducto": "activo",
+            "skuProducto": f"SKU-{i:06d}",
+            "codigoBarrasProducto": f"77{i:011d}",
+            "imagenUrl": "",
+            "inventario": {"stockActual": 10, "stockMinimo": 2, "precioVenta": 1000.0 + i},
+            "fechaCreacion": ahora,
+            "fechaActualizacion": ahora,
+        }
+        for i in range(cantidad)
+    ]
+
+
+def _medir(construir):
+    gc.collect()
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    resultado = construir()
+    segundos = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    actual = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return resultado, actual, pico, segundos
+
+
+def _como_dicts(documentos):
+    # Lo que hacía listar_productos_activos: el dict completo + copia "id"
+    productos = []
+    for doc in documentos:
+        doc = dict(doc, inventario=dict(doc["inventario"]))
+        doc["id"] = str(doc["_id"])
+        productos.append(doc)
+    return productos
+
+
+def _como_registros(documentos):
+    return [Producto.desde_bson(doc) for doc in documentos]
+
+
+def _desde_snapshot(mapa):
+    # Lo que hace cada worker al cargar el snapshot: el mmap no cuenta
+    # (no es memoria de Python), los registros decodificados sí
+    return decodificar_productos(memoryview(mapa))
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara la memoria del catálogo en memoria como dicts de pymongo "
+        "vs. registros Producto con __slots__, y lo que ocupa en cada worker "
+        "el catálogo decodificado del snapshot mmap."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--productos", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        cantidad = options["productos"]
+        documentos = _documentos_sinteticos(cantidad)
+
+        dicts, mem_dicts, pico_dicts, t_dicts = _medir(lambda: _como_dicts(documentos))
+        registros, mem_reg, pico_reg, t_reg = _medir(lambda: _como_registros(documentos))
+
+        descriptivos = [{k: v for k, v in doc.items() if k != "inventario"} for doc in documentos]
+        with tempfile.TemporaryFile() as f:
+            for doc in descriptivos:
+                f.write(bson.encode(doc))
+            f.flush()
+            tamano = f.tell()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapa:
+                _, mem_snap, pico_snap, t_snap = _medir(lambda: _desde_snapshot(mapa))
+
+        # Acceso típico del template: nombre, precio e id
+        inicio = time.perf_counter()
+        for p in dicts:
+            p["nombreProducto"], p["inventario"]["precioVenta"], p["id"]
+        acceso_dicts = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        for p in registros:
+            p.nombreProducto, p.inventario.precioVenta, p.id
+        acceso_reg = time.perf_counter() - inicio
+
+        self.stdout.write(f"Productos: {cantidad}")
+        self.stdout.write(
+            f"dicts     : {mem_dicts / 1024:10.1f} KiB  (pico {pico_dicts / 1024:.1f} KiB)  "
+            f"construir {t_dicts * 1000:.1f} ms  acceso {acceso_dicts * 1000:.1f} ms"
+        )
+        self.stdout.write(
+            f"registros : {mem_reg / 1024:10.1f} KiB  (pico {pico_reg / 1024:.1f} KiB)  "
+            f"construir {t_reg * 1000:.1f} ms  acceso {acceso_reg * 1000:.1f} ms"
+        )
+        self.stdout.write(
+            f"snapshot  : {mem_snap / 1024:10.1f} KiB  (pico {pico_snap / 1024:.1f} KiB)  "
+            f"decodificar {t_snap * 1000:.1f} ms  "
+            f"(archivo mmap {tamano / 1024:.1f} KiB, compartido en la caché de páginas)"
+        )
+        if mem_dicts:
+            ahorro = 100 * (1 - mem_reg / mem_dicts)
+            self.stdout.write(self.style.SUCCESS(f"Ahorro de memoria: {ahorro:.0f}%"))
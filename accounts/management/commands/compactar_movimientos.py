@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from accounts import mongo_service
+
+
+class Command(BaseCommand):
+    help = "Resume en saldos diarios los movimientos de inventario viejos y los borra."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dias",
+            type=int,
+            default=None,
+            help="Días de movimientos que se conservan (por defecto MOVIMIENTOS_RETENCION_DIAS).",
+        )
+
+    def handle(self, *args, **options):
+        if options["dias"] is not None and options["dias"] < 0:
+            raise CommandError("--dias no puede ser negativo")
+
+        try:
+            total = mongo_service.compactar_movimientos_inventario(options["dias"])
+        except PyMongoError as e:
+            raise CommandError(f"No se pudieron compactar los movimientos: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"{total} movimiento(s) compactados."))
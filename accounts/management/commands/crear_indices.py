@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from accounts import mongo_service
+
+
+class Command(BaseCommand):
+    help = "Crea en Mongo los índices que necesita la app (idempotente)."
+
+    def handle(self, *args, **options):
+        try:
+            nombres = mongo_service.asegurar_indices()
+        except PyMongoError as e:
+            raise CommandError(f"No se pudieron crear los índices: {e}")
+
+        for nombre in nombres:
+            self.stdout.write(f"  · {nombre}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(nombres)} índice(s) verificados."
+        ))
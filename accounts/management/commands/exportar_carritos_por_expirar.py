@@ -0,0 +1,59 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from accounts import mongo_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Exporta (JSON Lines) los carritos abiertos que el índice TTL "
+        "borrará pronto, para campañas de recuperación."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dias",
+            type=int,
+            default=3,
+            help="Carritos que expiran dentro de estos días (por defecto 3).",
+        )
+        parser.add_argument(
+            "--salida",
+            help="Archivo de salida (por defecto la salida estándar).",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            carritos = mongo_service.carritos_por_expirar(options["dias"])
+        except PyMongoError as e:
+            raise CommandError(f"No se pudieron leer los carritos: {e}")
+
+        salida = open(options["salida"], "w", encoding="utf-8") if options["salida"] else sys.stdout
+        try:
+            for carrito in carritos:
+                usuario = carrito["usuario"]
+                fila = {
+                    "idCarrito": str(carrito["_id"]),
+                    "idUsuario": str(carrito["idUsuarioCliente"]),
+                    "correo": usuario.get("correoElectronico", ""),
+                    "nombres": usuario.get("nombres", ""),
+                    "total": carrito.get("totalSeleccionadoSnapshot", 0),
+                    "fechaActualizacion": carrito["fechaActualizacionCarrito"].isoformat(),
+                    "items": [
+                        {
+                            "idProducto": str(item["idProducto"]),
+                            "nombreProducto": item.get("nombreProducto", ""),
+                            "cantidad": item.get("cantidad", 0),
+                        }
+                        for item in carrito.get("itemsCarrito", [])
+                    ],
+                }
+                salida.write(json.dumps(fila, ensure_ascii=False) + "\n")
+        finally:
+            if salida is not sys.stdout:
+                salida.close()
+
+        self.stderr.write(self.style.SUCCESS(f"{len(carritos)} carrito(s) exportados."))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import catalogo_snapshot
+
+
+class Command(BaseCommand):
+    help = "Genera el snapshot binario del catálogo activo (CATALOGO_SNAPSHOT_PATH)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ruta",
+            help="Ruta de salida (por defecto CATALOGO_SNAPSHOT_PATH).",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            version = catalogo_snapshot.escribir_snapshot(options.get("ruta"))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Snapshot del catálogo generado (versión {version})."
+        ))
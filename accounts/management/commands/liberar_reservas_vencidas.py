@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from accounts import mongo_service
+
+
+class Command(BaseCommand):
+    help = "Devuelve al stock disponible las reservas de carrito ya vencidas, por lotes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lote",
+            type=int,
+            default=500,
+            help="Reservas por lote (por defecto 500).",
+        )
+
+    def handle(self, *args, **options):
+        if options["lote"] <= 0:
+            raise CommandError("--lote debe ser mayor a 0")
+
+        try:
+            total = mongo_service.liberar_reservas_vencidas(tamano_lote=options["lote"])
+        except PyMongoError as e:
+            raise CommandError(f"No se pudieron liberar las reservas: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"{total} unidad(es) reservadas liberadas."))
@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from accounts import trabajos
+
+
+class Command(BaseCommand):
+    help = "Ejecuta los trabajos en segundo plano de la colección Trabajos."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--una-vez",
+            action="store_true",
+            help="Vaciar la cola y terminar (para cron) en vez de quedarse esperando.",
+        )
+        parser.add_argument(
+            "--intervalo",
+            type=float,
+            default=2.0,
+            help="Segundos de espera cuando la cola está vacía (por defecto 2).",
+        )
+
+    def handle(self, *args, **options):
+        if options["intervalo"] <= 0:
+            raise CommandError("--intervalo debe ser mayor a 0")
+
+        trabajador = trabajos.nombre_trabajador()
+        hechos = fallidos = 0
+        self.stdout.write(f"Trabajador {trabajador} iniciado.")
+
+        try:
+            while True:
+                try:
+                    trabajo = trabajos.procesar_siguiente(trabajador)
+                except PyMongoError as e:
+                    # Mongo caído un momento: esperar y seguir
+                    self.stderr.write(f"Error de Mongo: {e}")
+                    time.sleep(options["intervalo"])
+                    continue
+
+                if trabajo is None:
+                    if options["una_vez"]:
+                        break
+                    time.sleep(options["intervalo"])
+                    continue
+
+                if trabajo["estado"] == "hecho":
+                    hechos += 1
+                else:
+                    fallidos += 1
+                    self.stderr.write(f"  ✗ {trabajo['tipo']} {trabajo['_id']} → {trabajo['estado']}")
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{hechos} trabajo(s) hechos, {fallidos} con error."
+        ))
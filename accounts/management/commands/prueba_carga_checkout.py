@@ -0,0 +1,365 @@
+import logging
+import math
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from importlib import import_module
+
+from bson import ObjectId
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from pymongo import MongoClient, monitoring
+
+from accounts import mongo_service
+
+# Sesiones en cookie firmada: varios hilos escribiendo sesiones en SQLite
+# medirían los bloqueos de SQLite, no el checkout.
+MOTOR_SESIONES = "django.contrib.sessions.backends.signed_cookies"
+
+
+class _ContadorComandos(monitoring.CommandListener):
+    """
+    Cuenta los comandos que llegan a Mongo, separados por la fase
+    ('agregar' / 'checkout') que el hilo actual marcó antes de la petición.
+    pymongo avisa 'started' en el mismo hilo que lanza el comando.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.por_fase = Counter()
+        self.por_comando = Counter()
+
+    def started(self, event):
+        fase = getattr(self.local, "fase", None)
+        if fase is None:
+            return
+        with self.lock:
+            self.por_fase[fase] += 1
+            self.por_comando[(fase, event.command_name)] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def _percentil(valores: list[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    # rango más cercano
+    indice = max(0, min(len(ordenados) - 1, math.ceil(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def _sembrar(usuarios: int, productos: int, stock: int) -> tuple[list, list]:
+    """
+    Crea productos y usuarios (con dirección principal) en la base de la
+    prueba. Devuelve ([ObjectId producto], [(id usuario str, id dirección str)]).
+    """
+    ahora = datetime.now(timezone.utc)
+    docs_productos = [
+        {
+            "_id": ObjectId(),
+            "nombreProducto": f"Producto de carga {i}",
+            "descripcionCortaProducto": "Producto sintético para la prueba de carga.",
+            "marcaProducto": "Carga",
+            "unidadMedidaProducto": "unidad",
+            "estadoProducto": "activo",
+            "skuProducto": f"CARGA-{i:05d}",
+            "imagenUrl": "",
+            "inventario": {
+                "stockActual": stock,
+                "stockMinimo": 0,
+                "precioVenta": 1000.0 + i,
+                "bajoStock": stock <= 0,
+            },
+            "fechaCreacion": ahora,
+            "fechaActualizacion": ahora,
+        }
+        for i in range(productos)
+    ]
+    mongo_service.get_productos_collection().insert_many(docs_productos)
+
+    docs_usuarios = [
+        {
+            "_id": ObjectId(),
+            "nombres": f"Cliente {i}",
+            "correoElectronico": f"cliente{i}@carga.local",
+            "fechaCreacion": ahora,
+        }
+        for i in range(usuarios)
+    ]
+    mongo_service.get_usuarios_collection().insert_many(docs_usuarios)
+
+    docs_direcciones = [
+        {
+            "_id": ObjectId(),
+            "idUsuario": u["_id"],
+            "nombreContacto": u["nombres"],
+            "telefonoContacto": "3000000000",
+            "ciudad": "Bogotá",
+            "barrio": "Centro",
+            "complemento": "",
+            "esPrincipal": True,
+            "activo": True,
+            "fechaCreacion": ahora,
+        }
+        for u in docs_usuarios
+    ]
+    mongo_service.get_direcciones_envio_collection().insert_many(docs_direcciones)
+
+    return (
+        [p["_id"] for p in docs_productos],
+        [(str(u["_id"]), str(d["_id"])) for u, d in zip(docs_usuarios, docs_direcciones)],
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Prueba de carga del checkout: siembra una base aparte y lanza clientes "
+        "concurrentes (agregar al carrito → checkout) con el test client de Django. "
+        "Reporta throughput, latencias, sobreventa, pedidos duplicados y "
+        "comandos de Mongo por checkout."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--uri", default=None,
+                            help="Mongo de la prueba (por defecto MONGO_URI_LOCAL).")
+        parser.add_argument("--db", default=None,
+                            help="Base de la prueba (por defecto <MONGO_DB_NAME>_carga). Se borra al empezar.")
+        parser.add_argument("--usuarios", type=int, default=200,
+                            help="Clientes concurrentes; cada uno hace un checkout.")
+        parser.add_argument("--hilos", type=int, default=20)
+        parser.add_argument("--productos", type=int, default=50)
+        parser.add_argument("--stock", type=int, default=30,
+                            help="Stock inicial de cada producto.")
+        parser.add_argument("--calientes", type=int, default=3,
+                            help="Cuántos productos concentran la demanda.")
+        parser.add_argument("--sesgo", type=float, default=0.8,
+                            help="Probabilidad de que una línea sea de un producto caliente (0-1).")
+        parser.add_argument("--lineas", type=int, default=2,
+                            help="Productos distintos por carrito.")
+        parser.add_argument("--max-cantidad", type=int, default=3)
+        parser.add_argument("--reenvios", type=int, default=0,
+                            help="Envíos extra y simultáneos del mismo checkout (doble clic).")
+        parser.add_argument("--semilla", type=int, default=None)
+
+    def handle(self, *args, **options):
+        uri = options["uri"] or settings.MONGO_URI_LOCAL
+        nombre_db = options["db"] or f"{settings.MONGO_DB_NAME}_carga"
+        if not uri:
+            raise CommandError("No hay URI de Mongo: usa --uri o MONGO_URI_LOCAL.")
+        if nombre_db == settings.MONGO_DB_NAME:
+            raise CommandError("La base de la prueba no puede ser la de la app (se borra al empezar).")
+        if not 0 <= options["sesgo"] <= 1:
+            raise CommandError("--sesgo debe estar entre 0 y 1")
+        if min(options["usuarios"], options["hilos"], options["productos"], options["lineas"]) <= 0:
+            raise CommandError("--usuarios, --hilos, --productos y --lineas deben ser mayores a 0")
+
+        aleatorio = random.Random(options["semilla"])
+        contador = _ContadorComandos()
+        cliente_mongo = MongoClient(uri, event_listeners=[contador], maxPoolSize=options["hilos"] * 2)
+        anterior = (mongo_service._client, mongo_service._db)
+        mongo_service._client = cliente_mongo
+        mongo_service._db = cliente_mongo[nombre_db]
+
+        try:
+            cliente_mongo.drop_database(nombre_db)
+            cache.clear()
+            mongo_service.asegurar_indices()
+            ids_productos, usuarios = _sembrar(
+                options["usuarios"], options["productos"], options["stock"]
+            )
+            self.stdout.write(
+                f"Base '{nombre_db}': {len(usuarios)} usuarios, {len(ids_productos)} productos "
+                f"(stock {options['stock']}), transacciones: "
+                f"{'sí' if mongo_service._soporta_transacciones() else 'no (mongod suelto)'}."
+            )
+
+            # Los 400 por falta de stock son esperables: no llenar la consola
+            log_requests = logging.getLogger("django.request")
+            nivel_anterior = log_requests.level
+            log_requests.setLevel(logging.ERROR)
+            try:
+                with override_settings(SESSION_ENGINE=MOTOR_SESIONES):
+                    resultado = self._ejecutar(usuarios, ids_productos, options, aleatorio, contador)
+            finally:
+                log_requests.setLevel(nivel_anterior)
+            self._reportar(resultado, ids_productos, options, contador)
+        finally:
+            mongo_service._client, mongo_service._db = anterior
+            cache.clear()
+            cliente_mongo.close()
+
+    # ─────────────────────────────────────────────
+
+    def _elegir_lineas(self, ids_productos, options, aleatorio) -> list:
+        calientes = ids_productos[:options["calientes"]]
+        resto = ids_productos[options["calientes"]:] or calientes
+        elegidos = set()
+        while len(elegidos) < min(options["lineas"], len(ids_productos)):
+            grupo = calientes if calientes and aleatorio.random() < options["sesgo"] else resto
+            elegidos.add(aleatorio.choice(grupo))
+        return [(p, aleatorio.randint(1, options["max_cantidad"])) for p in elegidos]
+
+    def _ejecutar(self, usuarios, ids_productos, options, aleatorio, contador) -> dict:
+        motor = import_module(MOTOR_SESIONES)
+        url_agregar = reverse("carrito_agregar")
+        url_checkout = reverse("carrito_checkout")
+        lock = threading.Lock()
+        latencias = {"agregar": [], "checkout": []}
+        resultados = Counter()
+
+        # Las decisiones aleatorias se toman antes, para que --semilla repita la prueba
+        planes = [
+            (id_usuario, id_direccion, self._elegir_lineas(ids_productos, options, aleatorio))
+            for id_usuario, id_direccion in usuarios
+        ]
+
+        def nuevo_cliente(cookie):
+            c = Client()
+            c.cookies[settings.SESSION_COOKIE_NAME] = cookie
+            return c
+
+        def medir(fase, funcion):
+            contador.local.fase = fase
+            inicio = time.perf_counter()
+            try:
+                return funcion()
+            finally:
+                segundos = time.perf_counter() - inicio
+                contador.local.fase = None
+                with lock:
+                    latencias[fase].append(segundos)
+
+        def checkout(cookie, id_direccion, clave):
+            r = medir("checkout", lambda: nuevo_cliente(cookie).post(
+                url_checkout, {"direccion_id": id_direccion, "clave_idempotencia": clave}
+            ))
+            ok = r.status_code == 302 and "/pedido/" in r.get("Location", "")
+            with lock:
+                resultados["checkout_ok" if ok else "checkout_rechazado"] += 1
+
+        def sesion(id_usuario, id_direccion, lineas):
+            store = motor.SessionStore()
+            store["usuario_id"] = id_usuario
+            store["usuario_nombre"] = "Carga"
+            store["usuario_rol"] = str(ObjectId())
+            store.save()
+            cookie = store.session_key
+
+            c = nuevo_cliente(cookie)
+            for id_producto, cantidad in lineas:
+                r = medir("agregar", lambda: c.post(
+                    url_agregar,
+                    {"producto_id": str(id_producto), "cantidad": cantidad},
+                    HTTP_ACCEPT="application/json",
+                ))
+                with lock:
+                    resultados["agregar_ok" if r.status_code == 200 else "agregar_rechazado"] += 1
+
+            clave = mongo_service.nueva_clave_idempotencia()
+            envios = 1 + options["reenvios"]
+            if envios == 1:
+                checkout(cookie, id_direccion, clave)
+            else:
+                with ThreadPoolExecutor(max_workers=envios) as doble_clic:
+                    for _ in range(envios):
+                        doble_clic.submit(checkout, cookie, id_direccion, clave)
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["hilos"]) as pool:
+            futuros = [pool.submit(sesion, *plan) for plan in planes]
+            for futuro in futuros:
+                try:
+                    futuro.result()
+                except Exception as e:
+                    resultados["errores"] += 1
+                    self.stderr.write(f"ERROR en un cliente de carga: {e}")
+        segundos = time.perf_counter() - inicio
+
+        return {"segundos": segundos, "latencias": latencias, "resultados": resultados}
+
+    def _reportar(self, resultado, ids_productos, options, contador):
+        resultados = resultado["resultados"]
+        segundos = resultado["segundos"]
+        pedidos = mongo_service.get_pedidos_collection()
+
+        vendidas = {
+            fila["_id"]: fila["unidades"]
+            for fila in pedidos.aggregate([
+                {"$unwind": "$itemsPedido"},
+                {"$group": {"_id": "$itemsPedido.idProducto", "unidades": {"$sum": "$itemsPedido.cantidad"}}},
+            ])
+        }
+        stocks = {
+            p["_id"]: p.get("inventario", {})
+            for p in mongo_service.get_productos_collection().find(
+                {"_id": {"$in": ids_productos}},
+                {"inventario.stockActual": 1, "inventario.reservado": 1},
+            )
+        }
+        sobreventa = sum(max(0, vendidas.get(p, 0) - options["stock"]) for p in ids_productos)
+        negativos = sum(1 for inv in stocks.values() if inv.get("stockActual", 0) < 0)
+        descuadres = sum(
+            1 for p in ids_productos
+            if options["stock"] - vendidas.get(p, 0) != stocks.get(p, {}).get("stockActual")
+        )
+        duplicados = sum(
+            fila["pedidos"] - 1
+            for fila in pedidos.aggregate([
+                {"$group": {"_id": "$idUsuarioCliente", "pedidos": {"$sum": 1}}},
+                {"$match": {"pedidos": {"$gt": 1}}},
+            ])
+        )
+        total_pedidos = pedidos.count_documents({})
+        envios_checkout = len(resultado["latencias"]["checkout"])
+
+        self.stdout.write("")
+        self.stdout.write(
+            f"Duración: {segundos:.2f} s · {total_pedidos} pedido(s) · "
+            f"{total_pedidos / segundos if segundos else 0:.1f} checkouts/s"
+        )
+        self.stdout.write(
+            f"Respuestas: agregar {resultados['agregar_ok']} ok / {resultados['agregar_rechazado']} rechazados · "
+            f"checkout {resultados['checkout_ok']} ok / {resultados['checkout_rechazado']} rechazados · "
+            f"errores {resultados['errores']}"
+        )
+        for fase, valores in resultado["latencias"].items():
+            self.stdout.write(
+                f"Latencia {fase:<8} p50 {_percentil(valores, 50) * 1000:7.1f} ms · "
+                f"p95 {_percentil(valores, 95) * 1000:7.1f} ms · "
+                f"p99 {_percentil(valores, 99) * 1000:7.1f} ms  ({len(valores)} peticiones)"
+            )
+        for fase, envios in (("agregar", len(resultado["latencias"]["agregar"])), ("checkout", envios_checkout)):
+            if envios:
+                self.stdout.write(
+                    f"Comandos Mongo por {fase}: {contador.por_fase[fase] / envios:.1f}"
+                )
+        detalle = ", ".join(
+            f"{comando} {cantidad / envios_checkout:.1f}"
+            for (fase, comando), cantidad in contador.por_comando.most_common()
+            if fase == "checkout" and envios_checkout
+        )
+        if detalle:
+            self.stdout.write(f"  checkout: {detalle}")
+
+        problemas = {
+            "Unidades sobrevendidas": sobreventa,
+            "Productos con stock negativo": negativos,
+            "Productos con stock descuadrado": descuadres,
+            "Pedidos duplicados": duplicados,
+        }
+        for nombre, valor in problemas.items():
+            estilo = self.style.ERROR if valor else self.style.SUCCESS
+            self.stdout.write(estilo(f"{nombre}: {valor}"))
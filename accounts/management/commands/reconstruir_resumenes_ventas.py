@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import PyMongoError
+
+from accounts import mongo_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Rehace desde cero los resúmenes de ventas (diarios, semanales, por "
+        "producto y por método) recorriendo Pedidos en lotes. "
+        "Mientras corre, los trabajos 'resumen_pedido' quedan en pausa."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lote",
+            type=int,
+            default=500,
+            help="Pedidos que se suman en memoria antes de cada escritura.",
+        )
+
+    def handle(self, *args, **options):
+        if options["lote"] < 1:
+            raise CommandError("--lote debe ser mayor que 0")
+
+        try:
+            total = mongo_service.reconstruir_resumenes_ventas(options["lote"])
+        except (PyMongoError, RuntimeError) as e:
+            raise CommandError(
+                f"No se pudieron reconstruir los resúmenes: {e}. "
+                "Los trabajos 'resumen_pedido' siguen en pausa hasta que termine bien."
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"{total} pedido(s) sumados a los resúmenes de ventas."))
@@ -1,10 +1,17 @@
 # accounts/mongo_service.py
 from django.conf import settings
-from pymongo import MongoClient, errors
+from django.core.cache import cache
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne, errors
 from pymongo.errors import PyMongoError
 from bson import ObjectId
 import bcrypt
-from datetime import datetime, timezone
+import re
+import secrets
+import time
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+
+from .registros import Carrito, Direccion, Inventario, ItemCarrito, Pedido, PedidoResumen, Producto
 
 _client = None
 _db = None
@@ -102,6 +109,12 @@ def get_pedidos_collection():
     db = get_db()
     return db["Pedidos"]
 
+def get_metadatos_collection():
+    """
+    Devuelve la colección Metadatos (contadores de versión, etc.).
+    """
+    db = get_db()
+    return db["Metadatos"]
 
 
 
@@ -233,34 +246,84 @@ def actualizar_password_por_correo(correo: str, nueva_password_plana: str) -> bo
     return result.modified_count > 0
 
 
-def _recalcular_totales_carrito(carrito: dict) -> dict:
+def _etapas_totales_carrito(ahora: datetime) -> list[dict]:
     """
-    Recalcula subtotalCarritoSnapshot, subtotalSeleccionadoSnapshot
-    y totalSeleccionadoSnapshot en el documento de carrito.
-    NO guarda en BD, solo modifica el dict en memoria.
+    Etapas finales de los updates con pipeline sobre un carrito.
+    Recalculan DENTRO de Mongo, en la misma operación atómica que cambió
+    itemsCarrito, el subtotal de cada línea y:
+      - subtotalCarritoSnapshot
+      - subtotalSeleccionadoSnapshot
+      - totalSeleccionadoSnapshot
+    Además suben versionCarrito y la fecha de actualización.
+    Así los totales siempre cuadran con los ítems, aunque haya
+    modificaciones concurrentes, y la app nunca reenvía el arreglo.
     """
-    subtotal_total = 0
-    subtotal_seleccionado = 0
-
-    for item in carrito.get("itemsCarrito", []):
-        subtotal_linea = item.get("subtotalLineaSnapshot", 0)
-        subtotal_total += subtotal_linea
-        if item.get("seleccionado", True):
-            subtotal_seleccionado += subtotal_linea
-
-    carrito["subtotalCarritoSnapshot"] = subtotal_total
-    carrito["subtotalSeleccionadoSnapshot"] = subtotal_seleccionado
-    # Por ahora el total es igual al subtotal seleccionado
-    carrito["totalSeleccionadoSnapshot"] = subtotal_seleccionado
+    return [
+        {"$set": {
+            "itemsCarrito": {"$map": {
+                "input": "$itemsCarrito",
+                "as": "it",
+                "in": {"$mergeObjects": ["$$it", {
+                    "subtotalLineaSnapshot": {
+                        "$multiply": ["$$it.cantidad", "$$it.precioUnitarioSnapshot"]
+                    },
+                }]},
+            }},
+        }},
+        {"$set": {
+            "subtotalCarritoSnapshot": {"$sum": "$itemsCarrito.subtotalLineaSnapshot"},
+            "subtotalSeleccionadoSnapshot": {"$reduce": {
+                "input": "$itemsCarrito",
+                "initialValue": 0,
+                "in": {"$add": ["$$value", {"$cond": [
+                    {"$ifNull": ["$$this.seleccionado", True]},
+                    "$$this.subtotalLineaSnapshot",
+                    0,
+                ]}]},
+            }},
+            "versionCarrito": {"$add": [{"$ifNull": ["$versionCarrito", 0]}, 1]},
+            "fechaActualizacionCarrito": ahora,
+        }},
+        # Por ahora el total es igual al subtotal seleccionado
+        {"$set": {"totalSeleccionadoSnapshot": "$subtotalSeleccionadoSnapshot"}},
+    ]
 
-    carrito["fechaActualizacionCarrito"] = datetime.now(timezone.utc)
-    return carrito
+def _modificar_item_carrito(id_producto: ObjectId, cambios: dict) -> dict:
+    """
+    Expresión $map que aplica 'cambios' (expresiones de agregación,
+    pueden usar $$it) solo al ítem de id_producto y deja igual el resto.
+    """
+    return {"$map": {
+        "input": "$itemsCarrito",
+        "as": "it",
+        "in": {"$cond": [
+            {"$eq": ["$$it.idProducto", id_producto]},
+            {"$mergeObjects": ["$$it", cambios]},
+            "$$it",
+        ]},
+    }}
+
+def _error_item_no_encontrado(id_usuario: ObjectId) -> ValueError:
+    """
+    Cuando una operación atómica sobre un ítem no encontró documento,
+    distingue si falta el carrito o solo el ítem (camino poco frecuente).
+    """
+    existe = get_carritos_collection().find_one(
+        {"idUsuarioCliente": id_usuario, "estadoCarrito": "abierto"},
+        {"_id": 1}
+    )
+    if not existe:
+        return ValueError("El usuario no tiene un carrito abierto")
+    return ValueError("El producto no está en el carrito")
 
 def obtener_o_crear_carrito_abierto(id_usuario_str: str) -> dict:
     """
     Obtiene el carrito 'abierto' de un usuario.
     Si no existe, crea uno nuevo vacío.
     Devuelve el documento de carrito (dict).
+    Es UN solo upsert ($setOnInsert solo aplica al crear), respaldado por
+    el índice único parcial de asegurar_indices(): dos peticiones
+    simultáneas nunca dejan dos carritos abiertos para el mismo usuario.
     """
     carritos = get_carritos_collection()
 
@@ -269,29 +332,59 @@ def obtener_o_crear_carrito_abierto(id_usuario_str: str) -> dict:
     except Exception:
         raise ValueError("id_usuario_str no es un ObjectId válido")
 
-    carrito = carritos.find_one({
+    filtro = {
         "idUsuarioCliente": id_usuario,
         "estadoCarrito": "abierto"
-    })
+    }
+    ahora = datetime.now(timezone.utc)
 
-    if carrito:
-        return carrito
+    # idUsuarioCliente y estadoCarrito los copia Mongo desde el filtro al insertar
+    try:
+        return carritos.find_one_and_update(
+            filtro,
+            {"$setOnInsert": {
+                "fechaCreacionCarrito": ahora,
+                "fechaActualizacionCarrito": ahora,
+                "itemsCarrito": [],
+                "subtotalCarritoSnapshot": 0,
+                "subtotalSeleccionadoSnapshot": 0,
+                "totalSeleccionadoSnapshot": 0,
+                "versionCarrito": 0,
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except errors.DuplicateKeyError:
+        # Otra petición lo creó en el mismo instante: el índice evitó el duplicado
+        return carritos.find_one(filtro)
 
-    # Crear uno nuevo
-    nuevo = {
-        "idUsuarioCliente": id_usuario,
-        "estadoCarrito": "abierto",
-        "fechaCreacionCarrito": datetime.now(timezone.utc),
-        "fechaActualizacionCarrito": datetime.now(timezone.utc),
-        "itemsCarrito": [],
-        "subtotalCarritoSnapshot": 0,
-        "subtotalSeleccionadoSnapshot": 0,
-        "totalSeleccionadoSnapshot": 0
+def _cantidades_en_carrito(id_usuario: ObjectId) -> dict:
+    """
+    {idProducto: cantidad} del carrito abierto del usuario (proyección mínima).
+    Lo usa el modo reservas para saber cuánto apartar o liberar.
+    """
+    carrito = get_carritos_collection().find_one(
+        {"idUsuarioCliente": id_usuario, "estadoCarrito": "abierto"},
+        {"itemsCarrito.idProducto": 1, "itemsCarrito.cantidad": 1},
+    )
+    if not carrito:
+        return {}
+    return {
+        item["idProducto"]: item.get("cantidad", 0)
+        for item in carrito.get("itemsCarrito", [])
     }
 
-    result = carritos.insert_one(nuevo)
-    nuevo["_id"] = result.inserted_id
-    return nuevo
+def _cantidad_item_carrito(id_producto: ObjectId) -> dict:
+    """Expresión: unidades de id_producto que ya hay en el carrito (0 si no está)."""
+    return {"$reduce": {
+        "input": {"$ifNull": ["$itemsCarrito", []]},
+        "initialValue": 0,
+        "in": {"$add": ["$$value", {"$cond": [
+            {"$eq": ["$$this.idProducto", id_producto]},
+            "$$this.cantidad",
+            0,
+        ]}]},
+    }}
 
 def agregar_o_actualizar_item_carrito(
     id_usuario_str: str,
@@ -302,7 +395,10 @@ def agregar_o_actualizar_item_carrito(
     Agrega un producto al carrito del usuario o actualiza su cantidad.
     - Verifica que el producto exista y esté 'activo'.
     - Verifica que haya stock suficiente (inventario.stockActual).
-    - Si el ítem ya existe en el carrito, suma la cantidad.
+    - Si el ítem ya existe en el carrito, suma la cantidad; si no, lo
+      agrega al final de itemsCarrito. El tope de stock va en el filtro.
+    - Ambos casos son UN update con pipeline que también recalcula los
+      totales (una lectura del producto + una escritura del carrito).
     - Siempre marca seleccionado=True cuando se agrega/actualiza.
     Devuelve el carrito actualizado.
     Lanza ValueError con mensajes claros si algo falla.
@@ -331,68 +427,80 @@ def agregar_o_actualizar_item_carrito(
     inventario = producto.get("inventario", {})
     stock_actual = inventario.get("stockActual", 0)
 
-    # 2. Obtener o crear carrito
-    carrito = obtener_o_crear_carrito_abierto(id_usuario_str)
-
-    # 3. Buscar si ya existe ítem para ese producto
-    items = carrito.get("itemsCarrito", [])
-    item_existente = None
-    for item in items:
-        if item.get("idProducto") == id_producto:
-            item_existente = item
-            break
-
-    # 4. Calcular nueva cantidad
-    if item_existente:
-        nueva_cantidad = item_existente["cantidad"] + cantidad
-    else:
-        nueva_cantidad = cantidad
-
-    if nueva_cantidad > stock_actual:
-        raise ValueError(
-            f"No hay stock suficiente. Stock disponible: {stock_actual}, "
-            f"cantidad solicitada total en carrito: {nueva_cantidad}"
-        )
-
     precio_unitario = inventario.get("precioVenta")
     if precio_unitario is None:
         raise ValueError("El producto no tiene precioVenta definido en inventario")
 
-    subtotal_linea = nueva_cantidad * precio_unitario
-
-    # 5. Actualizar/crear ítem
-    if item_existente:
-        item_existente["cantidad"] = nueva_cantidad
-        item_existente["precioUnitarioSnapshot"] = precio_unitario
-        item_existente["subtotalLineaSnapshot"] = subtotal_linea
-        item_existente["seleccionado"] = True
-    else:
-        nuevo_item = {
-            "_idItemCarrito": ObjectId(),
-            "idProducto": id_producto,
-            "nombreProducto": producto.get("nombreProducto", ""),
-            "cantidad": nueva_cantidad,
-            "precioUnitarioSnapshot": precio_unitario,
-            "subtotalLineaSnapshot": subtotal_linea,
-            "seleccionado": True
-        }
-        items.append(nuevo_item)
-        carrito["itemsCarrito"] = items
+    ahora = datetime.now(timezone.utc)
+    filtro_carrito = {"idUsuarioCliente": id_usuario, "estadoCarrito": "abierto"}
+
+    # Modo reservas: primero se apartan las unidades; si el carrito
+    # no llega a cambiar (falta stock, error) se devuelven.
+    ajustar_reservas(id_usuario, {id_producto: cantidad})
+
+    nuevo_item = {
+        "_idItemCarrito": ObjectId(),
+        "idProducto": id_producto,
+        "nombreProducto": producto.get("nombreProducto", ""),
+        "cantidad": cantidad,
+        "precioUnitarioSnapshot": precio_unitario,
+        "subtotalLineaSnapshot": cantidad * precio_unitario,
+        "seleccionado": True
+    }
+    # 2. Un solo update: suma al ítem si ya está o lo agrega al final, con
+    #    los totales recalculados en la misma operación. El tope de stock
+    #    va en el filtro ($expr sobre lo que ya hay en el carrito), así dos
+    #    "agregar" simultáneos nunca superan stock_actual entre los dos.
+    filtro_agregar = {
+        **filtro_carrito,
+        "$expr": {"$lte": [
+            {"$add": [_cantidad_item_carrito(id_producto), cantidad]},
+            stock_actual,
+        ]},
+    }
+    actualizacion = [
+        {"$set": {"itemsCarrito": {"$cond": [
+            {"$in": [id_producto, {"$ifNull": ["$itemsCarrito.idProducto", []]}]},
+            _modificar_item_carrito(id_producto, {
+                "cantidad": {"$add": ["$$it.cantidad", cantidad]},
+                "precioUnitarioSnapshot": precio_unitario,
+                "seleccionado": True,
+            }),
+            # $literal: el nombre del producto nunca se interpreta como expresión
+            {"$concatArrays": ["$itemsCarrito", {"$literal": [nuevo_item]}]},
+        ]}}},
+        *_etapas_totales_carrito(ahora),
+    ]
 
-    # 6. Recalcular totales
-    carrito = _recalcular_totales_carrito(carrito)
+    try:
+        carrito = carritos.find_one_and_update(
+            filtro_agregar, actualizacion, return_document=ReturnDocument.AFTER
+        )
 
-    # 7. Guardar en BD y devolver
-    carritos.update_one(
-        {"_id": carrito["_id"]},
-        {"$set": {
-            "itemsCarrito": carrito["itemsCarrito"],
-            "subtotalCarritoSnapshot": carrito["subtotalCarritoSnapshot"],
-            "subtotalSeleccionadoSnapshot": carrito["subtotalSeleccionadoSnapshot"],
-            "totalSeleccionadoSnapshot": carrito["totalSeleccionadoSnapshot"],
-            "fechaActualizacionCarrito": carrito["fechaActualizacionCarrito"],
-        }}
-    )
+        # Camino poco frecuente: no aplicó. O no hay carrito abierto
+        # (primer uso) o el total pedido supera el stock.
+        if carrito is None:
+            actual = carritos.find_one(
+                filtro_carrito,
+                {"itemsCarrito": {"$elemMatch": {"idProducto": id_producto}}},
+            )
+            if actual is None:
+                obtener_o_crear_carrito_abierto(id_usuario_str)
+                carrito = carritos.find_one_and_update(
+                    filtro_agregar, actualizacion, return_document=ReturnDocument.AFTER
+                )
+
+        # 3. Ninguna operación aplicó: el total pedido supera el stock
+        if carrito is None:
+            items = (actual or {}).get("itemsCarrito") or [{}]
+            en_carrito = items[0].get("cantidad", 0)
+            raise ValueError(
+                f"No hay stock suficiente. Stock disponible: {stock_actual}, "
+                f"cantidad solicitada total en carrito: {en_carrito + cantidad}"
+            )
+    except Exception:
+        ajustar_reservas(id_usuario, {id_producto: -cantidad})
+        raise
 
     return carrito
 
@@ -416,28 +524,32 @@ def actualizar_cantidad_item_carrito(
     except Exception:
         raise ValueError("id_usuario_str o id_producto_str no son ObjectId válidos")
 
-    carrito = carritos.find_one({
+    filtro = {
         "idUsuarioCliente": id_usuario,
-        "estadoCarrito": "abierto"
-    })
-
-    if not carrito:
-        raise ValueError("El usuario no tiene un carrito abierto")
-
-    items = carrito.get("itemsCarrito", [])
-    item_encontrado = None
-    for item in items:
-        if item.get("idProducto") == id_producto:
-            item_encontrado = item
-            break
+        "estadoCarrito": "abierto",
+        "itemsCarrito": {"$elemMatch": {"idProducto": id_producto}},
+    }
+    ahora = datetime.now(timezone.utc)
 
-    if not item_encontrado:
-        raise ValueError("El producto no está en el carrito")
+    # Modo reservas: cuántas unidades más (o menos) hay que apartar
+    delta = 0
+    if settings.RESERVAS_STOCK_ACTIVAS:
+        delta = nueva_cantidad - _cantidades_en_carrito(id_usuario).get(id_producto, 0)
 
     if nueva_cantidad == 0:
         # Eliminar ítem
-        items = [it for it in items if it.get("idProducto") != id_producto]
-        carrito["itemsCarrito"] = items
+        carrito = carritos.find_one_and_update(
+            filtro,
+            [
+                {"$set": {"itemsCarrito": {"$filter": {
+                    "input": "$itemsCarrito",
+                    "as": "it",
+                    "cond": {"$ne": ["$$it.idProducto", id_producto]},
+                }}}},
+                *_etapas_totales_carrito(ahora),
+            ],
+            return_document=ReturnDocument.AFTER,
+        )
     else:
         # Verificar stock
         producto = productos.find_one({"_id": id_producto})
@@ -456,23 +568,29 @@ def actualizar_cantidad_item_carrito(
         if precio_unitario is None:
             raise ValueError("El producto no tiene precioVenta definido en inventario")
 
-        item_encontrado["cantidad"] = nueva_cantidad
-        item_encontrado["precioUnitarioSnapshot"] = precio_unitario
-        item_encontrado["subtotalLineaSnapshot"] = nueva_cantidad * precio_unitario
-
-    carrito = _recalcular_totales_carrito(carrito)
+        ajustar_reservas(id_usuario, {id_producto: max(delta, 0)})
+        try:
+            carrito = carritos.find_one_and_update(
+                filtro,
+                [
+                    {"$set": {"itemsCarrito": _modificar_item_carrito(id_producto, {
+                        "cantidad": nueva_cantidad,
+                        "precioUnitarioSnapshot": precio_unitario,
+                    })}},
+                    *_etapas_totales_carrito(ahora),
+                ],
+                return_document=ReturnDocument.AFTER,
+            )
+        except Exception:
+            ajustar_reservas(id_usuario, {id_producto: -max(delta, 0)})
+            raise
 
-    carritos.update_one(
-        {"_id": carrito["_id"]},
-        {"$set": {
-            "itemsCarrito": carrito["itemsCarrito"],
-            "subtotalCarritoSnapshot": carrito["subtotalCarritoSnapshot"],
-            "subtotalSeleccionadoSnapshot": carrito["subtotalSeleccionadoSnapshot"],
-            "totalSeleccionadoSnapshot": carrito["totalSeleccionadoSnapshot"],
-            "fechaActualizacionCarrito": carrito["fechaActualizacionCarrito"],
-        }}
-    )
+    if carrito is None:
+        ajustar_reservas(id_usuario, {id_producto: -max(delta, 0)})
+        raise _error_item_no_encontrado(id_usuario)
 
+    # Bajó la cantidad (o se quitó): liberar lo que sobra de la reserva
+    ajustar_reservas(id_usuario, {id_producto: min(delta, 0)})
     return carrito
 
 def actualizar_seleccion_item_carrito(
@@ -492,210 +610,1515 @@ def actualizar_seleccion_item_carrito(
     except Exception:
         raise ValueError("id_usuario_str o id_producto_str no son ObjectId válidos")
 
-    carrito = carritos.find_one({
-        "idUsuarioCliente": id_usuario,
-        "estadoCarrito": "abierto"
-    })
+    carrito = carritos.find_one_and_update(
+        {
+            "idUsuarioCliente": id_usuario,
+            "estadoCarrito": "abierto",
+            "itemsCarrito": {"$elemMatch": {"idProducto": id_producto}},
+        },
+        [
+            {"$set": {"itemsCarrito": _modificar_item_carrito(id_producto, {
+                "seleccionado": bool(seleccionado),
+            })}},
+            *_etapas_totales_carrito(datetime.now(timezone.utc)),
+        ],
+        return_document=ReturnDocument.AFTER,
+    )
 
-    if not carrito:
-        raise ValueError("El usuario no tiene un carrito abierto")
+    if carrito is None:
+        raise _error_item_no_encontrado(id_usuario)
 
-    items = carrito.get("itemsCarrito", [])
-    item_encontrado = None
-    for item in items:
-        if item.get("idProducto") == id_producto:
-            item_encontrado = item
-            break
+    return carrito
 
-    if not item_encontrado:
-        raise ValueError("El producto no está en el carrito")
+MAX_CAMBIOS_LOTE_CARRITO = 100
 
-    item_encontrado["seleccionado"] = bool(seleccionado)
+def actualizar_items_carrito_lote(id_usuario_str: str, cambios: list[dict]) -> dict:
+    """
+    Aplica varios cambios al carrito en UNA sola operación.
+    'cambios' es una lista de {producto_id, cantidad?, seleccionado?}:
+      - cantidad == 0 → quita el ítem; > 0 → fija la cantidad (con stock).
+      - seleccionado → marca/desmarca el ítem.
+    - El stock y el precio de todos los productos se validan con UNA
+      consulta $in; si alguno falla no se aplica nada.
+    - Todos los productos deben estar en el carrito (lo exige el filtro).
+    - Un update con pipeline aplica los cambios y recalcula los totales.
+    Devuelve el carrito actualizado. Lanza ValueError si algo falla.
+    """
+    if not cambios:
+        raise ValueError("No se enviaron cambios para el carrito")
+    if len(cambios) > MAX_CAMBIOS_LOTE_CARRITO:
+        raise ValueError(f"Máximo {MAX_CAMBIOS_LOTE_CARRITO} cambios por solicitud")
 
-    carrito = _recalcular_totales_carrito(carrito)
+    try:
+        id_usuario = ObjectId(id_usuario_str)
+    except Exception:
+        raise ValueError("id_usuario_str no es un ObjectId válido")
 
-    carritos.update_one(
-        {"_id": carrito["_id"]},
-        {"$set": {
-            "itemsCarrito": carrito["itemsCarrito"],
-            "subtotalCarritoSnapshot": carrito["subtotalCarritoSnapshot"],
-            "subtotalSeleccionadoSnapshot": carrito["subtotalSeleccionadoSnapshot"],
-            "totalSeleccionadoSnapshot": carrito["totalSeleccionadoSnapshot"],
-            "fechaActualizacionCarrito": carrito["fechaActualizacionCarrito"],
-        }}
-    )
+    # 1. Normalizar: {ObjectId producto: campos a fijar}
+    por_producto = {}
+    for cambio in cambios:
+        try:
+            id_producto = ObjectId(str(cambio.get("producto_id", "")))
+        except Exception:
+            raise ValueError("producto_id no es un ObjectId válido")
+
+        campos = por_producto.setdefault(id_producto, {})
+        # Tipos JSON estrictos: ni "false" (sería True) ni true / 2.7 como cantidad
+        if cambio.get("cantidad") is not None:
+            cantidad = cambio["cantidad"]
+            if isinstance(cantidad, bool) or not isinstance(cantidad, int):
+                raise ValueError("La cantidad debe ser un número entero.")
+            if cantidad < 0:
+                raise ValueError("La cantidad no puede ser negativa.")
+            campos["cantidad"] = cantidad
+        if cambio.get("seleccionado") is not None:
+            if not isinstance(cambio["seleccionado"], bool):
+                raise ValueError("'seleccionado' debe ser true o false.")
+            campos["seleccionado"] = cambio["seleccionado"]
+
+    # 2. Validar stock y precio de todas las cantidades con una sola consulta
+    con_cantidad = [i for i, campos in por_producto.items() if campos.get("cantidad", 0) > 0]
+    if con_cantidad:
+        productos = {
+            p["_id"]: p
+            for p in get_productos_collection().find(
+                {"_id": {"$in": con_cantidad}},
+                {"nombreProducto": 1, **PROYECCION_INVENTARIO},
+            )
+        }
+        for id_producto in con_cantidad:
+            producto = productos.get(id_producto)
+            if not producto:
+                raise ValueError("El producto no existe")
+
+            inventario = producto.get("inventario", {})
+            stock_actual = inventario.get("stockActual", 0)
+            cantidad = por_producto[id_producto]["cantidad"]
+            if cantidad > stock_actual:
+                raise ValueError(
+                    f"No hay stock suficiente para '{producto.get('nombreProducto', '')}'. "
+                    f"Stock disponible: {stock_actual}, cantidad solicitada: {cantidad}"
+                )
+
+            precio_unitario = inventario.get("precioVenta")
+            if precio_unitario is None:
+                raise ValueError("El producto no tiene precioVenta definido en inventario")
+            por_producto[id_producto]["precioUnitarioSnapshot"] = precio_unitario
+
+    # 3. Un solo update: aplicar cambios, quitar cantidades 0 y recalcular totales
+    lista_cambios = [
+        {"idProducto": id_producto, "campos": campos}
+        for id_producto, campos in por_producto.items()
+    ]
+    items_cambiados = {"$map": {
+        "input": "$itemsCarrito",
+        "as": "it",
+        "in": {"$let": {
+            "vars": {"cambio": {"$filter": {
+                "input": {"$literal": lista_cambios},
+                "as": "c",
+                "cond": {"$eq": ["$$c.idProducto", "$$it.idProducto"]},
+            }}},
+            "in": {"$cond": [
+                {"$eq": [{"$size": "$$cambio"}, 0]},
+                "$$it",
+                {"$mergeObjects": ["$$it", {"$arrayElemAt": ["$$cambio.campos", 0]}]},
+            ]},
+        }},
+    }}
+
+    # Modo reservas: apartar los aumentos antes y liberar las bajas después
+    deltas = {}
+    if settings.RESERVAS_STOCK_ACTIVAS:
+        actuales = _cantidades_en_carrito(id_usuario)
+        deltas = {
+            id_producto: campos["cantidad"] - actuales.get(id_producto, 0)
+            for id_producto, campos in por_producto.items()
+            if "cantidad" in campos
+        }
+    aumentos = {id_producto: d for id_producto, d in deltas.items() if d > 0}
+    ajustar_reservas(id_usuario, aumentos)
+
+    try:
+        carrito = get_carritos_collection().find_one_and_update(
+            {
+                "idUsuarioCliente": id_usuario,
+                "estadoCarrito": "abierto",
+                "itemsCarrito.idProducto": {"$all": list(por_producto)},
+            },
+            [
+                {"$set": {"itemsCarrito": {"$filter": {
+                    "input": items_cambiados,
+                    "as": "it",
+                    "cond": {"$gt": ["$$it.cantidad", 0]},
+                }}}},
+                *_etapas_totales_carrito(datetime.now(timezone.utc)),
+            ],
+            return_document=ReturnDocument.AFTER,
+        )
+    except Exception:
+        ajustar_reservas(id_usuario, {id_producto: -d for id_producto, d in aumentos.items()})
+        raise
+
+    if carrito is None:
+        ajustar_reservas(id_usuario, {id_producto: -d for id_producto, d in aumentos.items()})
+        raise _error_item_no_encontrado(id_usuario)
 
+    ajustar_reservas(id_usuario, {id_producto: d for id_producto, d in deltas.items() if d < 0})
     return carrito
 
-def crear_pedido_desde_carrito(
-    id_usuario_str: str,
-    metodo_entrega: str,
-    metodo_pago: str,
-    costo_envio: float = 0.0
-) -> dict:
+def validar_producto_para_carrito(id_producto_str: str, cantidad_total: int) -> dict:
     """
-    Crea un Pedido a partir del carrito ABIERTO del usuario.
-    - Usa SOLO los items seleccionados (seleccionado=True).
-    - Relee productos para usar precioActual (inventario.precioVenta).
-    - Verifica stock antes de descontar.
-    - Actualiza inventario de Productos.
-    - Marca el carrito como 'convertido'.
-
-    Devuelve el documento de Pedido creado.
-    Lanza ValueError si:
-      - No hay carrito.
-      - No hay items seleccionados.
-      - Falta stock o producto inactivo.
+    Valida, sin tocar ningún carrito, que se puedan tener 'cantidad_total'
+    unidades del producto (existe, está activo, tiene precio y stock).
+    Se usa para el carrito de invitados (cookie). Devuelve el producto
+    (proyección: nombre + inventario). Lanza ValueError si algo falla.
     """
-    from bson import ObjectId
-    from datetime import datetime, timezone
-
-    productos_col = get_productos_collection()
-    carritos_col = get_carritos_collection()
-    pedidos_col = get_pedidos_collection()
+    if cantidad_total <= 0:
+        raise ValueError("La cantidad debe ser mayor a 0")
 
     try:
-        id_usuario = ObjectId(id_usuario_str)
+        id_producto = ObjectId(id_producto_str)
     except Exception:
-        raise ValueError("id_usuario_str no es un ObjectId válido")
+        raise ValueError("id_producto_str no es un ObjectId válido")
 
-    # 1. Obtener carrito ABIERTO
-    carrito = carritos_col.find_one({
-        "idUsuarioCliente": id_usuario,
-        "estadoCarrito": "abierto"
-    })
+    producto = get_productos_collection().find_one(
+        {"_id": id_producto},
+        {"nombreProducto": 1, "estadoProducto": 1, **PROYECCION_INVENTARIO},
+    )
+    if not producto:
+        raise ValueError("El producto no existe")
 
-    if not carrito:
-        raise ValueError("El usuario no tiene un carrito abierto")
+    if producto.get("estadoProducto") != "activo":
+        raise ValueError("El producto no está activo en el catálogo")
 
-    items_carrito = carrito.get("itemsCarrito", [])
+    inventario = producto.get("inventario", {})
+    if inventario.get("precioVenta") is None:
+        raise ValueError("El producto no tiene precioVenta definido en inventario")
 
-    # 2. Filtrar SOLO items seleccionados y con cantidad > 0
-    items_seleccionados = [
-        item for item in items_carrito
-        if item.get("seleccionado", True) and item.get("cantidad", 0) > 0
-    ]
+    stock_actual = inventario.get("stockActual", 0)
+    if cantidad_total > stock_actual:
+        raise ValueError(
+            f"No hay stock suficiente. Stock disponible: {stock_actual}, "
+            f"cantidad solicitada total en carrito: {cantidad_total}"
+        )
+    return producto
 
-    if not items_seleccionados:
-        raise ValueError("No hay productos seleccionados para crear el pedido.")
+def _productos_para_carrito(ids_producto_str) -> dict:
+    """
+    Lee en UNA consulta $in los productos activos indicados (ids en string;
+    los inválidos se ignoran), con nombre e inventario.
+    Devuelve {ObjectId: producto}.
+    """
+    ids = []
+    for id_str in ids_producto_str:
+        try:
+            ids.append(ObjectId(id_str))
+        except Exception:
+            continue
 
-    # 3. Validar productos, stock y armar itemsPedido
-    items_pedido = []
-    subtotal_pedido = 0.0
-    productos_a_actualizar_stock = []  # (idProducto, cantidad)
+    if not ids:
+        return {}
 
-    for item in items_seleccionados:
-        id_producto = item.get("idProducto")
-        cantidad = item.get("cantidad", 0)
+    cursor = get_productos_collection().find(
+        {"_id": {"$in": ids}, "estadoProducto": "activo"},
+        {"nombreProducto": 1, **PROYECCION_INVENTARIO},
+    )
+    return {producto["_id"]: producto for producto in cursor}
 
-        if not id_producto or cantidad <= 0:
-            continue
+def construir_carrito_invitado(items_invitado: dict) -> Carrito:
+    """
+    Arma un registro Carrito (no se guarda) con el carrito de la cookie
+    de invitado, a precio actual, para pintarlo con carrito.html.
+    Una sola consulta a Productos; los que ya no están activos se omiten.
+    """
+    productos = _productos_para_carrito(items_invitado)
 
-        producto = productos_col.find_one({"_id": id_producto})
+    items = []
+    for id_str, cantidad in items_invitado.items():
+        producto = productos.get(ObjectId(id_str))
         if not producto:
-            raise ValueError("Uno de los productos del carrito ya no existe.")
+            continue
+        precio = producto.get("inventario", {}).get("precioVenta") or 0
+        items.append(ItemCarrito(
+            producto["_id"],
+            producto.get("nombreProducto", ""),
+            cantidad,
+            precio,
+            cantidad * precio,
+            True,
+        ))
+
+    total = sum(item.subtotalLineaSnapshot for item in items)
+    return Carrito(None, None, "abierto", items, total, total, total)
+
+def fusionar_carrito_invitado(id_usuario_str: str, items_invitado: dict) -> dict | None:
+    """
+    Fusiona el carrito de invitado (cookie) en el carrito abierto del
+    usuario al iniciar sesión, re-validando stock y precio:
+    - Una consulta $in a Productos (solo activos, con precio y stock).
+    - UN update con pipeline (upsert: crea el carrito si no existía):
+        * ítems que ya estaban: suma las cantidades con tope en el stock
+          ($min) y actualiza el precio snapshot;
+        * ítems nuevos: se agregan al final;
+        * totales recalculados en la misma operación.
+    Devuelve el carrito resultante, o None si nada de la cookie era válido.
+    """
+    try:
+        id_usuario = ObjectId(id_usuario_str)
+    except Exception:
+        raise ValueError("id_usuario_str no es un ObjectId válido")
 
-        if producto.get("estadoProducto") != "activo":
-            raise ValueError(
-                f"El producto '{producto.get('nombreProducto', '')}' ya no está activo."
-            )
+    productos = _productos_para_carrito(items_invitado)
+
+    topes = []   # lo que se suma a los ítems existentes
+    nuevos = []  # ítems completos por si el producto no estaba en el carrito
+    for id_str, cantidad in items_invitado.items():
+        producto = productos.get(ObjectId(id_str))
+        if not producto:
+            continue
 
         inventario = producto.get("inventario", {})
         stock_actual = inventario.get("stockActual", 0)
-        precio_actual = inventario.get("precioVenta")
-
-        if precio_actual is None:
-            raise ValueError(
-                f"El producto '{producto.get('nombreProducto', '')}' no tiene precio definido."
-            )
-
-        if cantidad > stock_actual:
-            raise ValueError(
-                f"No hay stock suficiente para '{producto.get('nombreProducto', '')}'. "
-                f"Disponible: {stock_actual}, solicitado: {cantidad}."
-            )
-
-        subtotal_linea = float(cantidad * precio_actual)
-        subtotal_pedido += subtotal_linea
+        precio_unitario = inventario.get("precioVenta")
+        if precio_unitario is None or stock_actual <= 0:
+            continue
 
-        items_pedido.append({
-            "idProducto": id_producto,
+        topes.append({
+            "idProducto": producto["_id"],
+            "cantidad": cantidad,
+            "stock": stock_actual,
+            "precio": precio_unitario,
+        })
+        nuevos.append({
+            "_idItemCarrito": ObjectId(),
+            "idProducto": producto["_id"],
             "nombreProducto": producto.get("nombreProducto", ""),
-            "cantidad": int(cantidad),
-            "precioUnitario": float(precio_actual),
-            "subtotalLinea": subtotal_linea
+            "cantidad": min(cantidad, stock_actual),
+            "precioUnitarioSnapshot": precio_unitario,
+            "subtotalLineaSnapshot": 0,  # lo calcula _etapas_totales_carrito
+            "seleccionado": True,
         })
 
-        productos_a_actualizar_stock.append((id_producto, cantidad))
+    if not nuevos:
+        return None
 
-    # 4. Calcular totales
-    subtotal_pedido = float(subtotal_pedido)
-    costo_envio = float(costo_envio)
-    total_pedido = subtotal_pedido + costo_envio
+    ahora = datetime.now(timezone.utc)
+    fusion = {"$let": {
+        "vars": {"actuales": {"$ifNull": ["$itemsCarrito", []]}},
+        "in": {"$concatArrays": [
+            {"$map": {
+                "input": "$$actuales",
+                "as": "it",
+                "in": {"$let": {
+                    "vars": {"tope": {"$filter": {
+                        "input": {"$literal": topes},
+                        "as": "t",
+                        "cond": {"$eq": ["$$t.idProducto", "$$it.idProducto"]},
+                    }}},
+                    "in": {"$cond": [
+                        {"$eq": [{"$size": "$$tope"}, 0]},
+                        "$$it",
+                        {"$mergeObjects": ["$$it", {
+                            "cantidad": {"$min": [
+                                {"$add": ["$$it.cantidad", {"$arrayElemAt": ["$$tope.cantidad", 0]}]},
+                                {"$arrayElemAt": ["$$tope.stock", 0]},
+                            ]},
+                            "precioUnitarioSnapshot": {"$arrayElemAt": ["$$tope.precio", 0]},
+                            "seleccionado": True,
+                        }]},
+                    ]},
+                }},
+            }},
+            {"$filter": {
+                "input": {"$literal": nuevos},
+                "as": "n",
+                "cond": {"$not": [{"$in": ["$$n.idProducto", "$$actuales.idProducto"]}]},
+            }},
+        ]},
+    }}
+    pipeline = [
+        {"$set": {
+            "itemsCarrito": fusion,
+            "fechaCreacionCarrito": {"$ifNull": ["$fechaCreacionCarrito", ahora]},
+        }},
+        *_etapas_totales_carrito(ahora),
+    ]
+    filtro = {"idUsuarioCliente": id_usuario, "estadoCarrito": "abierto"}
+    antes = _cantidades_en_carrito(id_usuario) if settings.RESERVAS_STOCK_ACTIVAS else {}
 
-        # 4.5. Obtener la dirección principal del usuario
-    direcciones_col = get_direcciones_envio_collection()
-    dir_principal = direcciones_col.find_one({
-        "idUsuario": id_usuario,
-        "activo": True,
-        "esPrincipal": True,
-    })
+    carritos = get_carritos_collection()
+    try:
+        carrito = carritos.find_one_and_update(
+            filtro, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except errors.DuplicateKeyError:
+        # El carrito se creó en paralelo: ahora el update sí lo encuentra
+        carrito = carritos.find_one_and_update(
+            filtro, pipeline, return_document=ReturnDocument.AFTER
+        )
 
-    if not dir_principal:
-        # No dejamos crear pedido si no hay dirección principal
-        raise ValueError("Debes tener al menos una dirección de envío principal para finalizar la compra.")
+    # Modo reservas: apartar lo que sumó la fusión. Si ya no alcanza queda
+    # sin reservar (el checkout igual exige stock disponible).
+    if settings.RESERVAS_STOCK_ACTIVAS and carrito:
+        for item in carrito.get("itemsCarrito", []):
+            delta = item.get("cantidad", 0) - antes.get(item["idProducto"], 0)
+            if delta > 0:
+                try:
+                    ajustar_reservas(id_usuario, {item["idProducto"]: delta})
+                except ValueError:
+                    pass
 
-    # Snapshot de la dirección al momento del pedido
-    direccion_snapshot = {
-        "idDireccionEnvio": dir_principal["_id"],
-        "nombreContacto": dir_principal.get("nombreContacto", ""),
-        "telefonoContacto": dir_principal.get("telefonoContacto", ""),
-        "ciudad": dir_principal.get("ciudad", ""),
-        "barrio": dir_principal.get("barrio", ""),
-        "complemento": dir_principal.get("complemento", ""),
-    }
+    return carrito
 
-    # 5. Construir documento Pedido (siguiendo tu $jsonSchema)
-    ahora = datetime.now(timezone.utc)
+def construir_vista_carrito(carrito: Carrito) -> dict:
+    """
+    Arma las líneas del carrito listas para el template, con el precio y
+    stock actuales de cada producto, en un número FIJO de consultas:
+    el inventario de todos los productos se pide junto (obtener_inventarios:
+    caché + un solo $in con proyección para lo que falte), nunca uno por línea.
+
+    Devuelve:
+      {
+        "items": [ {idProducto, nombreProducto, cantidad, precio_snapshot,
+                    subtotal_snapshot, seleccionado, precio_actual,
+                    precio_cambio, stock_actual, stock_minimo, stock_bajo}, ... ],
+        "hay_precio_cambiado": bool,          # en items seleccionados
+        "hay_stock_bajo_seleccionado": bool,
+      }
+    """
+    inventarios = obtener_inventarios(item.idProducto for item in carrito.itemsCarrito)
+
+    items_ui = []
+    for item in carrito.itemsCarrito:
+        precio_actual = None
+        precio_cambio = False
+        stock_actual = None
+        stock_minimo = None
+        stock_bajo = False
+
+        inventario = inventarios.get(item.idProducto)
+        if inventario is not None:
+            precio_actual = inventario.get("precioVenta")
+            stock_actual = inventario.get("stockActual")
+            stock_minimo = inventario.get("stockMinimo")
+
+            if stock_actual is not None and stock_minimo is not None:
+                stock_bajo = stock_actual <= stock_minimo
+
+        precio_snapshot = item.precioUnitarioSnapshot
+
+        if precio_actual is not None and precio_snapshot is not None:
+            precio_cambio = (precio_actual != precio_snapshot)
+
+        items_ui.append({
+            "idProducto": item.idProductoTexto,
+            "nombreProducto": item.nombreProducto,
+            "cantidad": item.cantidad,
+            "precio_snapshot": precio_snapshot,
+            "subtotal_snapshot": item.subtotalLineaSnapshot,
+            "seleccionado": item.seleccionado,
+            "precio_actual": precio_actual,
+            "precio_cambio": precio_cambio,
+            "stock_actual": stock_actual,
+            "stock_minimo": stock_minimo,
+            "stock_bajo": stock_bajo,
+        })
 
-    pedido_doc = {
-        "idUsuarioCliente": id_usuario,
-        "itemsPedido": items_pedido,
-        "fechaCreacionPedido": ahora,
-        "estadoPedido": "pendiente",  # luego lo cambiarás a 'pagado', etc.
-        "subtotalPedido": subtotal_pedido,
-        "costoEnvioPedido": costo_envio,
-        "totalPedido": total_pedido,
-        "metodoEntrega": metodo_entrega,  # 'domicilio' | 'contraEntrega'
-        "metodoPago": metodo_pago,       # 'efectivo', 'tarjetaCredito', etc.
-        # 👇 NUEVO
-        "idDireccionEnvio": direccion_snapshot["idDireccionEnvio"],
-        "direccionEnvioSnapshot": direccion_snapshot,
+    return {
+        "items": items_ui,
+        "hay_precio_cambiado": any(
+            it["seleccionado"] and it["precio_cambio"] for it in items_ui
+        ),
+        "hay_stock_bajo_seleccionado": any(
+            it["seleccionado"] and it["stock_bajo"] for it in items_ui
+        ),
     }
 
-    # 6. Insertar Pedido
-    result = pedidos_col.insert_one(pedido_doc)
-    pedido_doc["_id"] = result.inserted_id
+def resumen_carrito(carrito: dict | None) -> dict:
+    """
+    Resumen compacto del carrito para el contador del encabezado:
+    {idCarrito, lineas, unidades, total, version}.
+    Se arma con el documento que ya devolvió la mutación (sin consultar
+    Mongo) y las vistas lo guardan en la sesión ('carrito_resumen').
+    Sin carrito (o después del checkout) devuelve el resumen vacío.
+    """
+    if not carrito:
+        return {"idCarrito": None, "lineas": 0, "unidades": 0, "total": 0, "version": 0}
 
-    # 7. Actualizar stock de productos
-    for id_producto, cantidad in productos_a_actualizar_stock:
-        productos_col.update_one(
-            {"_id": id_producto},
-            {"$inc": {"inventario.stockActual": -int(cantidad)}}
+    items = carrito.get("itemsCarrito", [])
+    return {
+        "idCarrito": str(carrito["_id"]),
+        "lineas": len(items),
+        "unidades": sum(item.get("cantidad", 0) for item in items),
+        "total": carrito.get("totalSeleccionadoSnapshot", 0),
+        "version": carrito.get("versionCarrito", 0),
+    }
+
+def obtener_resumen_carrito(id_usuario_str: str) -> dict:
+    """
+    Lee el carrito abierto del usuario con una proyección mínima y devuelve
+    su resumen. Solo para inicializar la sesión (login); después el resumen
+    lo refrescan las mutaciones del carrito y el checkout.
+    """
+    try:
+        id_usuario = ObjectId(id_usuario_str)
+    except Exception:
+        return resumen_carrito(None)
+
+    carrito = get_carritos_collection().find_one(
+        {"idUsuarioCliente": id_usuario, "estadoCarrito": "abierto"},
+        {"itemsCarrito.cantidad": 1, "totalSeleccionadoSnapshot": 1, "versionCarrito": 1},
+    )
+    return resumen_carrito(carrito)
+
+# ─────────────────────────────────────────────
+#  CHECKOUT: escrituras atómicas
+# ─────────────────────────────────────────────
+# El stock se descuenta con filtros condicionados, así dos checkouts
+# simultáneos no pueden dejarlo negativo. En replica set (Atlas, o un
+# mongod local con --replSet rs0 + rs.initiate() y
+# MONGO_URI_LOCAL=mongodb://localhost:27017/?replicaSet=rs0) stock,
+# Pedido y carrito se escriben en una sola transacción.
+
+class ErroresValidacionPedido(ValueError):
+    """
+    Todos los problemas del carrito encontrados al validar el checkout.
+    'errores' trae un mensaje por línea; str() los une.
+    """
+
+    def __init__(self, errores: list[str]):
+        self.errores = errores
+        super().__init__(" ".join(errores))
+
+# Lo único que el checkout necesita releer de cada producto
+PROYECCION_VALIDACION_PEDIDO = {
+    "nombreProducto": 1,
+    "estadoProducto": 1,
+    "inventario.stockActual": 1,
+    "inventario.precioVenta": 1,
+}
+
+def _soporta_transacciones() -> bool:
+    """
+    True si el servidor admite transacciones multi-documento
+    (replica set o clúster). Un mongod suelto no las admite.
+    """
+    get_db()
+    try:
+        tipo = _client.topology_description.topology_type_name
+    except AttributeError:
+        return False
+    return tipo in ("ReplicaSetWithPrimary", "Sharded", "LoadBalanced")
+
+def _error_stock_checkout() -> ValueError:
+    return ValueError(
+        "No hay stock suficiente para uno de los productos seleccionados. "
+        "Revisa tu carrito e intenta de nuevo."
+    )
+
+def _descontar_stock_checkout(id_usuario: ObjectId, lineas: list, session, id_pedido: ObjectId) -> None:
+    """
+    Dentro de la transacción: descuenta el stock de [(idProducto, cantidad)]
+    con un solo bulk_write condicionado. Si alguna línea no coincide lanza
+    ValueError y la transacción se aborta entera.
+    Con reservas activas, las del usuario se consumen en el mismo bulk_write
+    (y las de ítems no comprados se liberan).
+    Los movimientos de inventario se registran en la misma transacción.
+    """
+    reservas = {}
+    if settings.RESERVAS_STOCK_ACTIVAS:
+        reservas_col = get_reservas_stock_collection()
+        reservas = {
+            r["idProducto"]: r.get("cantidad", 0)
+            for r in reservas_col.find({"idUsuarioCliente": id_usuario}, session=session)
+        }
+        reservas_col.delete_many({"idUsuarioCliente": id_usuario}, session=session)
+
+    operaciones = []
+    movimientos = []
+    for id_producto, cantidad in lineas:
+        reservadas = reservas.pop(id_producto, 0)
+        faltan = cantidad - min(reservadas, cantidad)
+        if not settings.RESERVAS_STOCK_ACTIVAS:
+            filtro = {"_id": id_producto, "inventario.stockActual": {"$gte": cantidad}}
+        elif faltan:
+            filtro = _filtro_stock_disponible(id_producto, faltan)
+        else:
+            filtro = {"_id": id_producto}
+        cambios = {"inventario.stockActual": -cantidad}
+        if reservadas:
+            cambios["inventario.reservado"] = -reservadas
+        operaciones.append(UpdateOne(filtro, _pipeline_inc_inventario(cambios)))
+        movimientos += [
+            _movimiento(id_producto, "venta", -cantidad, idPedido=id_pedido),
+            _movimiento(id_producto, "venta", -reservadas, "reservado", idPedido=id_pedido),
+        ]
+
+    productos_col = get_productos_collection()
+    res = productos_col.bulk_write(operaciones, ordered=True, session=session)
+    if res.matched_count != len(operaciones):
+        raise _error_stock_checkout()
+
+    liberar = [
+        UpdateOne({"_id": id_producto}, {"$inc": {"inventario.reservado": -cantidad}})
+        for id_producto, cantidad in reservas.items() if cantidad
+    ]
+    if liberar:
+        productos_col.bulk_write(liberar, ordered=False, session=session)
+    movimientos += [
+        _movimiento(id_producto, "reserva", -cantidad, "reservado", idUsuarioCliente=id_usuario)
+        for id_producto, cantidad in reservas.items()
+    ]
+    _registrar_movimientos(movimientos, session)
+
+def _descontar_stock_por_linea(id_usuario: ObjectId, lineas: list, id_pedido: ObjectId) -> tuple[list, list]:
+    """
+    Sin transacciones: descuenta línea por línea con el mismo filtro
+    condicionado. Si una no alcanza, devuelve lo ya descontado (stock y
+    reservas) y lanza ValueError.
+    Devuelve (líneas descontadas, reservas consumidas) para poder
+    compensar si el resto del checkout falla.
+    """
+    productos_col = get_productos_collection()
+    descontados = []
+    reservas = []
+    for id_producto, cantidad in lineas:
+        if settings.RESERVAS_STOCK_ACTIVAS:
+            ok, reserva = _convertir_reserva_en_venta(id_usuario, id_producto, cantidad, id_pedido)
+            if reserva:
+                reservas.append(reserva)
+        else:
+            ok = productos_col.update_one(
+                {"_id": id_producto, "inventario.stockActual": {"$gte": cantidad}},
+                _pipeline_inc_inventario({"inventario.stockActual": -cantidad}),
+            ).modified_count == 1
+            if ok:
+                _registrar_movimientos([_movimiento(id_producto, "venta", -cantidad, idPedido=id_pedido)])
+        if not ok:
+            _devolver_stock(descontados, id_pedido)
+            _restituir_reservas(reservas, id_pedido)
+            raise _error_stock_checkout()
+        descontados.append((id_producto, cantidad))
+    return descontados, reservas
+
+def _devolver_stock(lineas: list, id_pedido: ObjectId) -> None:
+    """
+    Compensación: vuelve a sumar el stock de [(idProducto, cantidad)].
+    El libro de movimientos no se borra: queda un 'ajuste' en sentido contrario.
+    """
+    if not lineas:
+        return
+    get_productos_collection().bulk_write([
+        UpdateOne({"_id": id_producto}, _pipeline_inc_inventario({"inventario.stockActual": cantidad}))
+        for id_producto, cantidad in lineas
+    ], ordered=False)
+    _registrar_movimientos([
+        _movimiento(id_producto, "ajuste", cantidad, idPedido=id_pedido)
+        for id_producto, cantidad in lineas
+    ])
+    invalidar_inventario(id_producto for id_producto, _ in lineas)
+
+def _restituir_reservas(reservas: list[dict], id_pedido: ObjectId) -> None:
+    """
+    Compensación: devuelve al cliente las reservas que consumió un checkout
+    fallido (documento en ReservasStock + inventario.reservado), con su
+    vencimiento original.
+    """
+    if not reservas:
+        return
+    get_productos_collection().bulk_write([
+        UpdateOne(
+            {"_id": reserva["idProducto"]},
+            _pipeline_inc_inventario({"inventario.reservado": reserva["cantidad"]}),
+        )
+        for reserva in reservas
+    ], ordered=False)
+    get_reservas_stock_collection().bulk_write([
+        UpdateOne(
+            {"_id": reserva["_id"]},
+            {"$inc": {"cantidad": reserva["cantidad"]}, "$set": {
+                "idUsuarioCliente": reserva["idUsuarioCliente"],
+                "idProducto": reserva["idProducto"],
+                "expira": reserva.get("expira"),
+            }},
+            upsert=True,
+        )
+        for reserva in reservas
+    ], ordered=False)
+    _registrar_movimientos([
+        _movimiento(reserva["idProducto"], "ajuste", reserva["cantidad"], "reservado", idPedido=id_pedido)
+        for reserva in reservas
+    ])
+    invalidar_inventario(reserva["idProducto"] for reserva in reservas)
+
+def _completar_clave_idempotencia(id_clave: str | None, id_pedido: ObjectId, session=None) -> None:
+    """Asocia el pedido creado a su clave de idempotencia (si hay)."""
+    if id_clave:
+        get_claves_idempotencia_collection().update_one(
+            {"_id": id_clave},
+            {"$set": {"estado": "completada", "idPedido": id_pedido}},
+            session=session,
         )
 
-    # 8. Marcar carrito como 'convertido'
-    carritos_col.update_one(
-        {"_id": carrito["_id"]},
+def _marcar_carrito_convertido(carrito: dict, ahora: datetime, session=None) -> None:
+    """
+    Pasa el carrito a 'convertido' solo si sigue abierto y en la misma
+    versión que se leyó: un doble envío o un cambio simultáneo falla aquí.
+    """
+    res = get_carritos_collection().update_one(
         {
-            "$set": {
-                "estadoCarrito": "convertido",
-                "fechaActualizacionCarrito": ahora
-            }
-        }
+            "_id": carrito["_id"],
+            "estadoCarrito": "abierto",
+            "versionCarrito": carrito.get("versionCarrito"),
+        },
+        {"$set": {"estadoCarrito": "convertido", "fechaActualizacionCarrito": ahora}},
+        session=session,
+    )
+    if res.matched_count == 0:
+        raise ValueError(
+            "Tu carrito cambió mientras finalizabas la compra. Revísalo e intenta de nuevo."
+        )
+
+# ─────────────────────────────────────────────
+#  IDEMPOTENCIA DEL CHECKOUT
+# ─────────────────────────────────────────────
+# El formulario del carrito lleva una clave de un solo uso (o llega en el
+# header Idempotency-Key). ClavesIdempotencia guarda una por usuario:
+#   {_id: "<usuario>:<clave>", estado: 'en_proceso'|'completada',
+#    idPedido, fechaCreacion, expiraProceso}
+# El _id hace de índice único; el índice TTL las borra tras
+# IDEMPOTENCIA_CHECKOUT_HORAS. Un reenvío con la misma clave devuelve el
+# pedido ya creado en vez de repetir el checkout.
+# 'en_proceso' es un alquiler hasta expiraProceso: si el proceso murió sin
+# soltar la clave, un reenvío posterior la retoma. Si el primero en realidad
+# seguía vivo, el guardado de versionCarrito impide el pedido doble.
+
+_FORMATO_CLAVE_IDEMPOTENCIA = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+def get_claves_idempotencia_collection():
+    """
+    Devuelve la colección ClavesIdempotencia.
+    """
+    db = get_db()
+    return db["ClavesIdempotencia"]
+
+def nueva_clave_idempotencia() -> str:
+    """Clave aleatoria para pintar en el formulario de checkout."""
+    return secrets.token_urlsafe(24)
+
+def _reclamar_clave_idempotencia(id_clave: str, id_usuario: ObjectId, expira_proceso: datetime) -> dict | None:
+    """
+    Registra la clave como 'en_proceso' hasta 'expira_proceso'. Devuelve
+    None si es nueva (o si retomó una cuyo alquiler venció), o el
+    documento que ya existía si es un reenvío.
+    """
+    col = get_claves_idempotencia_collection()
+    ahora = datetime.now(timezone.utc)
+    try:
+        col.insert_one({
+            "_id": id_clave,
+            "idUsuarioCliente": id_usuario,
+            "estado": "en_proceso",
+            "fechaCreacion": ahora,
+            "expiraProceso": expira_proceso,
+        })
+        return None
+    except errors.DuplicateKeyError:
+        pass
+
+    retomada = col.find_one_and_update(
+        {"_id": id_clave, "estado": "en_proceso", "expiraProceso": {"$lte": ahora}},
+        {"$set": {"expiraProceso": expira_proceso}},
+    )
+    if retomada is not None:
+        return None
+    # Si justo caducó, se trata como si siguiera en proceso
+    return col.find_one({"_id": id_clave}) or {"estado": "en_proceso"}
+
+def crear_pedido_desde_carrito(
+    id_usuario_str: str,
+    metodo_entrega: str,
+    metodo_pago: str,
+    costo_envio: float = 0.0,
+    clave_idempotencia: str | None = None,
+) -> dict:
+    """
+    Igual que _crear_pedido_desde_carrito, pero si llega 'clave_idempotencia'
+    un reenvío con la misma clave devuelve el pedido ya creado.
+    Lanza ValueError si la clave no es válida o si el primer envío todavía
+    se está procesando. Si el checkout falla la clave se suelta, para que
+    el usuario pueda reintentar tras corregir el carrito.
+    """
+    if not clave_idempotencia:
+        return _crear_pedido_desde_carrito(id_usuario_str, metodo_entrega, metodo_pago, costo_envio)
+
+    if not _FORMATO_CLAVE_IDEMPOTENCIA.match(clave_idempotencia):
+        raise ValueError("La solicitud de compra no es válida. Recarga el carrito e intenta de nuevo.")
+    try:
+        id_usuario = ObjectId(id_usuario_str)
+    except Exception:
+        raise ValueError("id_usuario_str no es un ObjectId válido")
+
+    id_clave = f"{id_usuario}:{clave_idempotencia}"
+    expira_proceso = datetime.now(timezone.utc) + timedelta(seconds=settings.IDEMPOTENCIA_PROCESO_SEGUNDOS)
+    previa = _reclamar_clave_idempotencia(id_clave, id_usuario, expira_proceso)
+    if previa is not None:
+        if previa.get("estado") == "completada":
+            pedido = get_pedidos_collection().find_one({"_id": previa["idPedido"]})
+            if pedido:
+                return pedido
+        raise ValueError(
+            "Tu pedido ya se está procesando. Revisa 'Mis pedidos' en unos segundos."
+        )
+
+    try:
+        return _crear_pedido_desde_carrito(
+            id_usuario_str, metodo_entrega, metodo_pago, costo_envio, id_clave
+        )
+    except Exception:
+        # Solo si sigue siendo nuestra: otro reenvío pudo retomarla
+        get_claves_idempotencia_collection().delete_one(
+            {"_id": id_clave, "estado": "en_proceso", "expiraProceso": expira_proceso}
+        )
+        raise
+
+def _crear_pedido_desde_carrito(
+    id_usuario_str: str,
+    metodo_entrega: str,
+    metodo_pago: str,
+    costo_envio: float = 0.0,
+    id_clave_idempotencia: str | None = None,
+) -> dict:
+    """
+    Crea un Pedido a partir del carrito ABIERTO del usuario.
+    - Usa SOLO los items seleccionados (seleccionado=True).
+    - Relee productos para usar precioActual (inventario.precioVenta).
+    - Descuenta stock con filtros condicionados (stockActual >= cantidad).
+    - Inserta el Pedido y marca el carrito como 'convertido'.
+    Los tres pasos de escritura van en una transacción si el servidor la
+    admite (ver _soporta_transacciones); si no, se compensan a mano.
+
+    Devuelve el documento de Pedido creado.
+    Lanza ValueError si:
+      - No hay carrito.
+      - No hay items seleccionados.
+      - Falta stock o producto inactivo (ErroresValidacionPedido, con
+        todos los problemas del carrito a la vez).
+    """
+    from bson import ObjectId
+    from datetime import datetime, timezone
+
+    productos_col = get_productos_collection()
+    carritos_col = get_carritos_collection()
+    pedidos_col = get_pedidos_collection()
+
+    try:
+        id_usuario = ObjectId(id_usuario_str)
+    except Exception:
+        raise ValueError("id_usuario_str no es un ObjectId válido")
+
+    # 1. Obtener carrito ABIERTO
+    carrito = carritos_col.find_one({
+        "idUsuarioCliente": id_usuario,
+        "estadoCarrito": "abierto"
+    })
+
+    if not carrito:
+        raise ValueError("El usuario no tiene un carrito abierto")
+
+    items_carrito = carrito.get("itemsCarrito", [])
+
+    # 2. Filtrar SOLO items seleccionados y con cantidad > 0
+    items_seleccionados = [
+        item for item in items_carrito
+        if item.get("seleccionado", True) and item.get("cantidad", 0) > 0
+    ]
+
+    if not items_seleccionados:
+        raise ValueError("No hay productos seleccionados para crear el pedido.")
+
+    # 3. Validar productos, stock y armar itemsPedido.
+    #    Todos los productos en UNA consulta $in; se juntan todos los
+    #    errores para que el usuario corrija el carrito de una sola vez.
+    lineas_validas = [
+        (item["idProducto"], int(item["cantidad"]))
+        for item in items_seleccionados if item.get("idProducto")
+    ]
+    productos = {
+        producto["_id"]: producto
+        for producto in productos_col.find(
+            {"_id": {"$in": [id_producto for id_producto, _ in lineas_validas]}},
+            PROYECCION_VALIDACION_PEDIDO,
+        )
+    }
+
+    items_pedido = []
+    subtotal_pedido = 0.0
+    productos_a_actualizar_stock = []  # (idProducto, cantidad)
+    errores = []
+
+    for id_producto, cantidad in lineas_validas:
+        producto = productos.get(id_producto)
+        if not producto:
+            errores.append("Uno de los productos del carrito ya no existe.")
+            continue
+
+        nombre = producto.get("nombreProducto", "")
+        inventario = producto.get("inventario", {})
+        stock_actual = inventario.get("stockActual", 0)
+        precio_actual = inventario.get("precioVenta")
+
+        if producto.get("estadoProducto") != "activo":
+            errores.append(f"El producto '{nombre}' ya no está activo.")
+            continue
+
+        if precio_actual is None:
+            errores.append(f"El producto '{nombre}' no tiene precio definido.")
+            continue
+
+        if cantidad > stock_actual:
+            errores.append(
+                f"No hay stock suficiente para '{nombre}'. "
+                f"Disponible: {stock_actual}, solicitado: {cantidad}."
+            )
+            continue
+
+        subtotal_linea = float(cantidad * precio_actual)
+        subtotal_pedido += subtotal_linea
+
+        items_pedido.append({
+            "idProducto": id_producto,
+            "nombreProducto": nombre,
+            "cantidad": cantidad,
+            "precioUnitario": float(precio_actual),
+            "subtotalLinea": subtotal_linea
+        })
+
+        productos_a_actualizar_stock.append((id_producto, cantidad))
+
+    if errores:
+        raise ErroresValidacionPedido(errores)
+
+    # 4. Calcular totales
+    subtotal_pedido = float(subtotal_pedido)
+    costo_envio = float(costo_envio)
+    total_pedido = subtotal_pedido + costo_envio
+
+        # 4.5. Obtener la dirección principal del usuario
+    direcciones_col = get_direcciones_envio_collection()
+    dir_principal = direcciones_col.find_one({
+        "idUsuario": id_usuario,
+        "activo": True,
+        "esPrincipal": True,
+    })
+
+    if not dir_principal:
+        # No dejamos crear pedido si no hay dirección principal
+        raise ValueError("Debes tener al menos una dirección de envío principal para finalizar la compra.")
+
+    # Snapshot de la dirección al momento del pedido
+    direccion_snapshot = {
+        "idDireccionEnvio": dir_principal["_id"],
+        "nombreContacto": dir_principal.get("nombreContacto", ""),
+        "telefonoContacto": dir_principal.get("telefonoContacto", ""),
+        "ciudad": dir_principal.get("ciudad", ""),
+        "barrio": dir_principal.get("barrio", ""),
+        "complemento": dir_principal.get("complemento", ""),
+    }
+
+    # 5. Construir documento Pedido (siguiendo tu $jsonSchema)
+    ahora = datetime.now(timezone.utc)
+
+    pedido_doc = {
+        "idUsuarioCliente": id_usuario,
+        "itemsPedido": items_pedido,
+        "fechaCreacionPedido": ahora,
+        "estadoPedido": "pendiente",  # luego lo cambiarás a 'pagado', etc.
+        "subtotalPedido": subtotal_pedido,
+        "costoEnvioPedido": costo_envio,
+        "totalPedido": total_pedido,
+        "metodoEntrega": metodo_entrega,  # 'domicilio' | 'contraEntrega'
+        "metodoPago": metodo_pago,       # 'efectivo', 'tarjetaCredito', etc.
+        # 👇 NUEVO
+        "idDireccionEnvio": direccion_snapshot["idDireccionEnvio"],
+        "direccionEnvioSnapshot": direccion_snapshot,
+    }
+
+    # 6. Escribir: stock + Pedido + carrito convertido, todo o nada
+    lineas = [(id_producto, int(cantidad)) for id_producto, cantidad in productos_a_actualizar_stock]
+
+    pedido_doc["_id"] = ObjectId()  # los movimientos de inventario lo referencian
+
+    def escribir(session):
+        _descontar_stock_checkout(id_usuario, lineas, session, pedido_doc["_id"])
+        pedidos_col.insert_one(pedido_doc, session=session)
+        _marcar_carrito_convertido(carrito, ahora, session)
+        _completar_clave_idempotencia(id_clave_idempotencia, pedido_doc["_id"], session)
+        # Correo, avisos, etc.: fuera del request (accounts/trabajos.py)
+        encolar_trabajo("pedido_creado", {"idPedido": pedido_doc["_id"]}, session)
+        encolar_trabajo("resumen_pedido", {"idPedido": pedido_doc["_id"]}, session)
+
+    if _soporta_transacciones():
+        # with_transaction reintenta solo ante errores transitorios
+        # (TransientTransactionError / UnknownTransactionCommitResult)
+        with _client.start_session() as session:
+            session.with_transaction(escribir)
+    else:
+        # mongod suelto: sin transacciones. Mismos filtros condicionados,
+        # y si algo falla a mitad se deshace a mano.
+        descontados, reservas = _descontar_stock_por_linea(id_usuario, lineas, pedido_doc["_id"])
+        try:
+            pedidos_col.insert_one(pedido_doc)
+            _marcar_carrito_convertido(carrito, ahora)
+        except Exception:
+            pedidos_col.delete_one({"_id": pedido_doc["_id"]})
+            _devolver_stock(descontados, pedido_doc["_id"])
+            _restituir_reservas(reservas, pedido_doc["_id"])
+            raise
+        # Desde aquí el pedido ya existe y el carrito quedó convertido:
+        # lo que falle se registra, pero no se deshace la compra.
+        try:
+            _completar_clave_idempotencia(id_clave_idempotencia, pedido_doc["_id"])
+        except Exception as e:
+            print("ERROR al completar la clave de idempotencia del pedido", pedido_doc["_id"], e)
+        for tipo in ("pedido_creado", "resumen_pedido"):
+            try:
+                encolar_trabajo(tipo, {"idPedido": pedido_doc["_id"]})
+            except Exception as e:
+                print(f"ERROR al encolar '{tipo}' del pedido", pedido_doc["_id"], e)
+        # Los ítems no seleccionados se van con el carrito: soltar sus reservas
+        if settings.RESERVAS_STOCK_ACTIVAS:
+            liberar_reservas_usuario(id_usuario)
+
+    invalidar_inventario(id_producto for id_producto, _ in lineas)
+
+    return pedido_doc
+
+
+# ─────────────────────────────────────────────
+#  HISTORIAL DE PEDIDOS ("Mis pedidos")
+# ─────────────────────────────────────────────
+# Paginación por clave (keyset), no por skip: cada página continúa desde
+# la (fechaCreacionPedido, _id) de la última fila de la anterior, así el
+# costo de una página no crece con la cantidad de pedidos del cliente.
+# El índice 'pedido_usuario_fecha' (y su variante con estado) la sostiene.
+
+ESTADOS_PEDIDO = ("pendiente", "pagado", "preparacion", "enviado", "entregado", "cancelado")
+PEDIDOS_POR_PAGINA = 20
+
+_EPOCA = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _cursor_pedido(fecha: datetime, id_pedido: ObjectId) -> str:
+    """'<milisegundos>_<id>' de la última fila de una página."""
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return f"{(fecha - _EPOCA) // timedelta(milliseconds=1)}_{id_pedido}"
+
+def _leer_cursor_pedido(cursor: str) -> tuple[datetime, ObjectId]:
+    try:
+        milis, id_texto = cursor.split("_", 1)
+        return _EPOCA + timedelta(milliseconds=int(milis)), ObjectId(id_texto)
+    except Exception:
+        raise ValueError("La página solicitada no es válida.")
+
+def _filtro_pagina_pedidos(
+    filtro: dict,
+    despues_de: str | None = None,
+    estado: str | None = None,
+    desde: datetime | None = None,
+    hasta: datetime | None = None,
+) -> dict:
+    """
+    Completa 'filtro' con el estado, el rango de fechas ('desde' incluido,
+    'hasta' excluido) y la continuación desde el cursor 'despues_de'.
+    """
+    filtro = dict(filtro)
+    if estado:
+        if estado not in ESTADOS_PEDIDO:
+            raise ValueError("Estado de pedido no válido.")
+        filtro["estadoPedido"] = estado
+
+    rango = {}
+    if desde:
+        rango["$gte"] = desde
+    if hasta:
+        rango["$lt"] = hasta
+    if rango:
+        filtro["fechaCreacionPedido"] = rango
+
+    if despues_de:
+        fecha, id_pedido = _leer_cursor_pedido(despues_de)
+        filtro["$or"] = [
+            {"fechaCreacionPedido": {"$lt": fecha}},
+            {"fechaCreacionPedido": fecha, "_id": {"$lt": id_pedido}},
+        ]
+    return filtro
+
+def _pagina_pedidos(filtro: dict, limite: int) -> tuple[list[PedidoResumen], str | None]:
+    docs = list(get_pedidos_collection().aggregate([
+        {"$match": filtro},
+        {"$sort": {"fechaCreacionPedido": -1, "_id": -1}},
+        {"$limit": limite + 1},
+        {"$project": {
+            "fechaCreacionPedido": 1,
+            "estadoPedido": 1,
+            "totalPedido": 1,
+            "cantidadItems": {"$size": {"$ifNull": ["$itemsPedido", []]}},
+        }},
+    ]))
+
+    siguiente = None
+    if len(docs) > limite:
+        docs = docs[:limite]
+        siguiente = _cursor_pedido(docs[-1]["fechaCreacionPedido"], docs[-1]["_id"])
+    return [PedidoResumen.desde_bson(doc) for doc in docs], siguiente
+
+def listar_pedidos_usuario(
+    id_usuario_str: str,
+    despues_de: str | None = None,
+    estado: str | None = None,
+    desde: datetime | None = None,
+    hasta: datetime | None = None,
+    limite: int = PEDIDOS_POR_PAGINA,
+) -> tuple[list[PedidoResumen], str | None]:
+    """
+    Una página del historial del usuario, del más reciente al más viejo.
+    - 'despues_de': cursor devuelto por la página anterior.
+    - 'estado': uno de ESTADOS_PEDIDO; 'desde' (incluido) y 'hasta'
+      (excluido) filtran por fechaCreacionPedido.
+    Solo trae fecha, estado, total y cuántos ítems tiene (no las líneas).
+    Devuelve (pedidos, cursor de la página siguiente o None).
+    """
+    try:
+        id_usuario = ObjectId(id_usuario_str)
+    except Exception:
+        raise ValueError("id_usuario_str no es un ObjectId válido")
+
+    filtro = _filtro_pagina_pedidos(
+        {"idUsuarioCliente": id_usuario}, despues_de, estado, desde, hasta
+    )
+    return _pagina_pedidos(filtro, limite)
+
+def listar_pedidos(
+    despues_de: str | None = None,
+    estado: str | None = None,
+    limite: int = PEDIDOS_POR_PAGINA,
+) -> tuple[list[PedidoResumen], str | None]:
+    """
+    Igual que listar_pedidos_usuario pero de todos los clientes
+    (panel de administración). Índices 'pedido_fecha' y 'pedido_estado_fecha'.
+    """
+    return _pagina_pedidos(_filtro_pagina_pedidos({}, despues_de, estado), limite)
+
+
+# Solo lo que pinta el detalle del pedido
+PROYECCION_PEDIDO_DETALLE = {
+    "idUsuarioCliente": 1,
+    "itemsPedido.idProducto": 1,
+    "itemsPedido.nombreProducto": 1,
+    "itemsPedido.cantidad": 1,
+    "itemsPedido.precioUnitario": 1,
+    "itemsPedido.subtotalLinea": 1,
+    "fechaCreacionPedido": 1,
+    "estadoPedido": 1,
+    "subtotalPedido": 1,
+    "costoEnvioPedido": 1,
+    "totalPedido": 1,
+    "metodoEntrega": 1,
+    "metodoPago": 1,
+    "direccionEnvioSnapshot": 1,
+}
+
+
+def _filtro_pedido_usuario(id_pedido_str: str, id_usuario_str: str) -> dict:
+    """
+    Filtro {_id, idUsuarioCliente}: el dueño se valida en la consulta misma,
+    así un pedido ajeno es indistinguible de uno que no existe.
+    """
+    try:
+        return {"_id": ObjectId(id_pedido_str), "idUsuarioCliente": ObjectId(id_usuario_str)}
+    except Exception:
+        raise ValueError("Identificador de pedido no válido.")
+
+
+def estado_pedido_usuario(id_pedido_str: str, id_usuario_str: str) -> str | None:
+    """
+    Estado del pedido si existe y es del usuario; None si no.
+    Lectura mínima (solo estadoPedido) para decidir si sirve la caché / 304.
+    """
+    doc = get_pedidos_collection().find_one(
+        _filtro_pedido_usuario(id_pedido_str, id_usuario_str),
+        {"estadoPedido": 1},
+    )
+    return doc.get("estadoPedido", "") if doc else None
+
+
+def obtener_pedido_usuario(id_pedido_str: str, id_usuario_str: str) -> Pedido | None:
+    """
+    Pedido completo (con PROYECCION_PEDIDO_DETALLE) si es del usuario; None si no.
+    """
+    doc = get_pedidos_collection().find_one(
+        _filtro_pedido_usuario(id_pedido_str, id_usuario_str),
+        PROYECCION_PEDIDO_DETALLE,
+    )
+    return Pedido.desde_bson(doc) if doc else None
+
+
+# ─────────────────────────────────────────────
+#  CAMBIOS DE ESTADO DEL PEDIDO
+# ─────────────────────────────────────────────
+
+# Desde estos ya no se sale
+ESTADOS_PEDIDO_FINALES = ("entregado", "cancelado")
+
+
+def cambiar_estado_pedido(id_pedido_str: str, nuevo_estado: str) -> bool:
+    """
+    Pasa el pedido a 'nuevo_estado' (uno de ESTADOS_PEDIDO) y encola la
+    actualización de los resúmenes de ventas.
+    Devuelve False si ya estaba en ese estado.
+    Lanza ValueError si el estado no es válido, el pedido no existe, está en
+    un estado final o cambió entretanto.
+    """
+    if nuevo_estado not in ESTADOS_PEDIDO:
+        raise ValueError("Estado de pedido no válido.")
+    try:
+        id_pedido = ObjectId(id_pedido_str)
+    except Exception:
+        raise ValueError("Identificador de pedido no válido.")
+
+    pedidos_col = get_pedidos_collection()
+    doc = pedidos_col.find_one({"_id": id_pedido}, {"estadoPedido": 1})
+    if not doc:
+        raise ValueError("El pedido no existe.")
+    estado_actual = doc.get("estadoPedido")
+    if estado_actual == nuevo_estado:
+        return False
+    if estado_actual in ESTADOS_PEDIDO_FINALES:
+        raise ValueError(f"Un pedido {estado_actual} ya no puede cambiar de estado.")
+
+    def escribir(session):
+        res = pedidos_col.update_one(
+            {"_id": id_pedido, "estadoPedido": estado_actual},
+            {"$set": {
+                "estadoPedido": nuevo_estado,
+                "fechaActualizacionPedido": datetime.now(timezone.utc),
+            }},
+            session=session,
+        )
+        if res.matched_count == 0:
+            raise ValueError("El pedido cambió de estado mientras tanto. Vuelve a intentarlo.")
+        encolar_trabajo("resumen_pedido", {"idPedido": id_pedido}, session)
+
+    if _soporta_transacciones():
+        with _client.start_session() as session:
+            session.with_transaction(escribir)
+    else:
+        escribir(None)
+    return True
+
+
+# ─────────────────────────────────────────────
+#  RESÚMENES DE VENTAS (pre-agregados para el panel)
+# ─────────────────────────────────────────────
+# Contadores que se mantienen con $inc (upsert) cuando un pedido se crea o
+# cambia de estado, para que el panel no recorra Pedidos:
+#   ResumenVentasDiarias    _id = día (UTC)
+#   ResumenVentasSemanales  _id = lunes de la semana (UTC)
+#       {pedidos, porEstado.<estado>, ingresos, unidades}
+#   ResumenVentasProductos  {semana, idProducto, nombreProducto, unidades, ingresos}
+#   ResumenVentasMetodos    _id = {campo: 'metodoPago'|'metodoEntrega', valor}
+#       {pedidos, ingresos}
+# Un pedido cancelado sigue contando en 'pedidos' y 'porEstado' de su día,
+# pero no en ingresos, unidades, productos ni métodos.
+#
+# Cada pedido guarda en 'estadoEnResumenes' el estado que ya está sumado; el
+# trabajo 'resumen_pedido' (accounts/trabajos.py) resta ese y suma el actual.
+# 'python manage.py reconstruir_resumenes_ventas' los rehace desde cero; mientras
+# corre, esos trabajos quedan en pausa (tomar_trabajo no los entrega).
+
+RESUMENES_VENTAS = (
+    "ResumenVentasDiarias",
+    "ResumenVentasSemanales",
+    "ResumenVentasProductos",
+    "ResumenVentasMetodos",
+)
+
+PROYECCION_RESUMEN_PEDIDO = {
+    "fechaCreacionPedido": 1,
+    "estadoPedido": 1,
+    "estadoEnResumenes": 1,
+    "totalPedido": 1,
+    "metodoPago": 1,
+    "metodoEntrega": 1,
+    "itemsPedido.idProducto": 1,
+    "itemsPedido.nombreProducto": 1,
+    "itemsPedido.cantidad": 1,
+    "itemsPedido.subtotalLinea": 1,
+}
+
+
+def get_resumen_ventas_collection(nombre: str):
+    """
+    Devuelve una de las colecciones de RESUMENES_VENTAS.
+    """
+    db = get_db()
+    return db[nombre]
+
+def _inicio_semana(fecha: datetime) -> datetime:
+    dia = _inicio_dia(fecha)
+    return dia - timedelta(days=dia.weekday())
+
+def _acumular_resumen(acumulado: dict, coleccion: str, clave, filtro: dict,
+                      incrementos: dict, fijar: dict | None = None) -> None:
+    entrada = acumulado.setdefault((coleccion, clave), {"filtro": filtro, "inc": {}, "set": {}})
+    for campo, valor in incrementos.items():
+        entrada["inc"][campo] = entrada["inc"].get(campo, 0) + valor
+    if fijar:
+        entrada["set"].update(fijar)
+
+def _sumar_pedido_a_resumenes(acumulado: dict, pedido: dict, estado: str | None, signo: int) -> None:
+    """
+    Acumula en 'acumulado' lo que aporta 'pedido' estando en 'estado'
+    (signo +1 para sumarlo, -1 para restarlo). Sin estado no aporta nada.
+    """
+    if not estado:
+        return
+
+    vigente = estado != "cancelado"
+    items = pedido.get("itemsPedido", []) if vigente else []
+    ingresos = pedido.get("totalPedido", 0) if vigente else 0
+    unidades = sum(int(item.get("cantidad", 0)) for item in items)
+
+    fecha = pedido["fechaCreacionPedido"]
+    dia, semana = _inicio_dia(fecha), _inicio_semana(fecha)
+    generales = {
+        "pedidos": signo,
+        f"porEstado.{estado}": signo,
+        "ingresos": signo * ingresos,
+        "unidades": signo * unidades,
+    }
+    _acumular_resumen(acumulado, "ResumenVentasDiarias", dia, {"_id": dia}, generales)
+    _acumular_resumen(acumulado, "ResumenVentasSemanales", semana, {"_id": semana}, generales)
+
+    if not vigente:
+        return
+    for item in items:
+        id_producto = item.get("idProducto")
+        _acumular_resumen(
+            acumulado, "ResumenVentasProductos", (semana, id_producto),
+            {"semana": semana, "idProducto": id_producto},
+            {
+                "unidades": signo * int(item.get("cantidad", 0)),
+                "ingresos": signo * item.get("subtotalLinea", 0),
+            },
+            {"nombreProducto": item.get("nombreProducto", "")},
+        )
+    for campo in ("metodoPago", "metodoEntrega"):
+        valor = pedido.get(campo) or ""
+        _acumular_resumen(
+            acumulado, "ResumenVentasMetodos", (campo, valor),
+            {"_id": {"campo": campo, "valor": valor}},
+            {"pedidos": signo, "ingresos": signo * ingresos},
+        )
+
+def _escribir_resumenes(acumulado: dict, session=None, sufijo: str = "") -> None:
+    """
+    Un bulk_write de $inc con upsert por colección (+ 'sufijo' en el nombre,
+    para la reconstrucción). Los contadores que quedan en 0 (p. ej. unidades
+    al pasar de 'pendiente' a 'pagado') no se escriben.
+    """
+    por_coleccion = {}
+    for (coleccion, _), entrada in acumulado.items():
+        incrementos = {campo: valor for campo, valor in entrada["inc"].items() if valor}
+        if not incrementos:
+            continue
+        cambios = {"$inc": incrementos}
+        if entrada["set"]:
+            cambios["$set"] = entrada["set"]
+        por_coleccion.setdefault(coleccion, []).append(
+            UpdateOne(entrada["filtro"], cambios, upsert=True)
+        )
+    for coleccion, operaciones in por_coleccion.items():
+        get_resumen_ventas_collection(coleccion + sufijo).bulk_write(
+            operaciones, ordered=False, session=session
+        )
+
+def _indice_resumen_productos(col) -> str:
+    """Un documento por (semana, producto): lo exige el upsert."""
+    return col.create_index(
+        [("semana", ASCENDING), ("idProducto", ASCENDING)],
+        name="resumen_producto_semana",
+        unique=True,
+    )
+
+def actualizar_resumenes_pedido(id_pedido: ObjectId) -> bool:
+    """
+    Lleva los resúmenes del estado ya sumado del pedido ('estadoEnResumenes')
+    a su estado actual. Devuelve False si no había nada que hacer.
+
+    No cuenta dos veces: 'estadoEnResumenes' solo avanza si sigue siendo el
+    que se leyó. Con transacciones va junto con los $inc; sin ellas se marca
+    primero, y si el proceso muere en medio la reconstrucción lo corrige.
+    """
+    pedidos_col = get_pedidos_collection()
+    pedido = pedidos_col.find_one({"_id": id_pedido}, PROYECCION_RESUMEN_PEDIDO)
+    if not pedido:
+        return False
+    anterior = pedido.get("estadoEnResumenes")
+    actual = pedido.get("estadoPedido")
+    if anterior == actual:
+        return False
+
+    acumulado = {}
+    _sumar_pedido_a_resumenes(acumulado, pedido, anterior, -1)
+    _sumar_pedido_a_resumenes(acumulado, pedido, actual, 1)
+
+    def escribir(session):
+        res = pedidos_col.update_one(
+            {"_id": id_pedido, "estadoPedido": actual, "estadoEnResumenes": anterior},
+            {"$set": {"estadoEnResumenes": actual}},
+            session=session,
+        )
+        if res.matched_count == 0:
+            return False  # ya lo hizo otro, o cambió de estado (ese trabajo lo hará)
+        _escribir_resumenes(acumulado, session)
+        return True
+
+    if _soporta_transacciones():
+        with _client.start_session() as session:
+            return session.with_transaction(escribir)
+    return escribir(None)
+
+def reconstruir_resumenes_ventas(lote: int = 500) -> int:
+    """
+    Rehace los resúmenes desde Pedidos. Recorre los pedidos por _id en lotes
+    de 'lote', sumando cada lote en memoria, y escribe en colecciones
+    '<nombre>_reconstruccion'; al terminar las pone en lugar de las vigentes
+    con renameCollection(dropTarget). El panel sigue viendo los resúmenes
+    anteriores completos hasta ese momento.
+
+    Los trabajos 'resumen_pedido' se pausan antes de empezar (y se esperan
+    los que ya estaban en curso): lo que escribieran en las colecciones
+    vigentes se perdería con el rename. Los que se encolen mientras tanto
+    quedan pendientes y al reanudar llevan cada pedido del estado sumado
+    aquí a su estado actual. Si la reconstrucción falla la pausa se
+    mantiene: 'estadoEnResumenes' ya apunta a colecciones que no llegaron a
+    reemplazar las vigentes, y hay que volver a correrla.
+    Devuelve cuántos pedidos se sumaron.
+    """
+    pausar_trabajos("resumen_pedido")
+    if not _esperar_trabajos_en_curso("resumen_pedido", settings.TRABAJOS_LEASE_SEGUNDOS):
+        raise RuntimeError(
+            "Hay trabajos 'resumen_pedido' en curso que no terminaron; "
+            "vuelve a intentar la reconstrucción."
+        )
+
+    sufijo = "_reconstruccion"
+    db = get_db()
+    for coleccion in RESUMENES_VENTAS:
+        db.drop_collection(coleccion + sufijo)
+        db.create_collection(coleccion + sufijo)
+    _indice_resumen_productos(get_resumen_ventas_collection("ResumenVentasProductos" + sufijo))
+
+    pedidos_col = get_pedidos_collection()
+    total = 0
+    ultimo_id = None
+    while True:
+        filtro = {"_id": {"$gt": ultimo_id}} if ultimo_id else {}
+        docs = list(pedidos_col.find(filtro, PROYECCION_RESUMEN_PEDIDO).sort("_id", ASCENDING).limit(lote))
+        if not docs:
+            break
+
+        acumulado = {}
+        for doc in docs:
+            _sumar_pedido_a_resumenes(acumulado, doc, doc.get("estadoPedido"), 1)
+        _escribir_resumenes(acumulado, sufijo=sufijo)
+        pedidos_col.bulk_write([
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"estadoEnResumenes": doc.get("estadoPedido")}})
+            for doc in docs
+        ], ordered=False)
+
+        total += len(docs)
+        ultimo_id = docs[-1]["_id"]
+
+    for coleccion in RESUMENES_VENTAS:
+        get_resumen_ventas_collection(coleccion + sufijo).rename(coleccion, dropTarget=True)
+
+    reanudar_trabajos("resumen_pedido")
+    return total
+
+def resumen_ventas(dias: int = 30, semanas: int = 12, top_productos: int = 10) -> dict:
+    """
+    Lo que muestra el panel de ventas, leído solo de los resúmenes:
+    - 'diario' ({dia, ...}): últimos 'dias' días; 'semanal' ({semana, ...}):
+      últimas 'semanas' semanas. Más reciente primero, solo los que tuvieron
+      pedidos.
+    - 'totales': suma de 'diario'.
+    - 'productos': los 'top_productos' más vendidos (unidades) en 'semanas'.
+    - 'metodos': {'metodoPago': [...], 'metodoEntrega': [...]}, histórico.
+    """
+    hoy = _inicio_dia(datetime.now(timezone.utc))
+    desde_dia = hoy - timedelta(days=dias - 1)
+    desde_semana = _inicio_semana(hoy) - timedelta(weeks=semanas - 1)
+
+    diario = list(
+        get_resumen_ventas_collection("ResumenVentasDiarias")
+        .find({"_id": {"$gte": desde_dia}})
+        .sort("_id", DESCENDING)
+    )
+    semanal = list(
+        get_resumen_ventas_collection("ResumenVentasSemanales")
+        .find({"_id": {"$gte": desde_semana}})
+        .sort("_id", DESCENDING)
     )
+    productos = list(get_resumen_ventas_collection("ResumenVentasProductos").aggregate([
+        {"$match": {"semana": {"$gte": desde_semana}}},
+        # $last toma el nombre de la semana más reciente
+        {"$sort": {"semana": 1}},
+        {"$group": {
+            "_id": "$idProducto",
+            "nombreProducto": {"$last": "$nombreProducto"},
+            "unidades": {"$sum": "$unidades"},
+            "ingresos": {"$sum": "$ingresos"},
+        }},
+        {"$match": {"unidades": {"$gt": 0}}},
+        {"$sort": {"unidades": -1}},
+        {"$limit": top_productos},
+    ]))
+
+    metodos = {"metodoPago": [], "metodoEntrega": []}
+    # Los que quedaron en 0 (todos sus pedidos se cancelaron) no se muestran
+    metodos_col = get_resumen_ventas_collection("ResumenVentasMetodos")
+    for doc in metodos_col.find({"pedidos": {"$gt": 0}}).sort("pedidos", DESCENDING):
+        metodos.setdefault(doc["_id"]["campo"], []).append({
+            "valor": doc["_id"]["valor"],
+            "pedidos": doc.get("pedidos", 0),
+            "ingresos": doc.get("ingresos", 0),
+        })
 
-    return pedido_doc
+    # Los templates no leen '_id': se renombra
+    for doc in diario:
+        doc["dia"] = doc.pop("_id")
+    for doc in semanal:
+        doc["semana"] = doc.pop("_id")
+    for doc in productos:
+        doc["idProducto"] = doc.pop("_id")
+
+    totales = {
+        "pedidos": sum(d.get("pedidos", 0) for d in diario),
+        "ingresos": sum(d.get("ingresos", 0) for d in diario),
+        "unidades": sum(d.get("unidades", 0) for d in diario),
+        "cancelados": sum(d.get("porEstado", {}).get("cancelado", 0) for d in diario),
+    }
+    return {
+        "diario": diario,
+        "semanal": semanal,
+        "totales": totales,
+        "productos": productos,
+        "metodos": metodos,
+    }
 
 
 # ─────────────────────────────────────────────
@@ -706,6 +2129,129 @@ from datetime import datetime, timezone
 from bson import ObjectId
 from pymongo.errors import PyMongoError
 
+# ─────────────────────────────────────────────
+#  CACHÉ DE CATÁLOGO: datos fríos vs. inventario caliente
+# ─────────────────────────────────────────────
+# Lo descriptivo (nombre, descripción, imagen...) cambia muy poco y se cachea
+# por horas, atado a una versión de catálogo guardada en Mongo.
+# El inventario (stock, mínimo, precio) cambia en cada compra: se lee aparte,
+# con una proyección pequeña y un TTL corto, y se invalida al modificarlo.
+
+PROYECCION_INVENTARIO = {
+    "inventario.stockActual": 1,
+    "inventario.stockMinimo": 1,
+    "inventario.precioVenta": 1,
+}
+
+
+def _clave_inventario(id_producto) -> str:
+    return f"inventario:{id_producto}"
+
+
+def obtener_version_catalogo() -> int:
+    """
+    Devuelve la versión actual del catálogo (Metadatos._id = 'catalogo').
+    Se cachea unos segundos para no consultar Mongo en cada request.
+    """
+    version = cache.get("catalogo:version")
+    if version is None:
+        doc = get_metadatos_collection().find_one({"_id": "catalogo"}, {"version": 1})
+        version = doc.get("version", 0) if doc else 0
+        cache.set("catalogo:version", version, settings.CATALOGO_VERSION_TTL)
+    return version
+
+
+def incrementar_version_catalogo() -> int:
+    """
+    Marca que cambió la parte descriptiva del catálogo
+    (alta, baja, cambio de nombre/descr./imagen/estado).
+    Las cachés que dependen de la versión anterior quedan obsoletas.
+    """
+    doc = get_metadatos_collection().find_one_and_update(
+        {"_id": "catalogo"},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    cache.set("catalogo:version", doc["version"], settings.CATALOGO_VERSION_TTL)
+    return doc["version"]
+
+
+def obtener_inventarios(ids_producto) -> dict:
+    """
+    Devuelve {ObjectId producto: {stockActual, stockMinimo, precioVenta}}
+    para los ids indicados.
+    Primero busca en caché; los que falten se leen en UNA sola consulta $in
+    con proyección solo del inventario.
+    Los productos que no existen no aparecen en el resultado.
+    """
+    ids = list(dict.fromkeys(ids_producto))
+    if not ids:
+        return {}
+
+    claves = {_clave_inventario(i): i for i in ids}
+    en_cache = cache.get_many(list(claves))
+    inventarios = {claves[k]: v for k, v in en_cache.items()}
+
+    faltantes = [i for i in ids if i not in inventarios]
+    if faltantes:
+        col = get_productos_collection()
+        nuevos = {}
+        for doc in col.find({"_id": {"$in": faltantes}}, PROYECCION_INVENTARIO):
+            inventarios[doc["_id"]] = doc.get("inventario", {})
+            nuevos[_clave_inventario(doc["_id"])] = inventarios[doc["_id"]]
+        cache.set_many(nuevos, settings.INVENTARIO_CACHE_TTL)
+
+    return inventarios
+
+
+def invalidar_inventario(ids_producto) -> None:
+    """
+    Borra de la caché el inventario de los productos indicados.
+    Se llama desde todo lo que cambia stock o precio.
+    """
+    cache.delete_many([_clave_inventario(i) for i in ids_producto])
+
+
+def consultar_catalogo_descriptivo_activo() -> list[dict]:
+    """
+    Consulta en Mongo los productos activos SIN el subdocumento inventario,
+    ordenados por nombre. Devuelve los documentos tal cual (BSON → dict).
+    """
+    col = get_productos_collection()
+    cursor = col.find(
+        {"estadoProducto": "activo"},
+        {"inventario": 0},
+    ).sort("nombreProducto", 1)
+    return list(cursor)
+
+
+def _catalogo_descriptivo_activo() -> list[Producto]:
+    """
+    Productos activos (registros Producto, sin inventario), ordenados por nombre.
+    Cacheado por versión de catálogo (CATALOGO_CACHE_TTL).
+    Si hay un snapshot en disco de la misma versión se usan sus registros
+    (construidos una vez por versión) y no se duplica en la caché.
+    Los registros pueden ser compartidos: no modificarlos.
+    """
+    from . import catalogo_snapshot
+
+    version = obtener_version_catalogo()
+    productos = catalogo_snapshot.productos_activos(version)
+    if productos is not None:
+        return productos
+
+    clave = f"catalogo:activos:v{version}"
+    productos = cache.get(clave)
+    if productos is None:
+        productos = [
+            Producto.desde_bson(doc)
+            for doc in consultar_catalogo_descriptivo_activo()
+        ]
+        cache.set(clave, productos, settings.CATALOGO_CACHE_TTL)
+    return productos
+
+
 def listar_productos(estado: str | None = None) -> list[dict]:
     """
     Devuelve una lista de productos.
@@ -753,9 +2299,20 @@ def crear_producto(doc_producto: dict) -> str:
     ahora = datetime.now(timezone.utc)
     doc_producto["fechaCreacion"] = ahora
     doc_producto["fechaActualizacion"] = ahora
+    inventario = doc_producto.get("inventario")
+    if inventario is not None:
+        inventario["bajoStock"] = (
+            inventario.get("stockActual", 0) <= inventario.get("stockMinimo", 0)
+        )
 
     col = get_productos_collection()
     resultado = col.insert_one(doc_producto)
+    _registrar_movimientos([_movimiento(
+        resultado.inserted_id,
+        "reposicion",
+        doc_producto.get("inventario", {}).get("stockActual", 0),
+    )])
+    incrementar_version_catalogo()
     return str(resultado.inserted_id)
 
 
@@ -775,12 +2332,38 @@ def actualizar_producto(id_producto_str: str, campos_actualizados: dict) -> bool
 
     campos_actualizados["fechaActualizacion"] = datetime.now(timezone.utc)
 
+    # Se lee el stock anterior en la misma operación para registrar el
+    # movimiento; el pipeline recalcula inventario.bajoStock en la misma escritura
     col = get_productos_collection()
-    res = col.update_one(
+    antes = col.find_one_and_update(
         {"_id": oid},
-        {"$set": campos_actualizados}
+        [
+            {"$set": {campo: {"$literal": valor} for campo, valor in campos_actualizados.items()}},
+            _etapa_bajo_stock(),
+        ],
+        projection={"inventario.stockActual": 1},
+        return_document=ReturnDocument.BEFORE,
     )
-    return res.modified_count == 1
+
+    if antes is not None:
+        if "inventario.stockActual" in campos_actualizados:
+            delta = (
+                campos_actualizados["inventario.stockActual"]
+                - antes.get("inventario", {}).get("stockActual", 0)
+            )
+            _registrar_movimientos([
+                _movimiento(oid, "reposicion" if delta > 0 else "ajuste", delta)
+            ])
+        # Invalidar solo la parte (fría o caliente) que realmente cambió
+        if any(c.startswith("inventario") for c in campos_actualizados):
+            invalidar_inventario([oid])
+        if any(
+            not c.startswith("inventario") and c != "fechaActualizacion"
+            for c in campos_actualizados
+        ):
+            incrementar_version_catalogo()
+
+    return antes is not None
 
 
 def cambiar_estado_producto(id_producto_str: str, nuevo_estado: str) -> bool:
@@ -810,23 +2393,27 @@ def eliminar_producto_definitivo(id_producto_str: str) -> bool:
 
     col = get_productos_collection()
     res = col.delete_one({"_id": oid})
+    if res.deleted_count == 1:
+        invalidar_inventario([oid])
+        incrementar_version_catalogo()
     return res.deleted_count == 1
 
-def listar_productos_activos():
+def listar_productos_activos() -> list[Producto]:
     """
-    Devuelve una lista de productos con estadoProducto = 'activo'.
-    Agrega un campo 'id' como string para usar en los templates.
+    Devuelve una lista de productos (registros Producto) con
+    estadoProducto = 'activo'. 'p.id' da el id como string para los templates.
+    Une la parte descriptiva cacheada con el inventario (caché corta).
     """
-    col = get_productos_collection()
-    cursor = col.find({"estadoProducto": "activo"}).sort("nombreProducto", 1)
+    productos = _catalogo_descriptivo_activo()
+    inventarios = obtener_inventarios(p._id for p in productos)
 
-    productos = []
-    for doc in cursor:
-        doc["id"] = str(doc["_id"])
-        productos.append(doc)
-    return productos
+    # Copia por request: los registros del catálogo se comparten entre hilos
+    return [
+        replace(producto, inventario=Inventario.desde_bson(inventarios.get(producto._id)))
+        for producto in productos
+    ]
 
-def listar_direcciones_usuario(usuario_id: str):
+def listar_direcciones_usuario(usuario_id: str) -> list[Direccion]:
     col = get_direcciones_envio_collection()
     try:
         oid = ObjectId(usuario_id)
@@ -837,18 +2424,8 @@ def listar_direcciones_usuario(usuario_id: str):
         {"idUsuario": oid, "activo": True}
     ).sort("fechaCreacion", 1)
 
-    direcciones = []
-    for doc in cursor:
-        direcciones.append({
-            "id": str(doc["_id"]),  # 👈 importante, esto alimenta {{ d.id }} en el template
-            "nombreContacto": doc.get("nombreContacto", ""),
-            "telefonoContacto": doc.get("telefonoContacto", ""),
-            "ciudad": doc.get("ciudad", ""),
-            "barrio": doc.get("barrio", ""),
-            "complemento": doc.get("complemento", ""),
-            "esPrincipal": doc.get("esPrincipal", False),
-        })
-    return direcciones
+    # Direccion.id alimenta {{ d.id }} en el template
+    return [Direccion.desde_bson(doc) for doc in cursor]
 
 def crear_direccion_envio(usuario_id: str, data: dict):
     """
@@ -1032,3 +2609,813 @@ def obtener_direccion_principal(usuario_id: str):
         )
 
     return doc
+
+
+# ─────────────────────────────────────────────
+#  PRODUCTOS CON STOCK BAJO
+# ─────────────────────────────────────────────
+# inventario.bajoStock (stockActual <= stockMinimo) se recalcula en la
+# misma escritura que mueve el stock (una etapa más del pipeline de
+# update), así la lista de reposición sale de un índice parcial sobre los
+# marcados en vez de un $expr que recorre todo el catálogo.
+
+def _etapa_bajo_stock() -> dict:
+    return {"$set": {"inventario.bajoStock": {"$lte": [
+        {"$ifNull": ["$inventario.stockActual", 0]},
+        {"$ifNull": ["$inventario.stockMinimo", 0]},
+    ]}}}
+
+def _pipeline_inc_inventario(cambios: dict) -> list:
+    """
+    Update con pipeline equivalente a {"$inc": cambios} sobre campos de
+    inventario, que además deja inventario.bajoStock al día.
+    """
+    return [
+        {"$set": {
+            campo: {"$add": [{"$ifNull": [f"${campo}", 0]}, delta]}
+            for campo, delta in cambios.items()
+        }},
+        _etapa_bajo_stock(),
+    ]
+
+def recalcular_bajo_stock() -> int:
+    """
+    Recalcula inventario.bajoStock en todo el catálogo (carga inicial o
+    tras cambios hechos por fuera de la app). Devuelve cuántos cambiaron.
+    """
+    res = get_productos_collection().update_many({}, [_etapa_bajo_stock()])
+    return res.modified_count
+
+def listar_productos_bajo_stock() -> list[dict]:
+    """
+    Productos activos con stockActual <= stockMinimo, por nombre, con lo
+    que falta para llegar al mínimo ('faltante'). Usa el índice parcial
+    'producto_bajo_stock'.
+    """
+    cursor = get_productos_collection().find(
+        {"inventario.bajoStock": True, "estadoProducto": "activo"},
+        {
+            "nombreProducto": 1,
+            "marcaProducto": 1,
+            "skuProducto": 1,
+            "inventario.stockActual": 1,
+            "inventario.stockMinimo": 1,
+        },
+    ).sort("nombreProducto", 1)
+
+    productos = []
+    for doc in cursor:
+        inventario = doc.get("inventario", {})
+        doc["id"] = str(doc["_id"])
+        doc["faltante"] = max(inventario.get("stockMinimo", 0) - inventario.get("stockActual", 0), 0)
+        productos.append(doc)
+    return productos
+
+
+# ─────────────────────────────────────────────
+#  MOVIMIENTOS DE INVENTARIO (libro de solo-agregar)
+# ─────────────────────────────────────────────
+# Cada cambio de stock deja un movimiento junto a la escritura que lo hace
+# (en la misma transacción cuando la hay):
+#   {idProducto, tipo: 'venta'|'reposicion'|'ajuste'|'reserva',
+#    campo: 'stockActual'|'reservado', delta, fecha, idPedido?, idUsuarioCliente?}
+# 'python manage.py compactar_movimientos' pasa los de días cerrados más
+# viejos que MOVIMIENTOS_RETENCION_DIAS a SaldosInventarioDiarios (un
+# documento por producto y día) y los borra.
+
+def get_movimientos_inventario_collection():
+    """
+    Devuelve la colección MovimientosInventario.
+    """
+    db = get_db()
+    return db["MovimientosInventario"]
+
+def get_saldos_inventario_collection():
+    """
+    Devuelve la colección SaldosInventarioDiarios (movimientos compactados).
+    """
+    db = get_db()
+    return db["SaldosInventarioDiarios"]
+
+def _movimiento(id_producto: ObjectId, tipo: str, delta: int, campo: str = "stockActual", **referencia) -> dict:
+    return {
+        "idProducto": id_producto,
+        "tipo": tipo,
+        "campo": campo,
+        "delta": int(delta),
+        "fecha": datetime.now(timezone.utc),
+        **referencia,
+    }
+
+def _registrar_movimientos(movimientos: list[dict], session=None) -> None:
+    """Agrega los movimientos con delta distinto de 0 (un solo insert_many)."""
+    movimientos = [m for m in movimientos if m["delta"]]
+    if movimientos:
+        get_movimientos_inventario_collection().insert_many(
+            movimientos, ordered=False, session=session
+        )
+
+def _inicio_dia(fecha: datetime) -> datetime:
+    return datetime(fecha.year, fecha.month, fecha.day, tzinfo=timezone.utc)
+
+def compactar_movimientos_inventario(dias_retencion: int | None = None) -> int:
+    """
+    Resume por producto y día los movimientos de los días ya cerrados con
+    más de 'dias_retencion' días (por defecto MOVIMIENTOS_RETENCION_DIAS)
+    y los borra. Devuelve cuántos movimientos se compactaron.
+
+    Se puede repetir sin duplicar: el saldo de un día se escribe una sola
+    vez ($setOnInsert) con todos sus movimientos, y solo después se borran.
+    Si se corta a mitad, la siguiente corrida solo termina de borrar.
+    """
+    if dias_retencion is None:
+        dias_retencion = settings.MOVIMIENTOS_RETENCION_DIAS
+    corte = _inicio_dia(datetime.now(timezone.utc)) - timedelta(days=dias_retencion)
+    movimientos = get_movimientos_inventario_collection()
+
+    grupos = movimientos.aggregate([
+        {"$match": {"fecha": {"$lt": corte}}},
+        {"$group": {
+            "_id": {
+                "idProducto": "$idProducto",
+                "dia": {"$dateToString": {"format": "%Y-%m-%d", "date": "$fecha"}},
+                "campo": "$campo",
+                "tipo": "$tipo",
+            },
+            "delta": {"$sum": "$delta"},
+            "cantidad": {"$sum": 1},
+        }},
+    ], allowDiskUse=True)
+
+    saldos = {}
+    for g in grupos:
+        clave = (g["_id"]["idProducto"], g["_id"]["dia"])
+        saldo = saldos.setdefault(clave, {
+            "idProducto": clave[0],
+            "dia": datetime.strptime(clave[1], "%Y-%m-%d").replace(tzinfo=timezone.utc),
+            "deltaStock": 0,
+            "deltaReservado": 0,
+            "porTipo": {},
+            "movimientos": 0,
+        })
+        if g["_id"]["campo"] == "reservado":
+            saldo["deltaReservado"] += g["delta"]
+        else:
+            saldo["deltaStock"] += g["delta"]
+            tipo = g["_id"]["tipo"]
+            saldo["porTipo"][tipo] = saldo["porTipo"].get(tipo, 0) + g["delta"]
+        saldo["movimientos"] += g["cantidad"]
+
+    if saldos:
+        get_saldos_inventario_collection().bulk_write([
+            UpdateOne(
+                {"_id": f"{id_producto}:{dia}"},
+                {"$setOnInsert": saldo},
+                upsert=True,
+            )
+            for (id_producto, dia), saldo in saldos.items()
+        ], ordered=False)
+
+    return movimientos.delete_many({"fecha": {"$lt": corte}}).deleted_count
+
+def stock_a_fecha(id_producto_str: str, fecha: datetime) -> int:
+    """
+    Stock (inventario.stockActual) que tenía el producto en 'fecha'.
+    Parte del stock actual y deshace lo posterior: movimientos vivos
+    posteriores a 'fecha' y saldos diarios de días posteriores. Para fechas
+    ya compactadas la precisión es de día (devuelve el cierre de ese día).
+    """
+    try:
+        oid = ObjectId(id_producto_str)
+    except Exception:
+        raise ValueError("id_producto_str no es un ObjectId válido")
+
+    producto = get_productos_collection().find_one({"_id": oid}, {"inventario.stockActual": 1})
+    if not producto:
+        raise ValueError("Producto no encontrado")
+    stock = producto.get("inventario", {}).get("stockActual", 0)
+
+    def suma(col, filtro, campo_delta):
+        filas = list(col.aggregate([
+            {"$match": filtro},
+            {"$group": {"_id": None, "total": {"$sum": campo_delta}}},
+        ]))
+        return filas[0]["total"] if filas else 0
+
+    posteriores = suma(
+        get_movimientos_inventario_collection(),
+        {"idProducto": oid, "campo": "stockActual", "fecha": {"$gt": fecha}},
+        "$delta",
+    )
+    dias_posteriores = suma(
+        get_saldos_inventario_collection(),
+        {"idProducto": oid, "dia": {"$gt": _inicio_dia(fecha)}},
+        "$deltaStock",
+    )
+    return stock - posteriores - dias_posteriores
+
+
+# ─────────────────────────────────────────────
+#  RESERVAS DE STOCK (modo opcional: RESERVAS_STOCK_ACTIVAS)
+# ─────────────────────────────────────────────
+# Al agregar al carrito, las unidades pasan de "disponibles" a
+# inventario.reservado, con vencimiento (RESERVA_STOCK_MINUTOS).
+# Disponible = inventario.stockActual - inventario.reservado.
+# ReservasStock guarda UNA reserva por (usuario, producto):
+#   {_id: "<usuario>:<producto>", idUsuarioCliente, idProducto, cantidad, expira}
+# Invariante: inventario.reservado == suma de 'cantidad' de sus reservas.
+# Las vencidas las devuelve 'python manage.py liberar_reservas_vencidas';
+# el checkout convierte las reservas en venta sin volver a leer el stock.
+
+def get_reservas_stock_collection():
+    """
+    Devuelve la colección ReservasStock.
+    """
+    db = get_db()
+    return db["ReservasStock"]
+
+def _id_reserva(id_usuario: ObjectId, id_producto: ObjectId) -> str:
+    return f"{id_usuario}:{id_producto}"
+
+def _filtro_stock_disponible(id_producto: ObjectId, cantidad: int) -> dict:
+    """
+    Filtro que solo coincide si hay 'cantidad' unidades disponibles
+    (sin contar las reservadas por otros).
+    """
+    return {
+        "_id": id_producto,
+        "$expr": {"$gte": [
+            {"$subtract": [
+                "$inventario.stockActual",
+                {"$ifNull": ["$inventario.reservado", 0]},
+            ]},
+            cantidad,
+        ]},
+    }
+
+def _reservar_stock(id_usuario: ObjectId, id_producto: ObjectId, cantidad: int, expira: datetime) -> bool:
+    """
+    Mueve 'cantidad' unidades a inventario.reservado si están disponibles
+    (un $inc condicionado) y suma la reserva del usuario.
+    Devuelve False si no alcanzó el stock disponible.
+    """
+    res = get_productos_collection().update_one(
+        _filtro_stock_disponible(id_producto, cantidad),
+        {"$inc": {"inventario.reservado": cantidad}},
+    )
+    if res.modified_count == 0:
+        return False
+
+    get_reservas_stock_collection().update_one(
+        {"_id": _id_reserva(id_usuario, id_producto)},
+        {
+            "$inc": {"cantidad": cantidad},
+            "$set": {
+                "idUsuarioCliente": id_usuario,
+                "idProducto": id_producto,
+                "expira": expira,
+            },
+        },
+        upsert=True,
+    )
+    _registrar_movimientos([
+        _movimiento(id_producto, "reserva", cantidad, "reservado", idUsuarioCliente=id_usuario)
+    ])
+    return True
+
+def _liberar_reserva(id_usuario: ObjectId, id_producto: ObjectId, cantidad: int | None = None) -> int:
+    """
+    Devuelve al stock disponible hasta 'cantidad' unidades reservadas por
+    el usuario (None = toda la reserva). Devuelve cuántas se liberaron.
+    """
+    reservas = get_reservas_stock_collection()
+    filtro = {"_id": _id_reserva(id_usuario, id_producto)}
+
+    if cantidad is None:
+        reserva = reservas.find_one_and_delete(filtro)
+        liberadas = reserva.get("cantidad", 0) if reserva else 0
+    else:
+        antes = reservas.find_one_and_update(
+            filtro,
+            [{"$set": {"cantidad": {"$max": [0, {"$subtract": ["$cantidad", cantidad]}]}}}],
+            return_document=ReturnDocument.BEFORE,
+        )
+        liberadas = min(antes.get("cantidad", 0), cantidad) if antes else 0
+
+    if liberadas:
+        get_productos_collection().update_one(
+            {"_id": id_producto},
+            {"$inc": {"inventario.reservado": -liberadas}},
+        )
+        _registrar_movimientos([
+            _movimiento(id_producto, "reserva", -liberadas, "reservado", idUsuarioCliente=id_usuario)
+        ])
+    return liberadas
+
+def ajustar_reservas(id_usuario: ObjectId, deltas: dict) -> None:
+    """
+    Ajusta las reservas del usuario según {id_producto: delta de unidades}.
+    - Primero reserva los aumentos; si alguno no alcanza, deshace los
+      que ya hizo y lanza ValueError (el carrito no se debe tocar).
+    - Luego libera las disminuciones.
+    - Renueva el vencimiento de todas sus reservas (sigue activo).
+    No hace nada si RESERVAS_STOCK_ACTIVAS está apagado.
+    """
+    deltas = {id_producto: delta for id_producto, delta in deltas.items() if delta}
+    if not settings.RESERVAS_STOCK_ACTIVAS or not deltas:
+        return
+
+    expira = datetime.now(timezone.utc) + timedelta(minutes=settings.RESERVA_STOCK_MINUTOS)
+
+    hechas = []
+    for id_producto, delta in deltas.items():
+        if delta <= 0:
+            continue
+        if not _reservar_stock(id_usuario, id_producto, delta, expira):
+            for id_hecho, delta_hecho in hechas:
+                _liberar_reserva(id_usuario, id_hecho, delta_hecho)
+            raise ValueError(
+                "No hay stock disponible: las últimas unidades están reservadas "
+                "en otros carritos. Intenta de nuevo en unos minutos."
+            )
+        hechas.append((id_producto, delta))
+
+    for id_producto, delta in deltas.items():
+        if delta < 0:
+            _liberar_reserva(id_usuario, id_producto, -delta)
+
+    get_reservas_stock_collection().update_many(
+        {"idUsuarioCliente": id_usuario},
+        {"$set": {"expira": expira}},
+    )
+
+def _convertir_reserva_en_venta(
+    id_usuario: ObjectId, id_producto: ObjectId, cantidad: int, id_pedido: ObjectId
+) -> tuple[bool, int]:
+    """
+    Checkout con reservas: toma la reserva del usuario y descuenta
+    stockActual y reservado en un solo $inc, sin releer el stock.
+    Si la reserva venció (o era menor) el resto debe estar disponible:
+    lo exige el filtro. Devuelve (ok, reserva consumida o None); la reserva
+    sirve para restituirla si el checkout falla después.
+    Si no fue posible, la reserva tomada se restituye aquí mismo.
+    """
+    reserva = get_reservas_stock_collection().find_one_and_delete(
+        {"_id": _id_reserva(id_usuario, id_producto)}
+    )
+    reservadas = reserva.get("cantidad", 0) if reserva else 0
+    usadas = min(reservadas, cantidad)
+
+    if usadas == cantidad:
+        filtro = {"_id": id_producto}
+    else:
+        filtro = _filtro_stock_disponible(id_producto, cantidad - usadas)
+
+    res = get_productos_collection().update_one(
+        filtro,
+        _pipeline_inc_inventario({
+            "inventario.stockActual": -cantidad,
+            # lo que sobraba de la reserva también se libera
+            "inventario.reservado": -reservadas,
+        }),
+    )
+    if res.modified_count == 1:
+        _registrar_movimientos([
+            _movimiento(id_producto, "venta", -cantidad, idPedido=id_pedido),
+            _movimiento(id_producto, "venta", -reservadas, "reservado", idPedido=id_pedido),
+        ])
+        return True, reserva
+
+    if reserva:
+        get_reservas_stock_collection().update_one(
+            {"_id": reserva["_id"]},
+            {"$inc": {"cantidad": reservadas}, "$set": {
+                "idUsuarioCliente": id_usuario,
+                "idProducto": id_producto,
+                "expira": reserva.get("expira"),
+            }},
+            upsert=True,
+        )
+    return False, None
+
+def liberar_reservas_usuario(id_usuario: ObjectId) -> int:
+    """
+    Libera todas las reservas del usuario (p. ej. después del checkout,
+    las de los ítems que no compró). Devuelve las unidades liberadas.
+    """
+    reservas = get_reservas_stock_collection().find(
+        {"idUsuarioCliente": id_usuario}, {"idProducto": 1}
+    )
+    return sum(_liberar_reserva(id_usuario, r["idProducto"]) for r in list(reservas))
+
+def liberar_reservas_vencidas(tamano_lote: int = 500) -> int:
+    """
+    Devuelve al stock disponible las reservas vencidas.
+    Cada reserva se toma con find_one_and_delete (si el usuario la renovó
+    entretanto ya no coincide) y los productos se actualizan en lote con
+    un bulk_write de $inc por producto. Devuelve las unidades liberadas.
+    """
+    reservas = get_reservas_stock_collection()
+    total = 0
+
+    while True:
+        ahora = datetime.now(timezone.utc)
+        ids = [
+            r["_id"] for r in
+            reservas.find({"expira": {"$lt": ahora}}, {"_id": 1}).limit(tamano_lote)
+        ]
+        if not ids:
+            return total
+
+        por_producto = {}
+        for id_reserva in ids:
+            reserva = reservas.find_one_and_delete({"_id": id_reserva, "expira": {"$lt": ahora}})
+            if reserva and reserva.get("cantidad", 0) > 0:
+                id_producto = reserva["idProducto"]
+                por_producto[id_producto] = por_producto.get(id_producto, 0) + reserva["cantidad"]
+
+        if por_producto:
+            get_productos_collection().bulk_write([
+                UpdateOne({"_id": id_producto}, {"$inc": {"inventario.reservado": -cantidad}})
+                for id_producto, cantidad in por_producto.items()
+            ], ordered=False)
+            _registrar_movimientos([
+                _movimiento(id_producto, "reserva", -cantidad, "reservado", vencida=True)
+                for id_producto, cantidad in por_producto.items()
+            ])
+            invalidar_inventario(por_producto)
+            total += sum(por_producto.values())
+
+
+# ─────────────────────────────────────────────
+#  COLA DE TRABAJOS (segundo plano)
+# ─────────────────────────────────────────────
+# Lo que no tiene que pasar dentro del request (correos, avisos, rollups...)
+# se encola en Trabajos y lo ejecuta 'python manage.py procesar_trabajos'
+# (ver accounts/trabajos.py).
+#   {tipo, datos, estado: 'pendiente'|'en_proceso'|'hecho'|'fallido',
+#    intentos, maxIntentos, disponibleDesde, bloqueadoHasta, trabajador,
+#    ultimoError, fechaCreacion, fechaActualizacion}
+# Un trabajador lo toma con find_one_and_update y queda "alquilado" hasta
+# bloqueadoHasta; si muere, al vencer el alquiler otro lo vuelve a tomar.
+
+def get_trabajos_collection():
+    """
+    Devuelve la colección Trabajos.
+    """
+    db = get_db()
+    return db["Trabajos"]
+
+def encolar_trabajo(tipo: str, datos: dict, session=None) -> ObjectId:
+    """
+    Encola un trabajo. Con 'session' se inserta dentro de la transacción
+    del llamador: si esta se aborta, el trabajo tampoco existe.
+    """
+    ahora = datetime.now(timezone.utc)
+    res = get_trabajos_collection().insert_one({
+        "tipo": tipo,
+        "datos": datos,
+        "estado": "pendiente",
+        "intentos": 0,
+        "maxIntentos": settings.TRABAJOS_MAX_INTENTOS,
+        "disponibleDesde": ahora,
+        "fechaCreacion": ahora,
+        "fechaActualizacion": ahora,
+    }, session=session)
+    return res.inserted_id
+
+def tipos_trabajo_pausados() -> list[str]:
+    """Tipos de trabajo que no se entregan por ahora (Metadatos._id = 'trabajos')."""
+    doc = get_metadatos_collection().find_one({"_id": "trabajos"}, {"pausados": 1})
+    return doc.get("pausados", []) if doc else []
+
+def pausar_trabajos(tipo: str) -> None:
+    """
+    Deja de entregar los trabajos de 'tipo': siguen encolándose y quedan
+    pendientes hasta reanudar_trabajos(). No detiene los que ya están en curso.
+    """
+    get_metadatos_collection().update_one(
+        {"_id": "trabajos"}, {"$addToSet": {"pausados": tipo}}, upsert=True
+    )
+
+def reanudar_trabajos(tipo: str) -> None:
+    get_metadatos_collection().update_one(
+        {"_id": "trabajos"}, {"$pull": {"pausados": tipo}}
+    )
+
+def _esperar_trabajos_en_curso(tipo: str, segundos: float) -> bool:
+    """
+    Espera hasta 'segundos' a que terminen los trabajos de 'tipo' en curso
+    (con el alquiler vigente). Devuelve False si no terminaron a tiempo.
+    """
+    limite = time.monotonic() + segundos
+    while True:
+        en_curso = get_trabajos_collection().count_documents({
+            "tipo": tipo,
+            "estado": "en_proceso",
+            "bloqueadoHasta": {"$gte": datetime.now(timezone.utc)},
+        })
+        if not en_curso:
+            return True
+        if time.monotonic() >= limite:
+            return False
+        time.sleep(1)
+
+def tomar_trabajo(trabajador: str) -> dict | None:
+    """
+    Toma atómicamente el siguiente trabajo disponible (pendiente, o en
+    proceso con el alquiler vencido) y lo alquila por
+    TRABAJOS_LEASE_SEGUNDOS. Los tipos pausados se saltan.
+    Devuelve None si no hay nada que hacer.
+    """
+    ahora = datetime.now(timezone.utc)
+    filtro = {"$or": [
+        {"estado": "pendiente", "disponibleDesde": {"$lte": ahora}},
+        {"estado": "en_proceso", "bloqueadoHasta": {"$lt": ahora}},
+    ]}
+    pausados = tipos_trabajo_pausados()
+    if pausados:
+        filtro["tipo"] = {"$nin": pausados}
+
+    return get_trabajos_collection().find_one_and_update(
+        filtro,
+        {
+            "$set": {
+                "estado": "en_proceso",
+                "trabajador": trabajador,
+                "bloqueadoHasta": ahora + timedelta(seconds=settings.TRABAJOS_LEASE_SEGUNDOS),
+                "fechaActualizacion": ahora,
+            },
+            "$inc": {"intentos": 1},
+        },
+        sort=[("disponibleDesde", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+def completar_trabajo(trabajo: dict) -> bool:
+    """
+    Marca el trabajo como 'hecho'. Devuelve False si el alquiler ya había
+    vencido y otro trabajador lo tomó.
+    """
+    res = get_trabajos_collection().update_one(
+        {"_id": trabajo["_id"], "estado": "en_proceso", "trabajador": trabajo["trabajador"]},
+        {
+            "$set": {"estado": "hecho", "fechaActualizacion": datetime.now(timezone.utc)},
+            "$unset": {"bloqueadoHasta": ""},
+        },
+    )
+    return res.modified_count == 1
+
+def fallar_trabajo(trabajo: dict, error: str) -> str:
+    """
+    Registra un intento fallido. Si quedan intentos vuelve a 'pendiente'
+    con espera exponencial (30 s, 1 min, 2 min... máx. 1 h); si no,
+    queda 'fallido'. Devuelve el nuevo estado.
+    """
+    ahora = datetime.now(timezone.utc)
+    intentos = trabajo.get("intentos", 1)
+    if intentos >= trabajo.get("maxIntentos", settings.TRABAJOS_MAX_INTENTOS):
+        estado, cambios = "fallido", {}
+    else:
+        espera = min(30 * 2 ** (intentos - 1), 3600)
+        estado, cambios = "pendiente", {"disponibleDesde": ahora + timedelta(seconds=espera)}
+
+    get_trabajos_collection().update_one(
+        {"_id": trabajo["_id"], "estado": "en_proceso", "trabajador": trabajo["trabajador"]},
+        {
+            "$set": {
+                "estado": estado,
+                "ultimoError": error[:1000],
+                "fechaActualizacion": ahora,
+                **cambios,
+            },
+            "$unset": {"bloqueadoHasta": ""},
+        },
+    )
+    return estado
+
+
+# ─────────────────────────────────────────────
+#  RETENCIÓN DE CARRITOS
+# ─────────────────────────────────────────────
+# - 'convertido': el pedido ya guarda su propio snapshot de ítems, así que
+#   el carrito se mueve por lotes a CarritosArchivados (o se borra).
+# - 'abierto' abandonado: lo borra Mongo con el índice TTL de
+#   asegurar_indices(); antes se puede exportar para marketing.
+
+def get_carritos_archivados_collection():
+    """
+    Devuelve la colección CarritosArchivados (carritos ya convertidos).
+    """
+    db = get_db()
+    return db["CarritosArchivados"]
+
+def archivar_carritos_convertidos(tamano_lote: int = 500, archivar: bool = True) -> int:
+    """
+    Saca de Carritos los carritos 'convertido', de a 'tamano_lote':
+    - archivar=True: los copia a CarritosArchivados y luego los borra.
+    - archivar=False: solo los borra (el pedido ya tiene el detalle).
+    Es reanudable: si se corta a mitad de un lote, al repetirlo los
+    duplicados del archivo se ignoran. Devuelve cuántos carritos movió.
+    """
+    carritos = get_carritos_collection()
+    archivados = get_carritos_archivados_collection()
+    total = 0
+
+    while True:
+        lote = list(
+            carritos.find({"estadoCarrito": "convertido"})
+            .sort("_id", 1)
+            .limit(tamano_lote)
+        )
+        if not lote:
+            return total
+
+        if archivar:
+            ahora = datetime.now(timezone.utc)
+            for carrito in lote:
+                carrito["fechaArchivado"] = ahora
+            try:
+                archivados.insert_many(lote, ordered=False)
+            except errors.BulkWriteError as e:
+                # Solo se toleran duplicados (lote ya copiado en una corrida anterior)
+                if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+
+        res = carritos.delete_many({
+            "_id": {"$in": [carrito["_id"] for carrito in lote]},
+            "estadoCarrito": "convertido",
+        })
+        total += res.deleted_count
+
+def carritos_por_expirar(dias_antes: int) -> list[dict]:
+    """
+    Carritos abiertos con ítems que el índice TTL borrará dentro de los
+    próximos 'dias_antes' días, con el correo y nombre del usuario
+    (una consulta a Carritos y una $in a Usuarios).
+    """
+    ahora = datetime.now(timezone.utc)
+    vencen = ahora - timedelta(days=settings.CARRITO_ABANDONADO_DIAS)
+
+    carritos = list(get_carritos_collection().find(
+        {
+            "estadoCarrito": "abierto",
+            "itemsCarrito.0": {"$exists": True},
+            "fechaActualizacionCarrito": {
+                "$gte": vencen,
+                "$lt": vencen + timedelta(days=dias_antes),
+            },
+        },
+        {
+            "idUsuarioCliente": 1,
+            "itemsCarrito.idProducto": 1,
+            "itemsCarrito.nombreProducto": 1,
+            "itemsCarrito.cantidad": 1,
+            "totalSeleccionadoSnapshot": 1,
+            "fechaActualizacionCarrito": 1,
+        },
+    ))
+
+    ids_usuario = list({c["idUsuarioCliente"] for c in carritos})
+    usuarios = {
+        u["_id"]: u
+        for u in get_usuarios_collection().find(
+            {"_id": {"$in": ids_usuario}},
+            {"correoElectronico": 1, "nombres": 1},
+        )
+    }
+
+    for carrito in carritos:
+        carrito["usuario"] = usuarios.get(carrito["idUsuarioCliente"], {})
+    return carritos
+
+
+# ─────────────────────────────────────────────
+#  ÍNDICES
+# ─────────────────────────────────────────────
+
+def _asegurar_indice_ttl(col, campo: str, nombre: str, segundos: int, filtro: dict | None = None) -> str:
+    """
+    Crea un índice TTL (parcial si se da 'filtro'). Si ya existía con otro
+    expireAfterSeconds (cambió la configuración) lo ajusta con collMod en
+    vez de fallar.
+    """
+    opciones = {"partialFilterExpression": filtro} if filtro else {}
+    try:
+        return col.create_index(
+            [(campo, ASCENDING)],
+            name=nombre,
+            expireAfterSeconds=segundos,
+            **opciones,
+        )
+    except errors.OperationFailure as e:
+        if e.code not in (85, 86):  # IndexOptionsConflict / IndexKeySpecsConflict
+            raise
+        col.database.command(
+            "collMod", col.name, index={"name": nombre, "expireAfterSeconds": segundos}
+        )
+        return nombre
+
+def asegurar_indices() -> list[str]:
+    """
+    Crea (si no existen) los índices que necesita la app.
+    Es idempotente: se ejecuta con 'python manage.py crear_indices'
+    en cada despliegue. Devuelve los nombres de los índices.
+    """
+    carritos = get_carritos_collection()
+
+    return [
+        # Máximo un carrito abierto por usuario (los convertidos no cuentan)
+        carritos.create_index(
+            [("idUsuarioCliente", ASCENDING)],
+            name="carrito_abierto_unico_por_usuario",
+            unique=True,
+            partialFilterExpression={"estadoCarrito": "abierto"},
+        ),
+        # Carritos abiertos abandonados: Mongo los borra solo tras
+        # CARRITO_ABANDONADO_DIAS sin cambios (ver exportar_carritos_por_expirar)
+        _asegurar_indice_ttl(
+            carritos,
+            "fechaActualizacionCarrito",
+            "carrito_abandonado_ttl",
+            settings.CARRITO_ABANDONADO_DIAS * 24 * 60 * 60,
+            {"estadoCarrito": "abierto"},
+        ),
+        # Archivado por lotes de los carritos convertidos
+        carritos.create_index(
+            [("estadoCarrito", ASCENDING), ("_id", ASCENDING)],
+            name="carrito_estado_id",
+        ),
+        # Barrido de reservas de stock vencidas (liberar_reservas_vencidas)
+        get_reservas_stock_collection().create_index(
+            [("expira", ASCENDING)],
+            name="reserva_stock_expira",
+        ),
+        get_reservas_stock_collection().create_index(
+            [("idUsuarioCliente", ASCENDING)],
+            name="reserva_stock_usuario",
+        ),
+        # Claves de idempotencia del checkout: caducan solas
+        _asegurar_indice_ttl(
+            get_claves_idempotencia_collection(),
+            "fechaCreacion",
+            "clave_idempotencia_ttl",
+            settings.IDEMPOTENCIA_CHECKOUT_HORAS * 60 * 60,
+        ),
+        # Historial de pedidos (keyset), con y sin filtro de estado
+        get_pedidos_collection().create_index(
+            [("idUsuarioCliente", ASCENDING), ("fechaCreacionPedido", DESCENDING), ("_id", DESCENDING)],
+            name="pedido_usuario_fecha",
+        ),
+        get_pedidos_collection().create_index(
+            [
+                ("idUsuarioCliente", ASCENDING),
+                ("estadoPedido", ASCENDING),
+                ("fechaCreacionPedido", DESCENDING),
+                ("_id", DESCENDING),
+            ],
+            name="pedido_usuario_estado_fecha",
+        ),
+        # Lista de reposición: solo entran los marcados con bajoStock
+        get_productos_collection().create_index(
+            [("estadoProducto", ASCENDING), ("nombreProducto", ASCENDING)],
+            name="producto_bajo_stock",
+            partialFilterExpression={"inventario.bajoStock": True},
+        ),
+        # Libro de inventario: auditoría por producto y compactación por fecha
+        get_movimientos_inventario_collection().create_index(
+            [("idProducto", ASCENDING), ("fecha", ASCENDING)],
+            name="movimiento_producto_fecha",
+        ),
+        get_movimientos_inventario_collection().create_index(
+            [("fecha", ASCENDING)],
+            name="movimiento_fecha",
+        ),
+        get_saldos_inventario_collection().create_index(
+            [("idProducto", ASCENDING), ("dia", ASCENDING)],
+            name="saldo_producto_dia",
+        ),
+        # Pedidos de todos los clientes (panel de administración)
+        get_pedidos_collection().create_index(
+            [("fechaCreacionPedido", DESCENDING), ("_id", DESCENDING)],
+            name="pedido_fecha",
+        ),
+        get_pedidos_collection().create_index(
+            [("estadoPedido", ASCENDING), ("fechaCreacionPedido", DESCENDING), ("_id", DESCENDING)],
+            name="pedido_estado_fecha",
+        ),
+        # Resúmenes de ventas: un documento por (semana, producto)
+        _indice_resumen_productos(get_resumen_ventas_collection("ResumenVentasProductos")),
+        # Cola de trabajos: lo que tomar_trabajo busca, y limpieza de los hechos
+        get_trabajos_collection().create_index(
+            [("estado", ASCENDING), ("disponibleDesde", ASCENDING)],
+            name="trabajo_estado_disponible",
+        ),
+        _asegurar_indice_ttl(
+            get_trabajos_collection(),
+            "fechaActualizacion",
+            "trabajo_hecho_ttl",
+            settings.TRABAJOS_HECHOS_DIAS * 24 * 60 * 60,
+            {"estado": "hecho"},
+        ),
+    ]
@@ -0,0 +1,223 @@
+# accounts/registros.py
+"""
+Registros livianos (dataclasses con __slots__) para lo que se guarda en
+memoria y se pinta en los templates: catálogo, carrito, direcciones y pedidos
+(detalle e historial).
+
+Los nombres de atributo son los mismos campos de Mongo, así que los templates
+siguen usando {{ p.nombreProducto }}, {{ p.inventario.precioVenta }}, etc.
+El 'id' en string se calcula una sola vez y solo si alguien lo pide.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from bson import ObjectId
+
+
+class _ConIdTexto:
+    """
+    Mezcla para los registros con '_id': expone 'id' (str) de forma perezosa.
+    La clase hija debe declarar los campos '_id' y '_id_texto'.
+    """
+    __slots__ = ()
+
+    @property
+    def id(self) -> str:
+        texto = self._id_texto
+        if texto is None:
+            texto = self._id_texto = str(self._id)
+        return texto
+
+
+@dataclass(slots=True)
+class Inventario:
+    stockActual: int = 0
+    stockMinimo: int = 0
+    precioVenta: float | None = None
+
+    @classmethod
+    def desde_bson(cls, doc: dict | None) -> "Inventario":
+        doc = doc or {}
+        return cls(
+            doc.get("stockActual", 0),
+            doc.get("stockMinimo", 0),
+            doc.get("precioVenta"),
+        )
+
+
+@dataclass(slots=True)
+class Producto(_ConIdTexto):
+    _id: ObjectId
+    nombreProducto: str = ""
+    descripcionCortaProducto: str = ""
+    marcaProducto: str = ""
+    unidadMedidaProducto: str = ""
+    estadoProducto: str = ""
+    imagenUrl: str = ""
+    inventario: Inventario | None = None
+    _id_texto: str | None = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def desde_bson(cls, doc: dict) -> "Producto":
+        inventario = doc.get("inventario")
+        return cls(
+            doc["_id"],
+            doc.get("nombreProducto", ""),
+            doc.get("descripcionCortaProducto", ""),
+            doc.get("marcaProducto", ""),
+            doc.get("unidadMedidaProducto", ""),
+            doc.get("estadoProducto", ""),
+            doc.get("imagenUrl", ""),
+            Inventario.desde_bson(inventario) if inventario is not None else None,
+        )
+
+
+@dataclass(slots=True)
+class ItemCarrito:
+    idProducto: ObjectId
+    nombreProducto: str = ""
+    cantidad: int = 0
+    precioUnitarioSnapshot: float = 0
+    subtotalLineaSnapshot: float = 0
+    seleccionado: bool = True
+    _idProducto_texto: str | None = field(default=None, repr=False, compare=False)
+
+    @property
+    def idProductoTexto(self) -> str:
+        texto = self._idProducto_texto
+        if texto is None:
+            texto = self._idProducto_texto = str(self.idProducto)
+        return texto
+
+    @classmethod
+    def desde_bson(cls, doc: dict) -> "ItemCarrito":
+        return cls(
+            doc.get("idProducto"),
+            doc.get("nombreProducto", ""),
+            doc.get("cantidad", 0),
+            doc.get("precioUnitarioSnapshot", 0),
+            doc.get("subtotalLineaSnapshot", 0),
+            doc.get("seleccionado", True),
+        )
+
+
+@dataclass(slots=True)
+class Carrito(_ConIdTexto):
+    _id: ObjectId
+    idUsuarioCliente: ObjectId | None = None
+    estadoCarrito: str = "abierto"
+    itemsCarrito: list[ItemCarrito] = field(default_factory=list)
+    subtotalCarritoSnapshot: float = 0
+    subtotalSeleccionadoSnapshot: float = 0
+    totalSeleccionadoSnapshot: float = 0
+    fechaActualizacionCarrito: datetime | None = None
+    _id_texto: str | None = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def desde_bson(cls, doc: dict) -> "Carrito":
+        return cls(
+            doc["_id"],
+            doc.get("idUsuarioCliente"),
+            doc.get("estadoCarrito", "abierto"),
+            [ItemCarrito.desde_bson(it) for it in doc.get("itemsCarrito", [])],
+            doc.get("subtotalCarritoSnapshot", 0),
+            doc.get("subtotalSeleccionadoSnapshot", 0),
+            doc.get("totalSeleccionadoSnapshot", 0),
+            doc.get("fechaActualizacionCarrito"),
+        )
+
+
+@dataclass(slots=True)
+class Direccion(_ConIdTexto):
+    _id: ObjectId
+    nombreContacto: str = ""
+    telefonoContacto: str = ""
+    ciudad: str = ""
+    barrio: str = ""
+    complemento: str = ""
+    esPrincipal: bool = False
+    _id_texto: str | None = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def desde_bson(cls, doc: dict) -> "Direccion":
+        return cls(
+            doc["_id"],
+            doc.get("nombreContacto", ""),
+            doc.get("telefonoContacto", ""),
+            doc.get("ciudad", ""),
+            doc.get("barrio", ""),
+            doc.get("complemento", ""),
+            doc.get("esPrincipal", False),
+        )
+
+
+@dataclass(slots=True)
+class ItemPedido:
+    idProducto: ObjectId | None = None
+    nombreProducto: str = ""
+    cantidad: int = 0
+    precioUnitario: float = 0
+    subtotalLinea: float = 0
+
+    @classmethod
+    def desde_bson(cls, doc: dict) -> "ItemPedido":
+        return cls(
+            doc.get("idProducto"),
+            doc.get("nombreProducto", ""),
+            doc.get("cantidad", 0),
+            doc.get("precioUnitario", 0),
+            doc.get("subtotalLinea", 0),
+        )
+
+
+@dataclass(slots=True)
+class Pedido(_ConIdTexto):
+    _id: ObjectId
+    idUsuarioCliente: ObjectId | None = None
+    itemsPedido: list[ItemPedido] = field(default_factory=list)
+    fechaCreacionPedido: datetime | None = None
+    estadoPedido: str = ""
+    subtotalPedido: float = 0
+    costoEnvioPedido: float = 0
+    totalPedido: float = 0
+    metodoEntrega: str = ""
+    metodoPago: str = ""
+    direccionEnvioSnapshot: dict | None = None
+    _id_texto: str | None = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def desde_bson(cls, doc: dict) -> "Pedido":
+        return cls(
+            doc["_id"],
+            doc.get("idUsuarioCliente"),
+            [ItemPedido.desde_bson(it) for it in doc.get("itemsPedido", [])],
+            doc.get("fechaCreacionPedido"),
+            doc.get("estadoPedido", ""),
+            doc.get("subtotalPedido", 0),
+            doc.get("costoEnvioPedido", 0),
+            doc.get("totalPedido", 0),
+            doc.get("metodoEntrega", ""),
+            doc.get("metodoPago", ""),
+            doc.get("direccionEnvioSnapshot"),
+        )
+
+
+@dataclass(slots=True)
+class PedidoResumen(_ConIdTexto):
+    """Fila del historial de pedidos: sin las líneas, solo cuántas son."""
+    _id: ObjectId
+    fechaCreacionPedido: datetime | None = None
+    estadoPedido: str = ""
+    totalPedido: float = 0
+    cantidadItems: int = 0
+    _id_texto: str | None = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def desde_bson(cls, doc: dict) -> "PedidoResumen":
+        return cls(
+            doc["_id"],
+            doc.get("fechaCreacionPedido"),
+            doc.get("estadoPedido", ""),
+            doc.get("totalPedido", 0),
+            doc.get("cantidadItems", 0),
+        )
@@ -0,0 +1,103 @@
+# accounts/storage.py
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional: sin él solo se generan los .gz
+    brotli = None
+
+# Minificadores (requirements.txt). Si no están instalados los .css/.js
+# se copian tal cual: mejor sin minificar que un minificador a mano que
+# rompa cadenas o comentarios.
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+# Extensiones de texto que vale la pena comprimir (las imágenes ya vienen comprimidas)
+EXTENSIONES_COMPRIMIBLES = (".css", ".js", ".svg", ".txt", ".html", ".json", ".map")
+
+
+def minificar_css(contenido: str) -> str:
+    """Minifica con 'rcssmin'; sin él devuelve el CSS sin cambios."""
+    if rcssmin is None:
+        return contenido
+    return rcssmin.cssmin(contenido)
+
+
+def minificar_js(contenido: str) -> str:
+    """Minifica con 'rjsmin'; sin él devuelve el JS sin cambios."""
+    if rjsmin is None:
+        return contenido
+    return rjsmin.jsmin(contenido)
+
+
+class ManifestComprimidoStorage(ManifestStaticFilesStorage):
+    """
+    Storage de archivos estáticos para producción (collectstatic):
+    - Minifica los .css y .js antes de calcular el hash.
+    - Genera nombres con hash de contenido + staticfiles.json (manifest).
+    - Deja junto a cada archivo de texto sus versiones .gz y .br
+      para servirlas sin comprimir en cada petición.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        if dry_run:
+            yield from super().post_process(paths, dry_run=dry_run, **options)
+            return
+
+        # 1. Minificar la copia en STATIC_ROOT (nunca los fuentes de static/)
+        #    y hacer que el hash se calcule sobre esa copia minificada.
+        for nombre in list(paths):
+            if nombre.endswith(".css"):
+                self._reescribir(nombre, minificar_css)
+            elif nombre.endswith(".js"):
+                self._reescribir(nombre, minificar_js)
+            else:
+                continue
+            paths[nombre] = (self, nombre)
+
+        # 2. Hash de contenido + manifest
+        procesados = []
+        for original, hasheado, procesado in super().post_process(paths, dry_run=dry_run, **options):
+            if hasheado and not isinstance(procesado, Exception):
+                procesados.append(hasheado)
+            yield original, hasheado, procesado
+
+        # 3. Pre-compresión de los archivos con hash
+        for nombre in procesados:
+            if nombre.endswith(EXTENSIONES_COMPRIMIBLES):
+                self._comprimir(nombre)
+
+    def _reescribir(self, nombre: str, minificador) -> None:
+        with self.open(nombre) as f:
+            contenido = f.read().decode("utf-8")
+        minificado = minificador(contenido)
+        self.delete(nombre)
+        self._save(nombre, ContentFile(minificado.encode("utf-8")))
+
+    def _comprimir(self, nombre: str) -> None:
+        with self.open(nombre) as f:
+            contenido = f.read()
+
+        variantes = [(".gz", gzip.compress(contenido, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variantes.append((".br", brotli.compress(contenido)))
+
+        for sufijo, comprimido in variantes:
+            # Solo vale la pena si realmente ahorra bytes
+            if len(comprimido) >= len(contenido):
+                continue
+            destino = nombre + sufijo
+            if self.exists(destino):
+                self.delete(destino)
+            self._save(destino, ContentFile(comprimido))
@@ -1,3 +1,686 @@
-from django.test import TestCase
+import json
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-# Create your tests here.
+from bson import ObjectId
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from pymongo import UpdateOne
+
+from . import carrito_invitado, mongo_service, trabajos
+from .views import _fecha_filtro
+
+
+# ─────────────────────────────────────────────
+#  HISTORIAL DE PEDIDOS: cursor y filtros (sin Mongo)
+# ─────────────────────────────────────────────
+
+class CursorPedidoTests(SimpleTestCase):
+
+    def test_ida_y_vuelta(self):
+        fecha = datetime(2026, 3, 5, 14, 30, 12, 345000, tzinfo=timezone.utc)
+        id_pedido = ObjectId()
+        cursor = mongo_service._cursor_pedido(fecha, id_pedido)
+        self.assertEqual(mongo_service._leer_cursor_pedido(cursor), (fecha, id_pedido))
+
+    def test_fecha_sin_zona_se_toma_como_utc(self):
+        # pymongo sin tz_aware devuelve fechas naive (en UTC)
+        id_pedido = ObjectId()
+        naive = datetime(2026, 3, 5, 14, 30)
+        self.assertEqual(
+            mongo_service._cursor_pedido(naive, id_pedido),
+            mongo_service._cursor_pedido(naive.replace(tzinfo=timezone.utc), id_pedido),
+        )
+
+    def test_cursor_invalido(self):
+        for cursor in ("", "abc", "12_no-es-id", f"x_{ObjectId()}"):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    mongo_service._leer_cursor_pedido(cursor)
+
+
+class FiltroPaginaPedidosTests(SimpleTestCase):
+
+    def setUp(self):
+        self.base = {"idUsuarioCliente": ObjectId()}
+
+    def test_sin_opciones_es_el_filtro_base(self):
+        filtro = mongo_service._filtro_pagina_pedidos(self.base)
+        self.assertEqual(filtro, self.base)
+        self.assertIsNot(filtro, self.base)
+
+    def test_estado(self):
+        filtro = mongo_service._filtro_pagina_pedidos(self.base, estado="enviado")
+        self.assertEqual(filtro["estadoPedido"], "enviado")
+
+    def test_estado_invalido(self):
+        with self.assertRaises(ValueError):
+            mongo_service._filtro_pagina_pedidos(self.base, estado="perdido")
+
+    def test_rango_desde_incluido_hasta_excluido(self):
+        desde = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        hasta = datetime(2026, 2, 1, tzinfo=timezone.utc)
+        filtro = mongo_service._filtro_pagina_pedidos(self.base, desde=desde, hasta=hasta)
+        self.assertEqual(filtro["fechaCreacionPedido"], {"$gte": desde, "$lt": hasta})
+
+        solo_desde = mongo_service._filtro_pagina_pedidos(self.base, desde=desde)
+        self.assertEqual(solo_desde["fechaCreacionPedido"], {"$gte": desde})
+
+    def test_continuacion_desde_el_cursor(self):
+        fecha = datetime(2026, 3, 5, 14, 30, tzinfo=timezone.utc)
+        id_pedido = ObjectId()
+        cursor = mongo_service._cursor_pedido(fecha, id_pedido)
+
+        filtro = mongo_service._filtro_pagina_pedidos(self.base, despues_de=cursor)
+        # Más viejos que la última fila, o misma fecha y _id menor (desempate)
+        self.assertEqual(filtro["$or"], [
+            {"fechaCreacionPedido": {"$lt": fecha}},
+            {"fechaCreacionPedido": fecha, "_id": {"$lt": id_pedido}},
+        ])
+        self.assertEqual(filtro["idUsuarioCliente"], self.base["idUsuarioCliente"])
+
+    def test_cursor_y_rango_se_combinan(self):
+        desde = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        cursor = mongo_service._cursor_pedido(datetime(2026, 3, 5, tzinfo=timezone.utc), ObjectId())
+        filtro = mongo_service._filtro_pagina_pedidos(self.base, despues_de=cursor, desde=desde)
+        self.assertEqual(filtro["fechaCreacionPedido"], {"$gte": desde})
+        self.assertEqual(len(filtro["$or"]), 2)
+
+
+class FechaFiltroTests(SimpleTestCase):
+
+    def test_fecha_del_formulario(self):
+        self.assertEqual(_fecha_filtro("2026-03-05"), datetime(2026, 3, 5, tzinfo=timezone.utc))
+
+    def test_vacia(self):
+        self.assertIsNone(_fecha_filtro(""))
+
+    def test_invalida(self):
+        with self.assertRaises(ValueError):
+            _fecha_filtro("05/03/2026")
+
+
+# ─────────────────────────────────────────────
+#  RESÚMENES DE VENTAS: aportes de un pedido (sin Mongo)
+# ─────────────────────────────────────────────
+
+class AportesResumenVentasTests(SimpleTestCase):
+
+    def setUp(self):
+        self.martillo, self.taladro = ObjectId(), ObjectId()
+        # Miércoles 4 de marzo de 2026 → semana del lunes 2
+        self.pedido = {
+            "fechaCreacionPedido": datetime(2026, 3, 4, 18, 45),
+            "totalPedido": 350.0,
+            "metodoPago": "efectivo",
+            "metodoEntrega": "domicilio",
+            "itemsPedido": [
+                {"idProducto": self.martillo, "nombreProducto": "Martillo", "cantidad": 2, "subtotalLinea": 150.0},
+                {"idProducto": self.taladro, "nombreProducto": "Taladro", "cantidad": 1, "subtotalLinea": 200.0},
+            ],
+        }
+        self.dia = datetime(2026, 3, 4, tzinfo=timezone.utc)
+        self.semana = datetime(2026, 3, 2, tzinfo=timezone.utc)
+
+    def _transicion(self, anterior, actual) -> dict:
+        """{(colección, clave): incrementos sin ceros} de pasar de 'anterior' a 'actual'."""
+        acumulado = {}
+        mongo_service._sumar_pedido_a_resumenes(acumulado, self.pedido, anterior, -1)
+        mongo_service._sumar_pedido_a_resumenes(acumulado, self.pedido, actual, 1)
+        netos = {}
+        for clave, entrada in acumulado.items():
+            incrementos = {campo: valor for campo, valor in entrada["inc"].items() if valor}
+            if incrementos:
+                netos[clave] = incrementos
+        return netos
+
+    def test_inicio_semana_es_lunes(self):
+        self.assertEqual(mongo_service._inicio_semana(self.pedido["fechaCreacionPedido"]), self.semana)
+        self.assertEqual(mongo_service._inicio_semana(self.semana + timedelta(days=6, hours=23)), self.semana)
+
+    def test_creacion(self):
+        netos = self._transicion(None, "pendiente")
+        generales = {"pedidos": 1, "porEstado.pendiente": 1, "ingresos": 350.0, "unidades": 3}
+        self.assertEqual(netos[("ResumenVentasDiarias", self.dia)], generales)
+        self.assertEqual(netos[("ResumenVentasSemanales", self.semana)], generales)
+        self.assertEqual(
+            netos[("ResumenVentasProductos", (self.semana, self.martillo))],
+            {"unidades": 2, "ingresos": 150.0},
+        )
+        self.assertEqual(
+            netos[("ResumenVentasMetodos", ("metodoPago", "efectivo"))],
+            {"pedidos": 1, "ingresos": 350.0},
+        )
+
+    def test_cambio_entre_estados_vigentes_solo_mueve_por_estado(self):
+        netos = self._transicion("pendiente", "pagado")
+        esperado = {"porEstado.pendiente": -1, "porEstado.pagado": 1}
+        self.assertEqual(netos, {
+            ("ResumenVentasDiarias", self.dia): esperado,
+            ("ResumenVentasSemanales", self.semana): esperado,
+        })
+
+    def test_cancelar_resta_ingresos_unidades_productos_y_metodos(self):
+        netos = self._transicion("pagado", "cancelado")
+        self.assertEqual(netos[("ResumenVentasDiarias", self.dia)], {
+            "porEstado.pagado": -1, "porEstado.cancelado": 1,
+            "ingresos": -350.0, "unidades": -3,
+        })
+        self.assertEqual(
+            netos[("ResumenVentasProductos", (self.semana, self.taladro))],
+            {"unidades": -1, "ingresos": -200.0},
+        )
+        self.assertEqual(
+            netos[("ResumenVentasMetodos", ("metodoEntrega", "domicilio"))],
+            {"pedidos": -1, "ingresos": -350.0},
+        )
+
+    def test_creado_ya_cancelado_solo_cuenta_el_pedido(self):
+        netos = self._transicion(None, "cancelado")
+        self.assertEqual(netos, {
+            ("ResumenVentasDiarias", self.dia): {"pedidos": 1, "porEstado.cancelado": 1},
+            ("ResumenVentasSemanales", self.semana): {"pedidos": 1, "porEstado.cancelado": 1},
+        })
+
+    def test_mismo_estado_no_cambia_nada(self):
+        self.assertEqual(self._transicion("enviado", "enviado"), {})
+
+
+class PausaReconstruccionResumenesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.trabajos = mock.MagicMock()
+        for objetivo, valor in (
+            ("get_trabajos_collection", mock.Mock(return_value=self.trabajos)),
+            ("tipos_trabajo_pausados", mock.Mock(return_value=["resumen_pedido"])),
+            ("pausar_trabajos", mock.Mock()),
+            ("reanudar_trabajos", mock.Mock()),
+            ("actualizar_resumenes_pedido", mock.Mock()),
+        ):
+            parche = mock.patch.object(mongo_service, objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def test_tomar_trabajo_salta_los_tipos_pausados(self):
+        mongo_service.tomar_trabajo("w1")
+        (filtro, _), _ = self.trabajos.find_one_and_update.call_args
+        self.assertEqual(filtro["tipo"], {"$nin": ["resumen_pedido"]})
+
+    def test_trabajo_tomado_antes_de_la_pausa_no_escribe(self):
+        with self.assertRaises(RuntimeError):
+            trabajos.resumir_pedido({"idPedido": ObjectId()})
+        mongo_service.actualizar_resumenes_pedido.assert_not_called()
+
+    def test_reconstruccion_no_empieza_con_trabajos_en_curso(self):
+        with mock.patch.object(mongo_service, "_esperar_trabajos_en_curso", return_value=False), \
+                mock.patch.object(mongo_service, "get_db") as get_db:
+            with self.assertRaises(RuntimeError):
+                mongo_service.reconstruir_resumenes_ventas()
+        mongo_service.pausar_trabajos.assert_called_once_with("resumen_pedido")
+        get_db.assert_not_called()
+        # La pausa se mantiene hasta que una reconstrucción termine bien
+        mongo_service.reanudar_trabajos.assert_not_called()
+
+
+# ─────────────────────────────────────────────
+#  CHECKOUT: descuento condicionado de stock (colección simulada)
+# ─────────────────────────────────────────────
+
+@override_settings(RESERVAS_STOCK_ACTIVAS=False)
+class DescuentoStockCheckoutTests(SimpleTestCase):
+
+    def setUp(self):
+        self.usuario, self.pedido = ObjectId(), ObjectId()
+        self.lineas = [(ObjectId(), 2), (ObjectId(), 1), (ObjectId(), 5)]
+        self.productos = mock.MagicMock()
+        for objetivo, valor in (
+            ("get_productos_collection", mock.Mock(return_value=self.productos)),
+            ("_registrar_movimientos", mock.Mock()),
+            ("invalidar_inventario", mock.Mock()),
+        ):
+            parche = mock.patch.object(mongo_service, objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def test_filtro_de_una_linea_exige_el_stock(self):
+        id_producto, cantidad = self.lineas[0]
+        self.productos.bulk_write.return_value = mock.Mock(matched_count=1)
+
+        mongo_service._descontar_stock_checkout(self.usuario, [(id_producto, cantidad)], None, self.pedido)
+
+        (operaciones,), _ = self.productos.bulk_write.call_args
+        self.assertEqual(operaciones, [UpdateOne(
+            {"_id": id_producto, "inventario.stockActual": {"$gte": cantidad}},
+            mongo_service._pipeline_inc_inventario({"inventario.stockActual": -cantidad}),
+        )])
+        mongo_service._registrar_movimientos.assert_called_once()
+
+    def test_linea_sin_stock_aborta_el_bulk_write(self):
+        # Dos de tres coinciden: la transacción se aborta y no hay movimientos
+        self.productos.bulk_write.return_value = mock.Mock(matched_count=2)
+
+        with self.assertRaises(ValueError):
+            mongo_service._descontar_stock_checkout(self.usuario, self.lineas, None, self.pedido)
+        mongo_service._registrar_movimientos.assert_not_called()
+
+    def test_sin_transacciones_deshace_lo_descontado_si_falla_la_n_esima(self):
+        self.productos.update_one.side_effect = [
+            mock.Mock(modified_count=1), mock.Mock(modified_count=1), mock.Mock(modified_count=0),
+        ]
+
+        with self.assertRaises(ValueError):
+            mongo_service._descontar_stock_por_linea(self.usuario, self.lineas, self.pedido)
+
+        # Cada línea con su propio filtro condicionado
+        filtros = [args[0] for args, _ in self.productos.update_one.call_args_list]
+        self.assertEqual(filtros, [
+            {"_id": id_producto, "inventario.stockActual": {"$gte": cantidad}}
+            for id_producto, cantidad in self.lineas
+        ])
+        # Se devuelven solo las dos primeras, con un 'ajuste' en el libro
+        (devoluciones,), _ = self.productos.bulk_write.call_args
+        self.assertEqual(devoluciones, [
+            UpdateOne({"_id": id_producto}, mongo_service._pipeline_inc_inventario({"inventario.stockActual": cantidad}))
+            for id_producto, cantidad in self.lineas[:2]
+        ])
+        (ajustes,), _ = mongo_service._registrar_movimientos.call_args
+        self.assertEqual(
+            [(m["idProducto"], m["tipo"], m["delta"]) for m in ajustes],
+            [(id_producto, "ajuste", cantidad) for id_producto, cantidad in self.lineas[:2]],
+        )
+
+    def test_sin_transacciones_todo_descontado(self):
+        self.productos.update_one.return_value = mock.Mock(modified_count=1)
+
+        descontados, reservas = mongo_service._descontar_stock_por_linea(self.usuario, self.lineas, self.pedido)
+
+        self.assertEqual(descontados, self.lineas)
+        self.assertEqual(reservas, [])
+        self.productos.bulk_write.assert_not_called()
+
+
+# ─────────────────────────────────────────────
+#  CHECKOUT IDEMPOTENTE: claves y reenvíos (colección simulada)
+# ─────────────────────────────────────────────
+
+class ClaveIdempotenciaTests(SimpleTestCase):
+
+    def setUp(self):
+        self.usuario = ObjectId()
+        self.clave = "a" * 32
+        self.id_clave = f"{self.usuario}:{self.clave}"
+        self.claves = mock.MagicMock()
+        self.pedidos = mock.MagicMock()
+        self.crear = mock.Mock(return_value={"_id": ObjectId()})
+        for objetivo, valor in (
+            ("get_claves_idempotencia_collection", mock.Mock(return_value=self.claves)),
+            ("get_pedidos_collection", mock.Mock(return_value=self.pedidos)),
+            ("_crear_pedido_desde_carrito", self.crear),
+        ):
+            parche = mock.patch.object(mongo_service, objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def _checkout(self):
+        return mongo_service.crear_pedido_desde_carrito(
+            str(self.usuario), "domicilio", "efectivo", clave_idempotencia=self.clave
+        )
+
+    def _ya_existe(self, previa: dict | None, retomada: dict | None = None):
+        self.claves.insert_one.side_effect = mongo_service.errors.DuplicateKeyError("E11000")
+        self.claves.find_one_and_update.return_value = retomada
+        self.claves.find_one.return_value = previa
+
+    def test_clave_nueva_crea_el_pedido_con_alquiler(self):
+        pedido = self._checkout()
+
+        self.assertIs(pedido, self.crear.return_value)
+        (doc,), _ = self.claves.insert_one.call_args
+        self.assertEqual(doc["estado"], "en_proceso")
+        self.assertGreater(doc["expiraProceso"], doc["fechaCreacion"])
+        self.assertEqual(self.crear.call_args.args[-1], self.id_clave)
+
+    def test_reenvio_completado_devuelve_el_mismo_pedido(self):
+        anterior = {"_id": ObjectId(), "estadoPedido": "pendiente"}
+        self._ya_existe({"_id": self.id_clave, "estado": "completada", "idPedido": anterior["_id"]})
+        self.pedidos.find_one.return_value = anterior
+
+        self.assertIs(self._checkout(), anterior)
+        self.pedidos.find_one.assert_called_once_with({"_id": anterior["_id"]})
+        self.crear.assert_not_called()
+
+    def test_reenvio_duplicado_en_proceso_se_rechaza(self):
+        self._ya_existe({"_id": self.id_clave, "estado": "en_proceso"})
+
+        with self.assertRaisesRegex(ValueError, "ya se está procesando"):
+            self._checkout()
+        self.crear.assert_not_called()
+        # Solo se retoma si el alquiler venció
+        (filtro, _), _ = self.claves.find_one_and_update.call_args
+        self.assertEqual(filtro["estado"], "en_proceso")
+        self.assertIn("$lte", filtro["expiraProceso"])
+
+    def test_alquiler_vencido_se_retoma(self):
+        self._ya_existe(None, retomada={"_id": self.id_clave, "estado": "en_proceso"})
+
+        self.assertIs(self._checkout(), self.crear.return_value)
+
+    def test_si_falla_suelta_solo_su_propio_alquiler(self):
+        self.crear.side_effect = ValueError("sin stock")
+
+        with self.assertRaises(ValueError):
+            self._checkout()
+        (doc,), _ = self.claves.insert_one.call_args
+        self.claves.delete_one.assert_called_once_with(
+            {"_id": self.id_clave, "estado": "en_proceso", "expiraProceso": doc["expiraProceso"]}
+        )
+
+    def test_clave_con_formato_invalido(self):
+        self.clave = "corta"
+        with self.assertRaises(ValueError):
+            self._checkout()
+        self.claves.insert_one.assert_not_called()
+
+
+# ─────────────────────────────────────────────
+#  CARRITO: agregar con tope de stock en el filtro (colección simulada)
+# ─────────────────────────────────────────────
+
+class AgregarItemCarritoTests(SimpleTestCase):
+
+    def setUp(self):
+        self.usuario, self.producto = ObjectId(), ObjectId()
+        self.productos = mock.MagicMock()
+        self.productos.find_one.return_value = {
+            "_id": self.producto,
+            "nombreProducto": "Martillo",
+            "estadoProducto": "activo",
+            "inventario": {"stockActual": 10, "precioVenta": 100.0},
+        }
+        self.carritos = mock.MagicMock()
+        for objetivo, valor in (
+            ("get_productos_collection", mock.Mock(return_value=self.productos)),
+            ("get_carritos_collection", mock.Mock(return_value=self.carritos)),
+            ("ajustar_reservas", mock.Mock()),
+            ("obtener_o_crear_carrito_abierto", mock.Mock()),
+        ):
+            parche = mock.patch.object(mongo_service, objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def _agregar(self, cantidad):
+        return mongo_service.agregar_o_actualizar_item_carrito(
+            str(self.usuario), str(self.producto), cantidad
+        )
+
+    def test_una_sola_escritura_con_tope_de_stock_en_el_filtro(self):
+        self.carritos.find_one_and_update.return_value = {"itemsCarrito": []}
+
+        self._agregar(3)
+
+        self.carritos.find_one_and_update.assert_called_once()
+        self.carritos.find_one.assert_not_called()
+        (filtro, actualizacion), _ = self.carritos.find_one_and_update.call_args
+        self.assertEqual(filtro["$expr"], {"$lte": [
+            {"$add": [mongo_service._cantidad_item_carrito(self.producto), 3]},
+            10,
+        ]})
+        # Los totales van en el mismo update
+        self.assertIn("subtotalCarritoSnapshot", actualizacion[-2]["$set"])
+
+    def test_agregado_simultaneo_que_supera_el_stock_se_rechaza(self):
+        # Otro request ya dejó 9 en el carrito: el filtro no coincide
+        self.carritos.find_one_and_update.return_value = None
+        self.carritos.find_one.return_value = {"itemsCarrito": [{"idProducto": self.producto, "cantidad": 9}]}
+
+        with self.assertRaisesRegex(ValueError, "cantidad solicitada total en carrito: 11"):
+            self._agregar(2)
+        mongo_service.ajustar_reservas.assert_called_with(self.usuario, {self.producto: -2})
+        mongo_service.obtener_o_crear_carrito_abierto.assert_not_called()
+
+    def test_primer_uso_crea_el_carrito_y_reintenta(self):
+        self.carritos.find_one_and_update.side_effect = [None, {"itemsCarrito": []}]
+        self.carritos.find_one.return_value = None
+
+        self.assertEqual(self._agregar(1), {"itemsCarrito": []})
+        mongo_service.obtener_o_crear_carrito_abierto.assert_called_once_with(str(self.usuario))
+        self.assertEqual(self.carritos.find_one_and_update.call_count, 2)
+
+    def test_cantidad_mayor_al_stock_sin_escribir(self):
+        self.carritos.find_one_and_update.return_value = None
+        self.carritos.find_one.return_value = {"_id": ObjectId()}
+
+        with self.assertRaisesRegex(ValueError, "No hay stock suficiente"):
+            self._agregar(11)
+
+
+# ─────────────────────────────────────────────
+#  CARRITO DE INVITADO: cookie firmada y fusión al iniciar sesión
+# ─────────────────────────────────────────────
+
+class CookieCarritoInvitadoTests(SimpleTestCase):
+
+    def setUp(self):
+        self.ids = [str(ObjectId()) for _ in range(3)]
+
+    def _request_con(self, valor: str):
+        request = RequestFactory().get("/carrito/")
+        request.COOKIES[carrito_invitado.COOKIE] = valor
+        return request
+
+    def _cookie_firmada(self, items) -> str:
+        respuesta = HttpResponse()
+        respuesta.set_signed_cookie(
+            carrito_invitado.COOKIE, json.dumps(items), salt=carrito_invitado.SALT
+        )
+        return respuesta.cookies[carrito_invitado.COOKIE].value
+
+    def test_ida_y_vuelta(self):
+        items = {self.ids[0]: 2, self.ids[1]: 1}
+        respuesta = HttpResponse()
+        carrito_invitado.guardar(respuesta, items)
+
+        valor = respuesta.cookies[carrito_invitado.COOKIE].value
+        self.assertEqual(carrito_invitado.leer(self._request_con(valor)), items)
+
+    def test_cookie_alterada_se_ignora(self):
+        valor = self._cookie_firmada({self.ids[0]: 2})
+        alterada = valor.replace(": 2}", ": 99}")
+        self.assertNotEqual(alterada, valor)
+        self.assertEqual(carrito_invitado.leer(self._request_con(alterada)), {})
+        self.assertEqual(carrito_invitado.leer(self._request_con("basura")), {})
+
+    @override_settings(CARRITO_INVITADO_MAX_LINEAS=2)
+    def test_cookie_con_demasiadas_lineas_se_recorta(self):
+        valor = self._cookie_firmada({id_producto: 1 for id_producto in self.ids})
+        self.assertEqual(len(carrito_invitado.leer(self._request_con(valor))), 2)
+
+    @override_settings(CARRITO_INVITADO_MAX_LINEAS=2)
+    def test_no_se_pasa_del_maximo_de_lineas(self):
+        items = {self.ids[0]: 1, self.ids[1]: 1}
+        with self.assertRaises(ValueError):
+            carrito_invitado.fijar_cantidad(items, self.ids[2], 1)
+        self.assertEqual(carrito_invitado.fijar_cantidad(items, self.ids[0], 5)[self.ids[0]], 5)
+
+    def test_entradas_invalidas_se_descartan(self):
+        valor = self._cookie_firmada({
+            self.ids[0]: 2,
+            "no-es-un-id": 1,
+            self.ids[1]: -3,
+            self.ids[2]: True,
+            str(ObjectId()): "4",
+        })
+        self.assertEqual(carrito_invitado.leer(self._request_con(valor)), {self.ids[0]: 2})
+
+    def test_vacio_borra_la_cookie(self):
+        respuesta = HttpResponse()
+        carrito_invitado.guardar(respuesta, {})
+        self.assertEqual(respuesta.cookies[carrito_invitado.COOKIE]["max-age"], 0)
+
+
+@override_settings(RESERVAS_STOCK_ACTIVAS=False)
+class FusionCarritoInvitadoTests(SimpleTestCase):
+
+    def setUp(self):
+        self.usuario = ObjectId()
+        self.con_stock, self.agotado, self.inactivo = ObjectId(), ObjectId(), ObjectId()
+        self.productos = mock.MagicMock()
+        # _productos_para_carrito pide solo activos: el inactivo no vuelve
+        self.productos.find.return_value = [
+            {"_id": self.con_stock, "nombreProducto": "Martillo",
+             "inventario": {"stockActual": 3, "precioVenta": 100.0}},
+            {"_id": self.agotado, "nombreProducto": "Taladro",
+             "inventario": {"stockActual": 0, "precioVenta": 200.0}},
+        ]
+        self.carritos = mock.MagicMock()
+        for objetivo, valor in (
+            ("get_productos_collection", mock.Mock(return_value=self.productos)),
+            ("get_carritos_collection", mock.Mock(return_value=self.carritos)),
+        ):
+            parche = mock.patch.object(mongo_service, objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def _fusionar(self, items):
+        return mongo_service.fusionar_carrito_invitado(str(self.usuario), items)
+
+    def test_solo_consulta_productos_activos(self):
+        self._fusionar({str(self.con_stock): 1})
+        (filtro, _), _ = self.productos.find.call_args
+        self.assertEqual(filtro["estadoProducto"], "activo")
+
+    def test_agotados_e_inactivos_no_se_fusionan(self):
+        resultado = self._fusionar({str(self.agotado): 1, str(self.inactivo): 2})
+        self.assertIsNone(resultado)
+        self.carritos.find_one_and_update.assert_not_called()
+
+    def test_cantidad_nueva_con_tope_en_el_stock(self):
+        self._fusionar({str(self.con_stock): 10, str(self.agotado): 1, str(self.inactivo): 2})
+
+        (filtro, pipeline), opciones = self.carritos.find_one_and_update.call_args
+        self.assertEqual(filtro, {"idUsuarioCliente": self.usuario, "estadoCarrito": "abierto"})
+        self.assertTrue(opciones["upsert"])
+        nuevos = pipeline[0]["$set"]["itemsCarrito"]["$let"]["in"]["$concatArrays"][1]["$filter"]["input"]["$literal"]
+        self.assertEqual([(n["idProducto"], n["cantidad"]) for n in nuevos], [(self.con_stock, 3)])
+
+
+# ─────────────────────────────────────────────
+#  CARRITO: cambios en lote (validación antes de escribir)
+# ─────────────────────────────────────────────
+
+@override_settings(RESERVAS_STOCK_ACTIVAS=False)
+class CambiosCarritoLoteTests(SimpleTestCase):
+
+    def setUp(self):
+        self.usuario, self.producto = ObjectId(), ObjectId()
+        self.productos = mock.MagicMock()
+        self.productos.find.return_value = [{
+            "_id": self.producto, "nombreProducto": "Martillo",
+            "inventario": {"stockActual": 5, "precioVenta": 100.0},
+        }]
+        self.carritos = mock.MagicMock()
+        for objetivo, valor in (
+            ("get_productos_collection", mock.Mock(return_value=self.productos)),
+            ("get_carritos_collection", mock.Mock(return_value=self.carritos)),
+        ):
+            parche = mock.patch.object(mongo_service, objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def _lote(self, *cambios):
+        return mongo_service.actualizar_items_carrito_lote(str(self.usuario), list(cambios))
+
+    def test_tipos_estrictos(self):
+        invalidos = (
+            {"cantidad": True},
+            {"cantidad": 2.7},
+            {"cantidad": "2"},
+            {"cantidad": -1},
+            {"seleccionado": "false"},
+            {"seleccionado": 0},
+        )
+        for cambio in invalidos:
+            with self.subTest(cambio=cambio):
+                with self.assertRaises(ValueError):
+                    self._lote({"producto_id": str(self.producto), **cambio})
+        self.carritos.find_one_and_update.assert_not_called()
+
+    def test_lote_vacio_demasiado_grande_o_id_invalido(self):
+        with self.assertRaises(ValueError):
+            self._lote()
+        with self.assertRaises(ValueError):
+            self._lote(*[{"producto_id": str(ObjectId()), "cantidad": 1}] * (mongo_service.MAX_CAMBIOS_LOTE_CARRITO + 1))
+        with self.assertRaises(ValueError):
+            self._lote({"producto_id": "123", "cantidad": 1})
+        self.carritos.find_one_and_update.assert_not_called()
+
+    def test_sin_stock_no_se_aplica_nada(self):
+        with self.assertRaisesRegex(ValueError, "No hay stock suficiente para 'Martillo'"):
+            self._lote({"producto_id": str(self.producto), "cantidad": 6})
+        self.carritos.find_one_and_update.assert_not_called()
+
+    def test_cambios_validos_en_un_solo_update(self):
+        self.carritos.find_one_and_update.return_value = {"itemsCarrito": []}
+
+        self._lote(
+            {"producto_id": str(self.producto), "cantidad": 5},
+            {"producto_id": str(self.producto), "seleccionado": False},
+        )
+
+        self.productos.find.assert_called_once()
+        self.carritos.find_one_and_update.assert_called_once()
+        (filtro, _), _ = self.carritos.find_one_and_update.call_args
+        self.assertEqual(filtro["itemsCarrito.idProducto"], {"$all": [self.producto]})
+
+
+# ─────────────────────────────────────────────
+#  TRABAJOS: correo de confirmación una sola vez
+# ─────────────────────────────────────────────
+
+class CorreoConfirmacionPedidoTests(SimpleTestCase):
+
+    def setUp(self):
+        self.pedido = {"_id": ObjectId(), "idUsuarioCliente": ObjectId(), "itemsPedido": [], "totalPedido": 0}
+        self.pedidos = mock.MagicMock()
+        self.pedidos.find_one.return_value = self.pedido
+        self.usuarios = mock.MagicMock()
+        self.usuarios.find_one.return_value = {"nombres": "Ana", "correoElectronico": "ana@example.com"}
+        for objetivo, valor in (
+            ("get_pedidos_collection", mock.Mock(return_value=self.pedidos)),
+            ("get_usuarios_collection", mock.Mock(return_value=self.usuarios)),
+        ):
+            parche = mock.patch.object(mongo_service, objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+        parche = mock.patch.object(trabajos, "send_mail")
+        self.send_mail = parche.start()
+        self.addCleanup(parche.stop)
+
+    def test_marca_antes_de_enviar(self):
+        self.pedidos.update_one.return_value = mock.Mock(modified_count=1)
+
+        trabajos.confirmar_pedido({"idPedido": self.pedido["_id"]})
+
+        (filtro, cambios), _ = self.pedidos.update_one.call_args
+        self.assertEqual(filtro, {"_id": self.pedido["_id"], "correoConfirmacionEnviado": {"$exists": False}})
+        self.assertIn("correoConfirmacionEnviado", cambios["$set"])
+        self.send_mail.assert_called_once()
+
+    def test_reintento_no_repite_el_correo(self):
+        self.pedidos.update_one.return_value = mock.Mock(modified_count=0)
+
+        trabajos.confirmar_pedido({"idPedido": self.pedido["_id"]})
+
+        self.send_mail.assert_not_called()
+
+    def test_si_el_envio_falla_se_quita_la_marca(self):
+        self.pedidos.update_one.return_value = mock.Mock(modified_count=1)
+        self.send_mail.side_effect = OSError("smtp caído")
+
+        with self.assertRaises(OSError):
+            trabajos.confirmar_pedido({"idPedido": self.pedido["_id"]})
+
+        (_, marca), _ = self.pedidos.update_one.call_args_list[0]
+        (filtro, cambios), _ = self.pedidos.update_one.call_args
+        self.assertEqual(filtro["correoConfirmacionEnviado"], marca["$set"]["correoConfirmacionEnviado"])
+        self.assertEqual(cambios, {"$unset": {"correoConfirmacionEnviado": ""}})
@@ -0,0 +1,129 @@
+# accounts/trabajos.py
+"""
+Trabajador de la cola de trabajos (colección Trabajos).
+
+El request solo encola (mongo_service.encolar_trabajo); este módulo los
+ejecuta fuera de él con 'python manage.py procesar_trabajos'. Cada tipo de
+trabajo tiene su manejador, registrado con @manejador("tipo"), que recibe
+'datos' y lanza una excepción si hay que reintentar. Los manejadores deben
+poder repetirse sin daño: si el alquiler vence, otro trabajador lo retoma.
+"""
+import os
+import socket
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.mail import send_mail
+
+from . import mongo_service
+
+MANEJADORES = {}
+
+
+def manejador(tipo: str):
+    """Registra la función como manejador de los trabajos de 'tipo'."""
+    def registrar(funcion):
+        MANEJADORES[tipo] = funcion
+        return funcion
+    return registrar
+
+
+def nombre_trabajador() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def procesar_siguiente(trabajador: str) -> dict | None:
+    """
+    Toma y ejecuta un trabajo. Devuelve el trabajo (con el 'estado' final)
+    o None si la cola está vacía.
+    """
+    trabajo = mongo_service.tomar_trabajo(trabajador)
+    if trabajo is None:
+        return None
+
+    if trabajo["intentos"] > trabajo.get("maxIntentos", settings.TRABAJOS_MAX_INTENTOS):
+        # Se retomó tras vencer el alquiler, pero ya no le quedan intentos
+        trabajo["estado"] = mongo_service.fallar_trabajo(trabajo, "Alquiler vencido sin terminar")
+        return trabajo
+
+    funcion = MANEJADORES.get(trabajo["tipo"])
+    try:
+        if funcion is None:
+            raise LookupError(f"No hay manejador para el tipo '{trabajo['tipo']}'")
+        funcion(trabajo.get("datos", {}))
+    except Exception as e:
+        print(f"ERROR en trabajo {trabajo['_id']} ({trabajo['tipo']}):", e)
+        trabajo["estado"] = mongo_service.fallar_trabajo(trabajo, f"{type(e).__name__}: {e}")
+        return trabajo
+
+    mongo_service.completar_trabajo(trabajo)
+    trabajo["estado"] = "hecho"
+    return trabajo
+
+
+# ─────────────────────────────────────────────
+#  MANEJADORES
+# ─────────────────────────────────────────────
+
+@manejador("pedido_creado")
+def confirmar_pedido(datos: dict) -> None:
+    """
+    Envía el correo de confirmación del pedido al cliente, una sola vez:
+    antes de enviarlo marca 'correoConfirmacionEnviado' en el pedido (solo
+    si no estaba), así un reintento tras vencer el alquiler no lo repite.
+    Si el envío falla la marca se quita para que el reintento lo haga.
+    """
+    pedidos_col = mongo_service.get_pedidos_collection()
+    pedido = pedidos_col.find_one({"_id": datos["idPedido"]})
+    if not pedido:
+        return  # se borró entretanto: no hay nada que confirmar
+
+    usuario = mongo_service.get_usuarios_collection().find_one(
+        {"_id": pedido["idUsuarioCliente"]},
+        {"nombres": 1, "correoElectronico": 1},
+    )
+    if not usuario or not usuario.get("correoElectronico"):
+        return
+
+    marca = datetime.now(timezone.utc)
+    res = pedidos_col.update_one(
+        {"_id": pedido["_id"], "correoConfirmacionEnviado": {"$exists": False}},
+        {"$set": {"correoConfirmacionEnviado": marca}},
+    )
+    if res.modified_count == 0:
+        return  # ya se envió (o lo está enviando otro trabajador)
+
+    lineas = "\n".join(
+        f"  - {item.get('cantidad', 0)} x {item.get('nombreProducto', '')}: "
+        f"${item.get('subtotalLinea', 0):,.0f}"
+        for item in pedido.get("itemsPedido", [])
+    )
+    try:
+        send_mail(
+            subject=f"Recibimos tu pedido #{str(pedido['_id'])[-6:]}",
+            message=(
+                f"Hola {usuario.get('nombres', '')},\n\n"
+                f"Tu pedido quedó registrado:\n{lineas}\n\n"
+                f"Total: ${pedido.get('totalPedido', 0):,.0f}\n"
+            ),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            recipient_list=[usuario["correoElectronico"]],
+        )
+    except Exception:
+        pedidos_col.update_one(
+            {"_id": pedido["_id"], "correoConfirmacionEnviado": marca},
+            {"$unset": {"correoConfirmacionEnviado": ""}},
+        )
+        raise
+
+
+@manejador("resumen_pedido")
+def resumir_pedido(datos: dict) -> None:
+    """
+    Lleva los resúmenes de ventas al estado actual del pedido.
+    Si se tomó justo antes de que la reconstrucción pausara estos trabajos,
+    no escribe: se reintenta cuando termine.
+    """
+    if "resumen_pedido" in mongo_service.tipos_trabajo_pausados():
+        raise RuntimeError("Resúmenes de ventas en reconstrucción")
+    mongo_service.actualizar_resumenes_pedido(datos["idPedido"])
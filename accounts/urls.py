@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     path('', views.landing, name='landing'),
+    path('encabezado/', views.encabezado, name='encabezado'),
     path('login/', views.login_view, name='login'),
     path('registro/', views.register_view, name='registro'),
     path('logout/', views.logout_view, name='logout'),
@@ -13,10 +14,16 @@ urlpatterns = [
     path("carrito/agregar/", views.carrito_agregar, name="carrito_agregar"),
     path("carrito/actualizar-cantidad/", views.carrito_actualizar_cantidad, name="carrito_actualizar_cantidad"),
     path("carrito/actualizar-seleccion/", views.carrito_actualizar_seleccion, name="carrito_actualizar_seleccion"),
+    path("carrito/actualizar-lote/", views.carrito_actualizar_lote, name="carrito_actualizar_lote"),
     path("carrito/checkout/", views.carrito_checkout, name="carrito_checkout"),
+    path("pedidos/", views.mis_pedidos, name="mis_pedidos"),
     path("pedido/<str:pedido_id>/", views.pedido_detalle, name="pedido_detalle"),
     path("admin/productos/", views.admin_productos_list, name="admin_productos_list"),
     path("admin/productos/nuevo/", views.admin_producto_nuevo, name="admin_producto_nuevo"),
+    path("admin/productos/bajo-stock/", views.admin_productos_bajo_stock, name="admin_productos_bajo_stock"),
+    path("admin/ventas/", views.admin_ventas, name="admin_ventas"),
+    path("admin/pedidos/", views.admin_pedidos, name="admin_pedidos"),
+    path("admin/pedidos/<str:pedido_id>/cambiar-estado/", views.admin_pedido_cambiar_estado, name="admin_pedido_cambiar_estado"),
     path("admin/productos/<str:producto_id>/editar/", views.admin_producto_editar, name="admin_producto_editar"),
     path("admin/productos/<str:producto_id>/cambiar-estado/", views.admin_producto_cambiar_estado, name="admin_producto_cambiar_estado"),
     path("admin/productos/<str:producto_id>/eliminar/", views.admin_producto_eliminar, name="admin_producto_eliminar"),
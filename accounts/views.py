@@ -1,9 +1,26 @@
+import hashlib
+import json
+
 from django.shortcuts import render, redirect
 from django.contrib import messages
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.utils.safestring import mark_safe
+from django.views.decorators.cache import cache_control, never_cache
+from django.views.decorators.vary import vary_on_headers
+from bson import ObjectId
 from pymongo import errors
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
-from . import mongo_service
+from . import carrito_invitado, mongo_service
+from .context_processors import resumen_carrito_actual
+from .registros import Carrito
 
 # Categoría genérica por defecto para los productos.
 # Debe ser un ObjectId válido (24 caracteres hex).
@@ -34,10 +51,25 @@ def _usuario_tiene_rol(request, roles_permitidos: list[str]) -> bool:
     return rol_doc.get("nombreDeRol") in roles_permitidos
 
 
+def _guardar_resumen_carrito(request, resumen: dict) -> None:
+    """
+    Guarda en la sesión el resumen del carrito (contador del encabezado).
+    Las páginas lo leen de ahí sin consultar Carritos en cada visita.
+    Solo lo refrescan el login, las mutaciones del carrito y el checkout;
+    las vistas GET solo lo leen.
+    """
+    request.session["carrito_resumen"] = resumen
+
+
+@cache_control(public=True, max_age=settings.LANDING_CACHE_MAX_AGE)
+@vary_on_headers("Accept-Encoding")
 def landing(request):
     """
     Página principal de la tienda.
     Ahora carga los productos reales desde MongoDB.
+    Es pública e igual para todos: NO debe tocar request.session ni el
+    token CSRF (eso agregaría 'Vary: Cookie' y la volvería no cacheable).
+    Lo personalizado (saludo, login/logout, token) lo pide app.js a 'encabezado'.
     """
     try:
         productos = mongo_service.listar_productos_activos()
@@ -51,6 +83,23 @@ def landing(request):
     return render(request, "paginaprincipal.html", contexto)
 
 
+@never_cache
+def encabezado(request):
+    """
+    Fragmento JSON con la parte personalizada del encabezado
+    de las páginas cacheables (landing).
+    """
+    usuario_id = request.session.get("usuario_id")
+
+    datos = {
+        "autenticado": bool(usuario_id),
+        "nombre": request.session.get("usuario_nombre", "") if usuario_id else "",
+        "csrfToken": get_token(request),
+        "carrito": resumen_carrito_actual(request),
+    }
+    return JsonResponse(datos)
+
+
 def login_view(request):
     if request.method == "POST":
         correo = request.POST.get("email", "").strip().lower()
@@ -77,7 +126,31 @@ def login_view(request):
         request.session["usuario_nombre"] = usuario["nombres"]
         request.session["usuario_rol"] = str(usuario["idRol"])
 
-        return redirect("landing")
+        # Si armó un carrito como invitado, se fusiona con su carrito abierto
+        items_invitado = carrito_invitado.leer(request)
+        respuesta = redirect("carrito" if items_invitado else "landing")
+        try:
+            carrito = None
+            if items_invitado:
+                carrito = mongo_service.fusionar_carrito_invitado(
+                    request.session["usuario_id"], items_invitado
+                )
+                carrito_invitado.borrar(respuesta)
+                if carrito:
+                    messages.info(
+                        request,
+                        "Agregamos a tu carrito los productos que elegiste antes de iniciar sesión."
+                    )
+
+            if carrito:
+                resumen = mongo_service.resumen_carrito(carrito)
+            else:
+                resumen = mongo_service.obtener_resumen_carrito(request.session["usuario_id"])
+            _guardar_resumen_carrito(request, resumen)
+        except errors.PyMongoError as e:
+            print("ERROR Mongo al fusionar/leer el carrito:", e)
+
+        return respuesta
 
     return render(request, "login.html")
 
@@ -361,84 +434,173 @@ def carrito_detalle(request):
     """
     usuario_id = request.session.get("usuario_id")
     if not usuario_id:
-        messages.error(request, "Debes iniciar sesión para ver tu carrito.")
-        return redirect("login")
+        return _carrito_invitado_detalle(request)
 
     try:
-        carrito = mongo_service.obtener_o_crear_carrito_abierto(usuario_id)
+        carrito_doc = mongo_service.obtener_o_crear_carrito_abierto(usuario_id)
+        carrito = Carrito.desde_bson(carrito_doc)
     except Exception as e:
         print("ERROR al obtener carrito:", e)
         messages.error(request, "No fue posible cargar tu carrito en este momento.")
         return redirect("landing")
 
-        # Construir una lista de items “listos para la vista”
-    items_ui = []
-    for item in carrito.get("itemsCarrito", []):
-        id_producto = item.get("idProducto")
-        producto = None
-        precio_actual = None
-        precio_cambio = False
-        stock_actual = None
-        stock_minimo = None
-        stock_bajo = False
-
-        try:
-            producto = mongo_service.get_productos_collection().find_one({"_id": id_producto})
-        except Exception as e:
-            print("ERROR buscando producto de carrito:", e)
-
-        if producto:
-            inventario = producto.get("inventario", {})
-            precio_actual = inventario.get("precioVenta")
-            stock_actual = inventario.get("stockActual")
-            stock_minimo = inventario.get("stockMinimo")
-
-            if stock_actual is not None and stock_minimo is not None:
-                stock_bajo = stock_actual <= stock_minimo
-
-        precio_snapshot = item.get("precioUnitarioSnapshot")
-
-        if precio_actual is not None and precio_snapshot is not None:
-            precio_cambio = (precio_actual != precio_snapshot)
-
-        items_ui.append({
-            "idProducto": str(id_producto),
-            "nombreProducto": item.get("nombreProducto") or (producto or {}).get("nombreProducto", ""),
-            "cantidad": item.get("cantidad", 0),
-            "precio_snapshot": precio_snapshot,
-            "subtotal_snapshot": item.get("subtotalLineaSnapshot", 0),
-            "seleccionado": item.get("seleccionado", True),
-            "precio_actual": precio_actual,
-            "precio_cambio": precio_cambio,
-            "stock_actual": stock_actual,
-            "stock_minimo": stock_minimo,
-            "stock_bajo": stock_bajo,
-        })
-
-    # Flags globales para la vista
-    hay_precio_cambiado = any(
-        it.get("seleccionado") and it.get("precio_cambio")
-        for it in items_ui
-    )
-
-    hay_stock_bajo_seleccionado = any(
-        it.get("seleccionado") and it.get("stock_bajo")
-        for it in items_ui
-    )
+    # Items listos para la vista con un número fijo de consultas
+    try:
+        vista = mongo_service.construir_vista_carrito(carrito)
+    except Exception as e:
+        print("ERROR construyendo vista del carrito:", e)
+        messages.error(request, "No fue posible cargar tu carrito en este momento.")
+        return redirect("landing")
 
     direcciones = mongo_service.listar_direcciones_usuario(usuario_id)
 
     contexto = {
         "carrito": carrito,
-        "items": items_ui,
-        "hay_precio_cambiado": hay_precio_cambiado,
-        "hay_stock_bajo_seleccionado": hay_stock_bajo_seleccionado,
+        "items": vista["items"],
+        "hay_precio_cambiado": vista["hay_precio_cambiado"],
+        "hay_stock_bajo_seleccionado": vista["hay_stock_bajo_seleccionado"],
         "direcciones": direcciones,  # 👈 NUEVO
+        # Un doble clic o un reintento del proxy reenvían la misma clave
+        "clave_checkout": mongo_service.nueva_clave_idempotencia(),
     }
 
     return render(request, "carrito.html", contexto)
 
 
+def _carrito_invitado_detalle(request):
+    """
+    Carrito de un visitante sin sesión: se arma desde la cookie firmada
+    a precio actual, sin escribir en Mongo. Para comprar debe iniciar sesión.
+    """
+    try:
+        carrito = mongo_service.construir_carrito_invitado(carrito_invitado.leer(request))
+        vista = mongo_service.construir_vista_carrito(carrito)
+    except Exception as e:
+        print("ERROR construyendo carrito de invitado:", e)
+        messages.error(request, "No fue posible cargar tu carrito en este momento.")
+        return redirect("landing")
+
+    contexto = {
+        "carrito": carrito,
+        "items": vista["items"],
+        "hay_precio_cambiado": vista["hay_precio_cambiado"],
+        "hay_stock_bajo_seleccionado": vista["hay_stock_bajo_seleccionado"],
+        "direcciones": [],
+        "es_invitado": True,
+    }
+    return render(request, "carrito.html", contexto)
+
+
+def _carrito_json(carrito: dict) -> dict:
+    """
+    Estado del carrito para las respuestas JSON (ids como string).
+    """
+    return {
+        "items": [
+            {
+                "idProducto": str(item["idProducto"]),
+                "nombreProducto": item.get("nombreProducto", ""),
+                "cantidad": item.get("cantidad", 0),
+                "precioUnitarioSnapshot": item.get("precioUnitarioSnapshot", 0),
+                "subtotalLineaSnapshot": item.get("subtotalLineaSnapshot", 0),
+                "seleccionado": item.get("seleccionado", True),
+            }
+            for item in carrito.get("itemsCarrito", [])
+        ],
+        "subtotalCarritoSnapshot": carrito.get("subtotalCarritoSnapshot", 0),
+        "subtotalSeleccionadoSnapshot": carrito.get("subtotalSeleccionadoSnapshot", 0),
+        "totalSeleccionadoSnapshot": carrito.get("totalSeleccionadoSnapshot", 0),
+        "versionCarrito": carrito.get("versionCarrito", 0),
+    }
+
+
+def _quiere_json(request) -> bool:
+    """
+    True si la petición viene de fetch/AJAX y espera JSON
+    (Accept: application/json o X-Requested-With: XMLHttpRequest).
+    Sin JS se mantiene el flujo POST → redirect → GET.
+    """
+    return (
+        "application/json" in request.headers.get("Accept", "")
+        or request.headers.get("X-Requested-With") == "XMLHttpRequest"
+    )
+
+
+def _respuesta_carrito_ok(request, mensaje: str, datos: dict):
+    """
+    Éxito de una acción del carrito: JSON con 'datos' (delta) si lo pidió
+    fetch; si no, mensaje flash + redirect al carrito (PRG).
+    """
+    if _quiere_json(request):
+        return JsonResponse({"ok": True, "mensaje": mensaje, **datos})
+    messages.success(request, mensaje)
+    return redirect("carrito")
+
+
+def _respuesta_carrito_error(request, mensaje: str, status: int = 400):
+    if _quiere_json(request):
+        return JsonResponse({"ok": False, "error": mensaje}, status=status)
+    messages.error(request, mensaje)
+    return redirect("carrito")
+
+
+def _delta_carrito(carrito: dict, producto_id: str) -> dict:
+    """
+    Lo mínimo para actualizar la página sin recargarla: la línea que
+    cambió (None si se quitó), los totales y el resumen del encabezado.
+    """
+    linea = None
+    for item in _carrito_json(carrito)["items"]:
+        if item["idProducto"] == producto_id:
+            linea = item
+            break
+
+    return {
+        "linea": linea,
+        "totales": {
+            "subtotalCarritoSnapshot": carrito.get("subtotalCarritoSnapshot", 0),
+            "subtotalSeleccionadoSnapshot": carrito.get("subtotalSeleccionadoSnapshot", 0),
+            "totalSeleccionadoSnapshot": carrito.get("totalSeleccionadoSnapshot", 0),
+        },
+        "resumen": mongo_service.resumen_carrito(carrito),
+    }
+
+
+def _carrito_invitado_cambiar(request, producto_id: str, cantidad: int, sumar: bool):
+    """
+    Agrega unidades (sumar=True) o fija la cantidad (0 = quitar) de un
+    producto en el carrito de invitado. Valida producto y stock con una
+    lectura; el carrito solo se escribe en la cookie de la respuesta.
+    """
+    items = carrito_invitado.leer(request)
+    nueva_cantidad = items.get(producto_id, 0) + cantidad if sumar else cantidad
+
+    try:
+        if cantidad < 0 or (sumar and cantidad == 0):
+            raise ValueError("La cantidad debe ser mayor a 0")
+
+        if nueva_cantidad > 0:
+            mongo_service.validar_producto_para_carrito(producto_id, nueva_cantidad)
+        items = carrito_invitado.fijar_cantidad(items, producto_id, nueva_cantidad)
+    except ValueError as ve:
+        return _respuesta_carrito_error(request, str(ve))
+    except errors.PyMongoError as e:
+        print("ERROR Mongo en carrito de invitado:", e)
+        return _respuesta_carrito_error(request, "Ocurrió un error al actualizar el carrito.", 503)
+
+    if sumar:
+        mensaje = "Producto agregado al carrito. Inicia sesión para finalizar tu compra."
+    elif nueva_cantidad == 0:
+        mensaje = "Producto eliminado del carrito."
+    else:
+        mensaje = "Cantidad actualizada en el carrito."
+
+    respuesta = _respuesta_carrito_ok(
+        request, mensaje, {"resumen": carrito_invitado.resumen(items)}
+    )
+    carrito_invitado.guardar(respuesta, items)
+    return respuesta
+
 
 def carrito_agregar(request):
     """
@@ -446,23 +608,24 @@ def carrito_agregar(request):
     Espera POST con:
       - producto_id
       - cantidad
+    Responde JSON (delta) si se pide desde fetch; si no, redirige al carrito.
     """
     if request.method != "POST":
         return redirect("carrito")
 
     usuario_id = request.session.get("usuario_id")
-    if not usuario_id:
-        messages.error(request, "Debes iniciar sesión para agregar productos al carrito.")
-        return redirect("login")
 
-    producto_id = request.POST.get("producto_id", "").strip()
+    producto_id = request.POST.get("producto_id", "").strip().lower()
     cantidad_str = request.POST.get("cantidad", "1").strip()
 
     try:
         cantidad = int(cantidad_str)
     except ValueError:
-        messages.error(request, "La cantidad debe ser un número entero.")
-        return redirect("carrito")
+        return _respuesta_carrito_error(request, "La cantidad debe ser un número entero.")
+
+    # Visitante: el carrito vive en una cookie firmada hasta que inicie sesión
+    if not usuario_id:
+        return _carrito_invitado_cambiar(request, producto_id, cantidad, sumar=True)
 
     try:
         carrito = mongo_service.agregar_o_actualizar_item_carrito(
@@ -470,18 +633,25 @@ def carrito_agregar(request):
             producto_id,
             cantidad
         )
-        messages.success(request, "Producto agregado al carrito correctamente.")
+        _guardar_resumen_carrito(request, mongo_service.resumen_carrito(carrito))
     except ValueError as ve:
-        messages.error(request, str(ve))
+        return _respuesta_carrito_error(request, str(ve))
     except errors.PyMongoError as e:
         print("ERROR Mongo al agregar al carrito:", e)
-        messages.error(request, "Ocurrió un error al agregar el producto al carrito.")
+        return _respuesta_carrito_error(
+            request, "Ocurrió un error al agregar el producto al carrito.", 503
+        )
     except Exception as e:
         print("ERROR inesperado al agregar al carrito:", e)
-        messages.error(request, "Ocurrió un error inesperado al agregar el producto al carrito.")
+        return _respuesta_carrito_error(
+            request, "Ocurrió un error inesperado al agregar el producto al carrito.", 500
+        )
 
-    # Podrías redirigir a la página del producto o al carrito; por ahora al carrito:
-    return redirect("carrito")
+    return _respuesta_carrito_ok(
+        request,
+        "Producto agregado al carrito correctamente.",
+        _delta_carrito(carrito, producto_id),
+    )
 
 def carrito_actualizar_cantidad(request):
     """
@@ -490,23 +660,23 @@ def carrito_actualizar_cantidad(request):
       - producto_id
       - cantidad
     Si cantidad = 0, elimina el ítem del carrito.
+    Responde JSON (delta) si se pide desde fetch; si no, redirige al carrito.
     """
     if request.method != "POST":
         return redirect("carrito")
 
     usuario_id = request.session.get("usuario_id")
-    if not usuario_id:
-        messages.error(request, "Debes iniciar sesión para modificar tu carrito.")
-        return redirect("login")
 
-    producto_id = request.POST.get("producto_id", "").strip()
+    producto_id = request.POST.get("producto_id", "").strip().lower()
     cantidad_str = request.POST.get("cantidad", "").strip()
 
     try:
         nueva_cantidad = int(cantidad_str)
     except ValueError:
-        messages.error(request, "La cantidad debe ser un número entero.")
-        return redirect("carrito")
+        return _respuesta_carrito_error(request, "La cantidad debe ser un número entero.")
+
+    if not usuario_id:
+        return _carrito_invitado_cambiar(request, producto_id, nueva_cantidad, sumar=False)
 
     try:
         carrito = mongo_service.actualizar_cantidad_item_carrito(
@@ -514,20 +684,23 @@ def carrito_actualizar_cantidad(request):
             producto_id,
             nueva_cantidad
         )
-        if nueva_cantidad == 0:
-            messages.success(request, "Producto eliminado del carrito.")
-        else:
-            messages.success(request, "Cantidad actualizada en el carrito.")
+        _guardar_resumen_carrito(request, mongo_service.resumen_carrito(carrito))
     except ValueError as ve:
-        messages.error(request, str(ve))
+        return _respuesta_carrito_error(request, str(ve))
     except errors.PyMongoError as e:
         print("ERROR Mongo al actualizar cantidad:", e)
-        messages.error(request, "Ocurrió un error al actualizar la cantidad.")
+        return _respuesta_carrito_error(request, "Ocurrió un error al actualizar la cantidad.", 503)
     except Exception as e:
         print("ERROR inesperado al actualizar cantidad:", e)
-        messages.error(request, "Ocurrió un error inesperado al actualizar el carrito.")
+        return _respuesta_carrito_error(
+            request, "Ocurrió un error inesperado al actualizar el carrito.", 500
+        )
 
-    return redirect("carrito")
+    if nueva_cantidad == 0:
+        mensaje = "Producto eliminado del carrito."
+    else:
+        mensaje = "Cantidad actualizada en el carrito."
+    return _respuesta_carrito_ok(request, mensaje, _delta_carrito(carrito, producto_id))
 
 def carrito_actualizar_seleccion(request):
     """
@@ -535,16 +708,22 @@ def carrito_actualizar_seleccion(request):
     Espera POST con:
       - producto_id
       - seleccionado ( 'true' / 'false' )
+    Responde JSON (delta) si se pide desde fetch; si no, redirige al carrito.
     """
     if request.method != "POST":
         return redirect("carrito")
 
     usuario_id = request.session.get("usuario_id")
     if not usuario_id:
+        if _quiere_json(request):
+            return JsonResponse(
+                {"ok": False, "error": "Debes iniciar sesión para modificar tu carrito."},
+                status=401,
+            )
         messages.error(request, "Debes iniciar sesión para modificar tu carrito.")
         return redirect("login")
 
-    producto_id = request.POST.get("producto_id", "").strip()
+    producto_id = request.POST.get("producto_id", "").strip().lower()
     seleccionado_str = request.POST.get("seleccionado", "true").strip().lower()
     seleccionado = (seleccionado_str == "true")
 
@@ -554,70 +733,208 @@ def carrito_actualizar_seleccion(request):
             producto_id,
             seleccionado
         )
-        messages.success(request, "Carrito actualizado.")
+        _guardar_resumen_carrito(request, mongo_service.resumen_carrito(carrito))
     except ValueError as ve:
-        messages.error(request, str(ve))
+        return _respuesta_carrito_error(request, str(ve))
     except errors.PyMongoError as e:
         print("ERROR Mongo al actualizar selección:", e)
-        messages.error(request, "Ocurrió un error al actualizar el carrito.")
+        return _respuesta_carrito_error(request, "Ocurrió un error al actualizar el carrito.", 503)
     except Exception as e:
         print("ERROR inesperado al actualizar selección:", e)
-        messages.error(request, "Ocurrió un error inesperado al actualizar el carrito.")
+        return _respuesta_carrito_error(
+            request, "Ocurrió un error inesperado al actualizar el carrito.", 500
+        )
 
-    return redirect("carrito")
+    return _respuesta_carrito_ok(
+        request, "Carrito actualizado.", _delta_carrito(carrito, producto_id)
+    )
 
-from bson import ObjectId
+def carrito_actualizar_lote(request):
+    """
+    Aplica varios cambios al carrito en una sola petición.
+    Espera POST con cuerpo JSON:
+      {"cambios": [{"producto_id": "...", "cantidad": 2, "seleccionado": true}, ...]}
+    ('cantidad' y 'seleccionado' son opcionales; cantidad 0 quita el ítem).
+    Responde JSON con el carrito nuevo, sin redirigir ni re-renderizar.
+    """
+    if request.method != "POST":
+        return JsonResponse({"ok": False, "error": "Método no permitido."}, status=405)
 
-def pedido_detalle(request, pedido_id: str):
+    usuario_id = request.session.get("usuario_id")
+    if not usuario_id:
+        return JsonResponse(
+            {"ok": False, "error": "Debes iniciar sesión para modificar tu carrito."},
+            status=401,
+        )
+
+    try:
+        datos = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"ok": False, "error": "El cuerpo debe ser JSON válido."}, status=400)
+
+    cambios = datos.get("cambios") if isinstance(datos, dict) else None
+    if not isinstance(cambios, list) or not all(isinstance(c, dict) for c in cambios):
+        return JsonResponse(
+            {"ok": False, "error": "Se espera una lista 'cambios' de objetos."},
+            status=400,
+        )
+
+    try:
+        carrito = mongo_service.actualizar_items_carrito_lote(usuario_id, cambios)
+    except ValueError as ve:
+        return JsonResponse({"ok": False, "error": str(ve)}, status=400)
+    except errors.PyMongoError as e:
+        print("ERROR Mongo al actualizar carrito en lote:", e)
+        return JsonResponse(
+            {"ok": False, "error": "Ocurrió un error al actualizar el carrito."},
+            status=503,
+        )
+
+    resumen = mongo_service.resumen_carrito(carrito)
+    _guardar_resumen_carrito(request, resumen)
+
+    return JsonResponse({
+        "ok": True,
+        "carrito": _carrito_json(carrito),
+        "resumen": resumen,
+    })
+
+def _fecha_filtro(valor: str) -> datetime | None:
+    """'AAAA-MM-DD' del formulario → datetime UTC (None si viene vacío)."""
+    if not valor:
+        return None
+    return datetime.strptime(valor, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+
+def mis_pedidos(request):
     """
-    Muestra el detalle de un pedido específico del usuario.
+    Historial de pedidos del usuario, paginado por clave (?despues=...),
+    con filtros opcionales por estado y rango de fechas (?desde / ?hasta,
+    ambos incluidos).
     """
     usuario_id = request.session.get("usuario_id")
     if not usuario_id:
         messages.error(request, "Debes iniciar sesión para ver tus pedidos.")
         return redirect("login")
 
+    estado = request.GET.get("estado", "").strip()
+    desde_str = request.GET.get("desde", "").strip()
+    hasta_str = request.GET.get("hasta", "").strip()
+    despues = request.GET.get("despues", "").strip() or None
+
     try:
-        id_pedido = ObjectId(pedido_id)
-        id_usuario = ObjectId(usuario_id)
-    except Exception:
-        messages.error(request, "Identificador de pedido no válido.")
+        desde = _fecha_filtro(desde_str)
+        hasta = _fecha_filtro(hasta_str)
+    except ValueError:
+        messages.error(request, "Las fechas del filtro no son válidas.")
+        return redirect("mis_pedidos")
+    if hasta:
+        hasta += timedelta(days=1)  # el día 'hasta' completo
+
+    try:
+        pedidos, siguiente = mongo_service.listar_pedidos_usuario(
+            usuario_id, despues, estado or None, desde, hasta
+        )
+    except ValueError as ve:
+        messages.error(request, str(ve))
+        return redirect("mis_pedidos")
+    except Exception as e:
+        print("ERROR al listar pedidos:", e)
+        messages.error(request, "No fue posible cargar tus pedidos.")
         return redirect("landing")
 
-    pedidos_col = mongo_service.get_pedidos_collection()
+    # Mismos filtros para el enlace a la página siguiente
+    filtros = request.GET.copy()
+    filtros.pop("despues", None)
+
+    contexto = {
+        "pedidos": pedidos,
+        "siguiente": siguiente,
+        "es_primera_pagina": despues is None,
+        "filtros_qs": filtros.urlencode(),
+        "estados": mongo_service.ESTADOS_PEDIDO,
+        "estado": estado,
+        "desde": desde_str,
+        "hasta": hasta_str,
+        "active_section": "pedidos",
+    }
+    return render(request, "mis_pedidos.html", contexto)
+
+
+def _cuerpo_pedido_detalle(pedido_id: str, usuario_id: str, estado: str) -> str | None:
+    """
+    HTML del cuerpo del detalle (pedido_detalle_cuerpo.html), cacheado por
+    (pedido, estadoPedido): las líneas no cambian después del checkout y un
+    cambio de estado cambia la clave. None si el pedido ya no está.
+    """
+    clave = f"pedido:detalle:{pedido_id}:{estado}"
+    cuerpo = cache.get(clave)
+    if cuerpo is None:
+        pedido = mongo_service.obtener_pedido_usuario(pedido_id, usuario_id)
+        if pedido is None:
+            return None
+        cuerpo = render_to_string("pedido_detalle_cuerpo.html", {
+            "pedido": pedido,
+            "items": pedido.itemsPedido,
+            "pedido_id": pedido.id,
+        })
+        clave = f"pedido:detalle:{pedido_id}:{pedido.estadoPedido}"
+        cache.set(clave, str(cuerpo), settings.PEDIDO_DETALLE_CACHE_TTL)
+    return mark_safe(cuerpo)
+
+
+def pedido_detalle(request, pedido_id: str):
+    """
+    Muestra el detalle de un pedido específico del usuario.
+    Responde 304 si el navegador ya tiene esta misma versión (ETag).
+    """
+    usuario_id = request.session.get("usuario_id")
+    if not usuario_id:
+        messages.error(request, "Debes iniciar sesión para ver tus pedidos.")
+        return redirect("login")
 
     try:
-        pedido = pedidos_col.find_one({"_id": id_pedido})
+        estado = mongo_service.estado_pedido_usuario(pedido_id, usuario_id)
+    except ValueError as ve:
+        messages.error(request, str(ve))
+        return redirect("landing")
     except Exception as e:
         print("ERROR al buscar pedido:", e)
         messages.error(request, "No fue posible cargar el pedido.")
         return redirect("landing")
 
-    if not pedido:
+    if estado is None:
         messages.error(request, "El pedido no existe.")
         return redirect("landing")
 
-    if pedido.get("idUsuarioCliente") != id_usuario:
-        messages.error(request, "No tienes permiso para ver este pedido.")
-        return redirect("landing")
+    # La página también lleva el encabezado del usuario (nombre, carrito):
+    # entra en el ETag para no devolver 304 con un contador viejo.
+    # Con mensajes pendientes no hay 304 (hay que mostrarlos).
+    resumen = resumen_carrito_actual(request)
+    etag = quote_etag(hashlib.sha1(
+        f"{pedido_id}:{estado}:{request.session.get('usuario_nombre', '')}:{resumen}".encode()
+    ).hexdigest())
+    if not len(messages.get_messages(request)):
+        no_modificado = get_conditional_response(request, etag=etag)
+        if no_modificado is not None:
+            patch_cache_control(no_modificado, private=True, no_cache=True)
+            return no_modificado
 
-    items_ui = []
-    for it in pedido.get("itemsPedido", []):
-        items_ui.append({
-        "nombreProducto": it.get("nombreProducto", ""),
-        "cantidad": it.get("cantidad", 0),
-        "precioUnitario": it.get("precioUnitario", 0),
-        "subtotalLinea": it.get("subtotalLinea", 0),
-    })
+    try:
+        cuerpo = _cuerpo_pedido_detalle(pedido_id, usuario_id, estado)
+    except Exception as e:
+        print("ERROR al buscar pedido:", e)
+        messages.error(request, "No fue posible cargar el pedido.")
+        return redirect("landing")
 
-    pedido_id_str = str(pedido.get("_id"))  # 👈 NUEVO
+    if cuerpo is None:
+        messages.error(request, "El pedido no existe.")
+        return redirect("landing")
 
-    contexto = {
-        "pedido": pedido,
-        "items": items_ui,
-        "pedido_id": pedido_id_str,          # 👈 NUEVO
-}
-    return render(request, "pedido_detalle.html", contexto)
+    response = render(request, "pedido_detalle.html", {"cuerpo_pedido": cuerpo})
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 # ─────────────────────────────────────────────
 # ADMIN / VENDEDOR – CRUD DE PRODUCTOS
@@ -651,6 +968,129 @@ def admin_productos_list(request):
     return render(request, "admin_productos_list.html", contexto)
 
 
+def admin_productos_bajo_stock(request):
+    """
+    Lista de reposición: productos activos con stock en o bajo el mínimo.
+    """
+    if not _usuario_tiene_rol(request, ["Vendedor", "Admin"]):
+        messages.error(request, "No tienes permisos para administrar productos.")
+        return redirect("landing")
+
+    try:
+        productos = mongo_service.listar_productos_bajo_stock()
+    except Exception as e:
+        print("ERROR listar_productos_bajo_stock:", e)
+        messages.error(request, "Ocurrió un error al cargar los productos con stock bajo.")
+        productos = []
+
+    contexto = {
+        "productos": productos,
+    }
+    return render(request, "admin_productos_bajo_stock.html", contexto)
+
+
+PERIODOS_PANEL_VENTAS = (7, 30, 90)
+
+
+def admin_ventas(request):
+    """
+    Panel de ventas: lee solo los resúmenes pre-agregados
+    (mongo_service.resumen_ventas), nunca recorre Pedidos.
+    """
+    if not _usuario_tiene_rol(request, ["Vendedor", "Admin"]):
+        messages.error(request, "No tienes permisos para ver las ventas.")
+        return redirect("landing")
+
+    try:
+        dias = int(request.GET.get("dias", 30))
+    except ValueError:
+        dias = 30
+    if dias not in PERIODOS_PANEL_VENTAS:
+        dias = 30
+
+    try:
+        resumen = mongo_service.resumen_ventas(dias)
+    except Exception as e:
+        print("ERROR resumen_ventas:", e)
+        messages.error(request, "Ocurrió un error al cargar el resumen de ventas.")
+        resumen = {
+            "diario": [], "semanal": [], "productos": [],
+            "totales": {}, "metodos": {"metodoPago": [], "metodoEntrega": []},
+        }
+
+    contexto = {
+        **resumen,
+        "dias": dias,
+        "periodos": PERIODOS_PANEL_VENTAS,
+    }
+    return render(request, "admin_ventas.html", contexto)
+
+
+def admin_pedidos(request):
+    """
+    Pedidos de todos los clientes, del más reciente al más viejo,
+    paginados por clave (?despues=...) y con filtro opcional por estado.
+    Desde aquí se cambia el estado de cada pedido.
+    """
+    if not _usuario_tiene_rol(request, ["Vendedor", "Admin"]):
+        messages.error(request, "No tienes permisos para administrar pedidos.")
+        return redirect("landing")
+
+    estado = request.GET.get("estado", "").strip()
+    despues = request.GET.get("despues", "").strip() or None
+
+    try:
+        pedidos, siguiente = mongo_service.listar_pedidos(despues, estado or None)
+    except ValueError as ve:
+        messages.error(request, str(ve))
+        return redirect("admin_pedidos")
+    except Exception as e:
+        print("ERROR listar_pedidos:", e)
+        messages.error(request, "Ocurrió un error al cargar los pedidos.")
+        pedidos, siguiente = [], None
+
+    filtros = request.GET.copy()
+    filtros.pop("despues", None)
+
+    contexto = {
+        "pedidos": pedidos,
+        "siguiente": siguiente,
+        "es_primera_pagina": despues is None,
+        "filtros_qs": filtros.urlencode(),
+        "estados": mongo_service.ESTADOS_PEDIDO,
+        "estados_finales": mongo_service.ESTADOS_PEDIDO_FINALES,
+        "estado": estado,
+    }
+    return render(request, "admin_pedidos.html", contexto)
+
+
+def admin_pedido_cambiar_estado(request, pedido_id: str):
+    """
+    Cambia estadoPedido (pagado, enviado, cancelado...). Los resúmenes de
+    ventas se actualizan en segundo plano (trabajo 'resumen_pedido').
+    """
+    if request.method != "POST":
+        return redirect("admin_pedidos")
+
+    if not _usuario_tiene_rol(request, ["Vendedor", "Admin"]):
+        messages.error(request, "No tienes permisos para administrar pedidos.")
+        return redirect("landing")
+
+    try:
+        if mongo_service.cambiar_estado_pedido(pedido_id, request.POST.get("estado", "")):
+            messages.success(request, "Estado del pedido actualizado.")
+    except ValueError as ve:
+        messages.error(request, str(ve))
+    except Exception as e:
+        print("ERROR cambiar_estado_pedido:", e)
+        messages.error(request, "No se pudo cambiar el estado del pedido.")
+
+    volver = request.POST.get("volver", "")
+    if volver.startswith("?"):
+        return redirect(reverse("admin_pedidos") + volver)
+    return redirect("admin_pedidos")
+
+
 def admin_producto_nuevo(request):
     """
     Crear un producto nuevo.
@@ -932,14 +1372,22 @@ def carrito_checkout(request):
     except ValueError:
         costo_envio = 0.0
 
+    clave_idempotencia = (
+        request.POST.get("clave_idempotencia")
+        or request.headers.get("Idempotency-Key", "")
+    ).strip()
+
     try:
         pedido = mongo_service.crear_pedido_desde_carrito(
             usuario_id,
             metodo_entrega,
             metodo_pago,
-            costo_envio
+            costo_envio,
+            clave_idempotencia or None,
         )
         pedido_id_str = str(pedido.get("_id"))
+        # El carrito quedó convertido: el contador vuelve a cero
+        _guardar_resumen_carrito(request, mongo_service.resumen_carrito(None))
         messages.success(
             request,
             "Pedido creado correctamente."
@@ -947,6 +1395,12 @@ def carrito_checkout(request):
         return redirect("pedido_detalle", pedido_id=pedido_id_str)
 
 
+    except mongo_service.ErroresValidacionPedido as ev:
+        # Todos los problemas del carrito a la vez (sin stock, inactivos...)
+        for error in ev.errores:
+            messages.error(request, error)
+        return redirect("carrito")
+
     except ValueError as ve:
         # Errores de validación de negocio (sin stock, sin items seleccionados, etc.)
         messages.error(request, str(ve))
@@ -65,6 +65,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'accounts.context_processors.carrito_resumen',
             ],
         },
     },
@@ -76,6 +77,17 @@ STATIC_URL = "/static/"
 STATICFILES_DIRS = [
     BASE_DIR / 'static',
 ]
+# Destino de collectstatic (archivos minificados, con hash y pre-comprimidos)
+STATIC_ROOT = BASE_DIR / "staticfiles"
+
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "accounts.storage.ManifestComprimidoStorage",
+    },
+}
 
 
 
@@ -130,5 +142,76 @@ USE_TZ = True
 load_dotenv()
 
 MONGO_URI_ATLAS = os.getenv("MONGO_URI_ATLAS")
+# Para probar el checkout transaccional en local usar un replica set de un
+# nodo: mongod --replSet rs0, rs.initiate() y ...:27017/?replicaSet=rs0
 MONGO_URI_LOCAL = os.getenv("MONGO_URI_LOCAL")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
+
+
+# Caché de la app (catálogo / inventario).
+# LocMem es por proceso; con varios workers conviene un backend compartido
+# (Redis/Memcached) para que la invalidación de inventario llegue a todos.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "nexosoft",
+    }
+}
+
+# Datos descriptivos del catálogo (nombre, descripción, imagen): cambian poco
+CATALOGO_CACHE_TTL = int(os.getenv("CATALOGO_CACHE_TTL", 6 * 60 * 60))
+# Cada cuánto se relee la versión del catálogo desde Mongo
+CATALOGO_VERSION_TTL = int(os.getenv("CATALOGO_VERSION_TTL", 30))
+# Inventario (stock, mínimo, precio): cambia en cada compra
+INVENTARIO_CACHE_TTL = int(os.getenv("INVENTARIO_CACHE_TTL", 10))
+
+# Snapshot binario (BSON + mmap) del catálogo activo que cargan los workers
+# al arrancar. Dejar la variable vacía para desactivarlo.
+CATALOGO_SNAPSHOT_PATH = os.getenv("CATALOGO_SNAPSHOT_PATH", str(BASE_DIR / "catalogo.snapshot"))
+CATALOGO_SNAPSHOT_INTERVALO = int(os.getenv("CATALOGO_SNAPSHOT_INTERVALO", 60))
+
+# Cuerpo renderizado del detalle de pedido (clave: pedido + estadoPedido)
+PEDIDO_DETALLE_CACHE_TTL = int(os.getenv("PEDIDO_DETALLE_CACHE_TTL", 24 * 60 * 60))
+
+# Cache-Control de la página principal (pública, sin datos de sesión)
+LANDING_CACHE_MAX_AGE = int(os.getenv("LANDING_CACHE_MAX_AGE", 60))
+
+# Carrito de visitantes (cookie firmada, sin escrituras en Mongo hasta el login)
+CARRITO_INVITADO_MAX_LINEAS = int(os.getenv("CARRITO_INVITADO_MAX_LINEAS", 20))
+CARRITO_INVITADO_MAX_AGE = int(os.getenv("CARRITO_INVITADO_MAX_AGE", 14 * 24 * 60 * 60))
+
+# Retención de carritos: los abiertos sin cambios por este tiempo los borra
+# el índice TTL (python manage.py crear_indices aplica el cambio)
+CARRITO_ABANDONADO_DIAS = int(os.getenv("CARRITO_ABANDONADO_DIAS", 30))
+
+# Reservas de stock: al agregar al carrito las unidades quedan apartadas
+# (inventario.reservado) por RESERVA_STOCK_MINUTOS. Requiere correr
+# 'python manage.py liberar_reservas_vencidas' periódicamente (cron).
+RESERVAS_STOCK_ACTIVAS = os.getenv("RESERVAS_STOCK_ACTIVAS", "0") == "1"
+RESERVA_STOCK_MINUTOS = int(os.getenv("RESERVA_STOCK_MINUTOS", 15))
+
+# Checkout idempotente: cuánto se recuerda cada clave de envío del carrito
+# (un POST repetido con la misma clave devuelve el pedido ya creado)
+IDEMPOTENCIA_CHECKOUT_HORAS = int(os.getenv("IDEMPOTENCIA_CHECKOUT_HORAS", 24))
+# Si el proceso que tomó una clave muere, un reenvío la retoma pasado este tiempo
+IDEMPOTENCIA_PROCESO_SEGUNDOS = int(os.getenv("IDEMPOTENCIA_PROCESO_SEGUNDOS", 120))
+
+# Cola de trabajos en segundo plano (colección Trabajos). El trabajador se
+# corre con 'python manage.py procesar_trabajos'.
+TRABAJOS_LEASE_SEGUNDOS = int(os.getenv("TRABAJOS_LEASE_SEGUNDOS", 300))
+TRABAJOS_MAX_INTENTOS = int(os.getenv("TRABAJOS_MAX_INTENTOS", 5))
+TRABAJOS_HECHOS_DIAS = int(os.getenv("TRABAJOS_HECHOS_DIAS", 7))
+
+# Correos (confirmación de pedidos). En desarrollo se imprimen en consola.
+EMAIL_BACKEND = os.getenv("EMAIL_BACKEND", "django.core.mail.backends.console.EmailBackend")
+DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", "NexoSoft <no-responder@nexosoft.local>")
+
+# Libro de movimientos de inventario: los de días más viejos que esto se
+# resumen en saldos diarios con 'python manage.py compactar_movimientos'
+MOVIMIENTOS_RETENCION_DIAS = int(os.getenv("MOVIMIENTOS_RETENCION_DIAS", 90))
+
+# Resumen periódico de productos con stock bajo
+# ('python manage.py aviso_bajo_stock'), separados por coma
+AVISO_BAJO_STOCK_CORREOS = [
+    c.strip() for c in os.getenv("AVISO_BAJO_STOCK_CORREOS", "").split(",") if c.strip()
+]
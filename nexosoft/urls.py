@@ -1,5 +1,8 @@
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+
+from accounts.estaticos import servir_estatico
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -10,6 +13,13 @@ urlpatterns = [
     path("", include("accounts.urls")),
 ]
 
+# En desarrollo runserver sirve /static/ por su cuenta; en producción
+# servimos lo generado por collectstatic con caché inmutable.
+if not settings.DEBUG:
+    urlpatterns += [
+        re_path(r"^static/(?P<path>.*)$", servir_estatico),
+    ]
+
 # 👇 Importante: estas líneas van FUERA de urlpatterns
 handler404 = "accounts.views.custom_404"
 handler500 = "accounts.views.custom_500"
\ No newline at end of file
@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'nexosoft.settings')
 
 application = get_wsgi_application()
+
+
+# Cada worker arranca con el catálogo desde el snapshot en disco
+# y un hilo que lo regenera cuando cambia la versión del catálogo.
+from accounts import catalogo_snapshot  # noqa: E402
+
+catalogo_snapshot.iniciar()
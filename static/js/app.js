@@ -364,3 +364,109 @@ document.addEventListener("DOMContentLoaded", function () {
     });
   });
 });
+
+
+// ============================================================
+// 7. ENCABEZADO PERSONALIZADO (página pública cacheable)
+// ============================================================
+// La página principal se sirve igual para todos; el saludo, los enlaces
+// de sesión, el contador del carrito y el token CSRF de los formularios
+// llegan por /encabezado/.
+function aplicarEncabezado(datos) {
+  document.querySelectorAll("[data-solo-sesion]").forEach((el) => {
+    el.hidden = !datos.autenticado;
+  });
+  document.querySelectorAll("[data-solo-anonimo]").forEach((el) => {
+    el.hidden = datos.autenticado;
+  });
+
+  const nombreEl = document.getElementById("usuarioNombre");
+  if (nombreEl) nombreEl.textContent = datos.nombre || "";
+
+  const cartCountEl = document.getElementById("cartCount");
+  if (cartCountEl && datos.carrito) cartCountEl.textContent = datos.carrito.unidades;
+
+  if (!datos.csrfToken) return;
+
+  // Con el token ya se puede agregar de verdad: GET al carrito → POST a carrito_agregar
+  document.querySelectorAll(".product-cart-form[data-agregar-url]").forEach((form) => {
+    form.method = "post";
+    form.action = form.dataset.agregarUrl;
+  });
+
+  document.querySelectorAll('form[method="post"]').forEach((form) => {
+    let input = form.querySelector('input[name="csrfmiddlewaretoken"]');
+    if (!input) {
+      input = document.createElement("input");
+      input.type = "hidden";
+      input.name = "csrfmiddlewaretoken";
+      form.appendChild(input);
+    }
+    input.value = datos.csrfToken;
+  });
+}
+
+document.addEventListener("DOMContentLoaded", function () {
+  const url = document.body.dataset.encabezadoUrl;
+  if (!url) return;
+
+  fetch(url, { credentials: "same-origin", headers: { Accept: "application/json" } })
+    .then((resp) => (resp.ok ? resp.json() : null))
+    .then((datos) => {
+      if (datos) aplicarEncabezado(datos);
+    })
+    .catch(() => {});
+});
+
+
+// ============================================================
+// 8. AGREGAR AL CARRITO SIN SALIR DE LA PÁGINA
+// ============================================================
+// carrito_agregar responde JSON cuando se le pide (Accept); así el
+// contador se actualiza sin redirigir ni re-renderizar el carrito.
+// Si fetch falla, el formulario se envía de la forma tradicional.
+// Mientras /encabezado/ no haya traído el token no se envía nada: sin él
+// carrito_agregar respondería 403.
+function mostrarResultadoAgregar(form, texto, esError) {
+  let aviso = form.querySelector(".product-cart-msg");
+  if (!aviso) {
+    aviso = document.createElement("p");
+    aviso.className = "product-cart-msg";
+    form.appendChild(aviso);
+  }
+  aviso.textContent = texto;
+  aviso.classList.toggle("error", esError);
+}
+
+document.addEventListener("submit", function (event) {
+  const form = event.target;
+  if (!form.matches(".product-cart-form") || !window.fetch) return;
+  event.preventDefault();
+
+  if (!form.querySelector('input[name="csrfmiddlewaretoken"]')) {
+    mostrarResultadoAgregar(
+      form,
+      "No pudimos preparar el formulario. Recarga la página e intenta de nuevo.",
+      true
+    );
+    return;
+  }
+
+  fetch(form.action, {
+    method: "POST",
+    body: new FormData(form),
+    credentials: "same-origin",
+    headers: { Accept: "application/json" },
+  })
+    .then((resp) => resp.json())
+    .then((datos) => {
+      if (!datos.ok) {
+        mostrarResultadoAgregar(form, datos.error, true);
+        return;
+      }
+      const cartCountEl = document.getElementById("cartCount");
+      if (cartCountEl) cartCountEl.textContent = datos.resumen.unidades;
+      mostrarResultadoAgregar(form, datos.mensaje, false);
+    })
+    .catch(() => form.submit());
+});